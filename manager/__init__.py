@@ -2,13 +2,12 @@
 # Last Change: Nov 05, 2019
 
 import logging
+import operator
 import os
-import re
+import stat
+import time
 
-from bs4 import BeautifulSoup
-from humanfriendly import compact, concatenate, format_size, format_timespan, pluralize, Timer
-from proc.apache import find_apache_memory_usage, find_apache_workers
-from proc.core import Process
+from humanfriendly import compact, concatenate, format_size, pluralize, Timer
 from property_manager import (
     PropertyManager,
     cached_property,
@@ -17,22 +16,39 @@ from property_manager import (
     required_property,
     writable_property,
 )
-from six.moves.urllib.error import HTTPError
-from six.moves.urllib.request import urlopen
+from six import string_types
 
 from perf_moon.exceptions import AddressDiscoveryError, StatusPageError
+from perf_moon.history import MetricsHistory
+from perf_moon.hotspots import HeavyHitters, aggregate_requests
+from perf_moon.killer import KillScheduler
+from perf_moon.parsers import (
+    DEFAULT_PARSER,
+    coerce_value,
+    normalize_text,
+    parse_status_page,
+    parse_text_status,
+)
+from perf_moon.scoreboard import MISSING, Scoreboard, ScoreboardTracker
+from perf_moon.tracing import CycleTrace, traced
 
 __version__ = '0.2'
 __all__ = (
+    'COLLECTION_MODES',
+    'DEFAULT_ACCOUNTING',
+    'DEFAULT_ACTIVITY_FILE',
     'HANGING_WORKER_THRESHOLD',
     'IDLE_MODES',
+    'MEMORY_ACCOUNTING_MODES',
     'NATIVE_WORKERS_LABEL',
     'PORTS_CONF',
+    'SCOREBOARD_MODES',
     'STATUS_COLUMNS',
     'ApacheManager',
     'KillableWorker',
     'NetworkAddress',
     'NonNativeWorker',
+    'ScoreboardRow',
     'WorkerStatus',
 )
 
@@ -45,9 +61,66 @@ STATUS_COLUMNS = (
 
 IDLE_MODES = ('_', 'I', '.')
 
+SCOREBOARD_MODES = {
+    '_': 'waiting',
+    'S': 'starting',
+    'R': 'reading',
+    'W': 'sending',
+    'K': 'keepalive',
+    'D': 'dns',
+    'C': 'closing',
+    'L': 'logging',
+    'G': 'finishing',
+    'I': 'cleanup',
+    '.': 'open',
+}
+
+COLLECTION_MODES = ('full', 'lean')
+
+# How the memory usage of a worker is measured: the resident set size (which
+# counts pages shared with the Apache master process in every worker), the
+# proportional set size (shared pages divided by the number of processes
+# sharing them) or the unique set size (only the private pages).
+MEMORY_ACCOUNTING_MODES = ('rss', 'pss', 'uss')
+
+DEFAULT_ACCOUNTING = 'rss'
+
 NATIVE_WORKERS_LABEL = 'native'
 
+# One-shot runs (e.g. from cron) keep the CPU times and busy periods of the
+# workers in this file, the /proc fallback needs them to derive SS.
+DEFAULT_ACTIVITY_FILE = '/tmp/perf-moon.activity'
+
 HANGING_WORKER_THRESHOLD = 60 * 5
+
+# Cached properties derived from the Apache configuration, these survive
+# refresh() unless the configuration is explicitly reloaded.
+CONFIG_PROPERTIES = (
+    'apache_config', 'html_status_url', 'listen_addresses', 'status_location', 'status_urls', 'text_status_url',
+)
+
+# The metrics reported since the first release, by the name of the field in
+# the plain text status page: (metric name, type, multiplier).
+SERVER_METRICS = {
+    # Example: "Total Accesses: 49038"
+    'total_accesses': ('total_accesses', int, 1),
+    # Example: "Total kBytes: 169318"
+    'total_kbytes': ('total_traffic', int, 1024),
+    # Example: "CPULoad: 7.03642"
+    'cpu_load': ('cpu_load', float, 1),
+    # Example: "Uptime: 85017"
+    'uptime': ('uptime', int, 1),
+    # Example: "ReqPerSec: .576802"
+    'req_per_sec': ('requests_per_second', float, 1),
+    # Example: "BytesPerSec: 2039.38"
+    'bytes_per_sec': ('bytes_per_second', float, 1),
+    # Example: "BytesPerReq: 3535.66"
+    'bytes_per_req': ('bytes_per_request', float, 1),
+    # Example: "BusyWorkers: 2"
+    'busy_workers': ('busy_workers', int, 1),
+    # Example: "IdleWorkers: 6"
+    'idle_workers': ('idle_workers', int, 1),
+}
 logger = logging.getLogger(__name__)
 
 
@@ -75,54 +148,164 @@ class ApacheManager(PropertyManager):
     def ports_config(self):
         return PORTS_CONF
 
+    @mutable_property
+    def config_file(self):
+        # On Debian the main configuration file includes ports.conf, it's
+        # used unless a different ports.conf was given.
+        from perf_moon.config import APACHE_CONFIG
+        if self.ports_config == PORTS_CONF and os.path.isfile(APACHE_CONFIG):
+            return APACHE_CONFIG
+        return self.ports_config
+
+    @mutable_property
+    def config_cache(self):
+        # The file that caches the results of configuration discovery (None
+        # disables the cache).
+        from perf_moon.config import DEFAULT_CACHE_FILE
+        return DEFAULT_CACHE_FILE
+
+    @writable_property(cached=True)
+    def connection_pool(self):
+        from perf_moon.transport import ConnectionPool
+        return ConnectionPool()
+
+    @writable_property(cached=True)
+    def process_snapshot(self):
+        from perf_moon.processes import ProcessSnapshot
+        return ProcessSnapshot()
+
+    @writable_property(cached=True)
+    def trace(self):
+        return CycleTrace()
+
+    @writable_property(cached=True)
+    def history(self):
+        return MetricsHistory()
+
+    @mutable_property
+    def growth_horizon(self):
+        # Memory growth is only tracked (which means measuring the memory
+        # usage of every worker on every cycle) when a horizon is set.
+        return None
+
+    @writable_property(cached=True)
+    def growth_tracker(self):
+        from perf_moon.growth import GrowthTracker
+        return GrowthTracker()
+
+    @writable_property(cached=True)
+    def activity_tracker(self):
+        from perf_moon.activity import ActivityTracker
+        return ActivityTracker()
+
+    @mutable_property
+    def status_fallback(self):
+        # Derive the scoreboard from /proc when the status page can't be fetched.
+        return True
+
+    @mutable_property
+    def activity_file(self):
+        # Where the state of the activity tracker is kept between runs (None
+        # keeps it in memory, which suits long running processes).
+        return None
+
+    @writable_property(cached=True)
+    def heavy_hitters(self):
+        return HeavyHitters()
+
+    @writable_property(cached=True)
+    def scoreboard_tracker(self):
+        return ScoreboardTracker(HANGING_WORKER_THRESHOLD)
+
+    @writable_property
+    def num_recycled(self):
+        return 0
+
+    @writable_property(cached=True)
+    def kill_scheduler(self):
+        return KillScheduler()
+
+    @writable_property
+    def kill_results(self):
+        return []
+
+    @mutable_property
+    def collection_mode(self):
+        return 'full'
+
+    @mutable_property
+    def history_file(self):
+        # The binary history file that save_metrics() appends to (optional).
+        return None
+
+    @mutable_property
+    def snapshot_file(self):
+        # The file that save_metrics() records worker snapshots in (optional).
+        return None
+
+    @mutable_property
+    def memory_accounting(self):
+        return DEFAULT_ACCOUNTING
+
+    @property
+    def have_worker_details(self):
+        # In lean mode the HTML status page is only fetched on demand, so the
+        # per-PID details are available only once something asked for them.
+        return self.collection_mode != 'lean' or 'slots' in self.__dict__
+
+    @cached_property
+    def apache_config(self):
+        from perf_moon.config import discover_config
+        return discover_config(self.config_file, self.config_cache)
+
     @cached_property
     def listen_addresses(self):
-        
-        logger.debug("Discovering where Apache is listening by parsing %s ..", self.ports_config)
-        
-        if not os.path.isfile(self.ports_config):
-            raise AddressDiscoveryError(compact("""Failed!""", filename=self.ports_config))
         matched_addresses = []
-        pattern = re.compile(r'^(.+):(\d+)$')
-        with open(self.ports_config) as handle:
-            for lnum, line in enumerate(handle, start=1):
-                tokens = line.split()
-                if len(tokens) >= 2 and tokens[0] == 'Listen':
-                    parsed_value = None
-                    if tokens[1].isdigit():
-                        parsed_value = NetworkAddress(port=int(tokens[1]))
-                    else:
-                        match = pattern.match(tokens[1])
-                        if match:
-                            address = match.group(1)
-                            port = int(match.group(2))
-                            if address == '0.0.0.0':
-                                address = '127.0.0.1'
-                            parsed_value = NetworkAddress(address=address, port=port)
-                    if parsed_value is not None:
-                        if len(tokens) >= 3:
-                            parsed_value.protocol = tokens[2]
-                        logger.debug("Parsed listen directive on line %i: %s", lnum, parsed_value)
-                        matched_addresses.append(parsed_value)
-                    else:
-                        logger.warning("Failed to parse listen directive on line %i: %s", lnum, line)
+        for address, port, protocol in self.apache_config.listen:
+            parsed_value = NetworkAddress(address=address, port=port)
+            if protocol:
+                parsed_value.protocol = protocol
+            matched_addresses.append(parsed_value)
         if not matched_addresses:
             raise AddressDiscoveryError(compact("""
                 Failed to discover any addresses or ports that Apache is
                 listening on! Maybe I'm parsing the wrong configuration file?
                 ({filename})
-            """, filename=self.ports_config))
+            """, filename=self.config_file))
         logger.debug("Discovered %s that Apache is listening on: %s",
                      pluralize(len(matched_addresses), "address", "addresses"),
                      concatenate(map(str, matched_addresses)))
         return matched_addresses
 
+    @cached_property
+    def status_location(self):
+        # The path and port of the server-status handler (the port is None
+        # when it's not configured in a virtual host).
+        from perf_moon.config import DEFAULT_STATUS_PATH
+        locations = self.apache_config.status_locations
+        return locations[0] if locations else (DEFAULT_STATUS_PATH, None)
+
     @cached_property(writable=True)
     def html_status_url(self):
-        status_url = "%s/server-status" % self.listen_addresses[0].url
+        path, port = self.status_location
+        addresses = [a for a in self.listen_addresses if port in (None, a.port)] or self.listen_addresses
+        status_url = "%s%s" % (addresses[0].url, path)
         logger.debug("Discovered Apache HTML status page URL: %s", status_url)
         return status_url
 
+    @cached_property
+    def status_urls(self):
+        # The status handler of each address (skipping addresses where the
+        # handler is only configured in a virtual host on another port).
+        from perf_moon.config import DEFAULT_STATUS_PATH
+        locations = self.apache_config.status_locations or [(DEFAULT_STATUS_PATH, None)]
+        status_urls = []
+        for address in self.listen_addresses:
+            paths = [path for path, port in locations if port in (None, address.port)]
+            if paths:
+                status_urls.append("%s%s" % (address.url, paths[0]))
+        return status_urls
+
     @cached_property
     def text_status_url(self):
         status_url = "%s?auto" % self.html_status_url
@@ -130,10 +313,12 @@ class ApacheManager(PropertyManager):
         return status_url
 
     @cached_property
+    @traced('fetch_html_status')
     def html_status(self):
         return self.fetch_status_page(self.html_status_url)
 
     @cached_property
+    @traced('fetch_text_status')
     def text_status(self):
         return self.fetch_status_page(self.text_status_url).decode()
 
@@ -141,93 +326,207 @@ class ApacheManager(PropertyManager):
         timer = Timer()
         logger.debug("Fetching Apache status page from %s ..", status_url)
         try:
-            response = urlopen(status_url)
-        except HTTPError as e:
-            response = e
-        response_code = response.getcode()
+            response_code, response_body = self.connection_pool.fetch(status_url)
+        except StatusPageError:
+            self.status_response = False
+            raise
         if response_code != 200:
             self.status_response = False
             raise StatusPageError(compact("""
                 Failed to retrieve Apache status page from {url}! Expected to
                 get HTTP response status 200, got {code} instead.
             """, url=status_url, code=response_code))
-        response_body = response.read()
         logger.debug("Fetched %s in %s.", format_size(len(response_body)), timer)
+        self.trace.count('bytes_fetched', len(response_body))
         self.status_response = True
         return response_body
 
     @cached_property
+    @traced('parse_text_status')
+    def text_status_fields(self):
+        return parse_text_status(self.text_status)
+
+    @cached_property
+    def scoreboard(self):
+        scoreboard = self.text_status_fields.get('scoreboard')
+        if isinstance(scoreboard, string_types):
+            return scoreboard
+        else:
+            logger.warning("Plain text Apache status page doesn't contain a scoreboard!")
+            return ''
+
+    @cached_property
+    def mode_counts(self):
+        scoreboard = self.scoreboard
+        return dict((mode, scoreboard.count(mode)) for mode in SCOREBOARD_MODES)
+
+    @mutable_property
+    def status_parser(self):
+        return DEFAULT_PARSER
+
+    @cached_property
+    @traced('parse_html_status')
     def slots(self):
-        soup = BeautifulSoup(self.html_status, "html.parser")
+        try:
+            html_status = self.html_status
+        except StatusPageError as e:
+            # When Apache is saturated the status page request queues behind
+            # the busy workers, which is exactly when the hang detection and
+            # kill logic need the per-worker details.
+            if not self.status_fallback:
+                raise
+            logger.warning("Deriving worker states from /proc! (%s)", e)
+            return self.fallback_slots
         required_columns = [normalize_text(c) for c in STATUS_COLUMNS]
-        for table in soup.findAll('table'):
-            matched_rows = list(parse_status_table(table))
-            validated_rows = [r for r in matched_rows if all(c in r for c in required_columns)]
-            if validated_rows:
-                return [WorkerStatus(status_fields=f) for f in validated_rows]
+        validated_rows = parse_status_page(html_status, required_columns, parser=self.status_parser)
+        self.trace.count('rows_parsed', len(validated_rows))
+        if validated_rows:
+            # The rows are stored in typed columns instead of one WorkerStatus
+            # object (and dictionary) per slot, which adds up on servers with
+            # thousands of slots.
+            return Scoreboard.from_rows(validated_rows, row_type=ScoreboardRow)
         raise StatusPageError(compact("""
             Failed to parse Apache status page! No tables found containing all
             of the required column headings and at least one row of data that
             could be parsed.
         """))
 
+    @cached_property
+    @traced('fallback_slots')
+    def fallback_slots(self):
+        try:
+            ports = set(a.port for a in self.listen_addresses)
+        except Exception:
+            ports = None
+        rows = self.activity_tracker.scoreboard_rows(self.apache_workers, ports)
+        return Scoreboard.from_rows(rows, row_type=ScoreboardRow)
+
     @cached_property
     def workers(self):
-        return [ws for ws in self.slots if ws.m != '.']
+        return self.slots.select(self.slots.mode_mask('.', negate=True))
 
     @cached_property
     def hanging_workers(self):
-        return [ws for ws in self.workers if ws.is_active and ws.ss >= HANGING_WORKER_THRESHOLD]
+        return self.slots.select(self.slots.mode_mask(IDLE_MODES, negate=True),
+                                 self.slots.threshold_mask(self.slots.ss, HANGING_WORKER_THRESHOLD))
+
+    @cached_property
+    @traced('slot_events')
+    def slot_events(self):
+        # Changes to the scoreboard since the previous cycle, subscribers of
+        # the scoreboard tracker receive these as well.
+        if self.slots is self.__dict__.get('fallback_slots'):
+            # The slots derived from /proc don't have server slot numbers or
+            # request counters, comparing them to a real scoreboard (in either
+            # direction) produces bogus events.
+            self.scoreboard_tracker.reset()
+            return []
+        # The busy periods are matched to the workers found by the process
+        # scan (which also loads the state saved by a previous run), so that
+        # the /proc fallback of a later cycle or run can continue them.
+        self.apache_workers
+        self.activity_tracker.note_scoreboard(self.slots)
+        events = self.scoreboard_tracker.update(self.slots)
+        # On threaded MPMs every thread of a replaced process has an event.
+        self.num_recycled += len(set((e.slot, e.previous_pid) for e in events if e.kind == 'pid_replaced'))
+        return events
 
     @cached_property
+    @traced('request_hotspots')
+    def request_hotspots(self):
+        # The busy slots grouped by virtual host and route. Each cycle adds
+        # the number of slots per group to the heavy hitters sketch, so
+        # that shows which routes tie up the most slots over time.
+        groups = aggregate_requests(self.slots, [m for m in SCOREBOARD_MODES if m not in IDLE_MODES])
+        for group in groups:
+            self.heavy_hitters.add((group.vhost, group.route), group.count)
+        return groups
+
+    @cached_property
+    @traced('killable_workers')
     def killable_workers(self):
         all_workers = list(self.workers)
         native_pids = set(w.pid for w in self.workers)
-        for process in find_apache_workers():
+        for worker in all_workers:
+            process = self.process_snapshot.get(worker.pid)
+            if process is not None:
+                worker.process = process
+        for process in self.apache_workers:
             if process.pid not in native_pids:
                 all_workers.append(NonNativeWorker(process=process))
         return sorted(all_workers, key=lambda p: p.pid)
 
+    @cached_property
+    @traced('scan_processes')
+    def apache_workers(self):
+        # A single scan of /proc per cycle is shared by the memory usage and
+        # kill logic (the snapshot is updated incrementally between cycles).
+        self.process_snapshot.update()
+        self.trace.count('pids_scanned', len(self.process_snapshot.processes))
+        workers = self.process_snapshot.find_apache_workers()
+        timestamp = time.time()
+        if self.activity_file and self.activity_tracker.timestamp is None:
+            self.activity_tracker.load(self.activity_file)
+        if self.growth_horizon:
+            self.growth_tracker.observe(timestamp, workers, self.measure_memory)
+        self.activity_tracker.observe(timestamp, workers)
+        return workers
+
+    def measure_memory(self, process):
+        return self.process_snapshot.memory_usage(process, self.memory_accounting)
+
     @property
     def manager_metrics(self):
-        return dict(workers_hanging=len(self.hanging_workers),
-                    workers_killed_active=self.num_killed_active,
-                    workers_killed_idle=self.num_killed_idle,
-                    status_response=self.status_response)
+        metrics = dict(workers_killed_active=self.num_killed_active,
+                       workers_killed_idle=self.num_killed_idle,
+                       status_response=self.status_response)
+        metrics.update(self.connection_pool.latency.metrics('status_fetch'))
+        metrics.update(self.history.current_metrics())
+        metrics.update(self.trace.metrics())
+        # These need the per-PID details of the HTML status page, so in lean
+        # mode (which exists to avoid fetching that page) they're missing
+        # from the data file unless something else needed the details.
+        if self.have_worker_details:
+            metrics['workers_hanging'] = len(self.hanging_workers)
+            metrics['workers_recycled'] = self.num_recycled
+            # The number of slots derived from /proc (when the status page
+            # couldn't be fetched).
+            metrics['fallback_slots'] = len(self.__dict__.get('fallback_slots', ()))
+        return metrics
 
     @cached_property
     def server_metrics(self):
         logger.debug("Extracting metrics from Apache's plain text status page ..")
-        return dict(
-            # Example: "Total Accesses: 49038"
-            total_accesses=int(self.extract_metric(r'^Total Accesses: (\d+)')),
-            # Example: "Total kBytes: 169318"
-            total_traffic=int(self.extract_metric(r'^Total KBytes: (\d+)')) * 1024,
-            # Example: "CPULoad: 7.03642"
-            cpu_load=float(self.extract_metric(r'^CPULoad: ([0-9.]+)')),
-            # Example: "Uptime: 85017"
-            uptime=int(self.extract_metric(r'^Uptime: (\d+)')),
-            # Example: "ReqPerSec: .576802"
-            requests_per_second=float(self.extract_metric(r'^ReqPerSec: ([0-9.]+)')),
-            # Example: "BytesPerSec: 2039.38"
-            bytes_per_second=float(self.extract_metric(r'^BytesPerSec: ([0-9.]+)')),
-            # Example: "BytesPerReq: 3535.66"
-            bytes_per_request=float(self.extract_metric(r'^BytesPerReq: ([0-9.]+)')),
-            # Example: "BusyWorkers: 2"
-            busy_workers=int(self.extract_metric(r'^BusyWorkers: (\d+)')),
-            # Example: "IdleWorkers: 6"
-            idle_workers=int(self.extract_metric(r'^IdleWorkers: (\d+)')),
-        )
+        metrics = dict((n, v) for n, v in self.text_status_fields.items()
+                       if not isinstance(v, string_types))
+        for key, (name, type, multiplier) in SERVER_METRICS.items():
+            value = metrics.pop(key, None)
+            if value is None:
+                logger.warning("Field %r missing from plain text Apache status page contents!", key)
+                value = 0
+            metrics[name] = type(value) * multiplier
+        # Example: "Scoreboard: _W___K......"
+        for mode, name in SCOREBOARD_MODES.items():
+            metrics['slots_%s' % name] = self.mode_counts[mode]
+        return metrics
 
-    def extract_metric(self, pattern, default='0'):
-        modified_pattern = re.sub(r'\s+', r'\s+', pattern)
-        match = re.search(modified_pattern, self.text_status, re.IGNORECASE | re.MULTILINE)
-        if match:
-            logger.debug("Pattern '%s' matched '%s'.", pattern, match.group(0))
-            return match.group(1)
-        else:
-            logger.warning("Pattern %r didn't match plain text Apache status page contents!", pattern)
-            return default
+    @cached_property
+    def sample_time(self):
+        # The metrics of a cycle are recorded in the history at most once, no
+        # matter how many consumers (watch mode, data file, daemon) ask for it.
+        timestamp = time.time()
+        if self.have_worker_details:
+            # The per-slot consumers (scoreboard events and request hot spots)
+            # are updated once per cycle as well.
+            self.slot_events
+            self.request_hotspots
+        metrics = dict(self.server_metrics)
+        metrics.update(self.manager_metrics)
+        self.history.record(timestamp, metrics)
+        return timestamp
+
+    def record_metrics(self):
+        return self.sample_time
 
     @cached_property
     def memory_usage(self):
@@ -238,48 +537,88 @@ class ApacheManager(PropertyManager):
         return self.combined_memory_usage[1]
 
     @cached_property
+    def memory_groups(self):
+        groups = dict(self.wsgi_process_groups)
+        groups[NATIVE_WORKERS_LABEL] = self.memory_usage
+        return groups
+
+    @cached_property
+    @traced('memory_usage')
     def combined_memory_usage(self):
-        return find_apache_memory_usage()
-
-    def kill_workers(self, max_memory_active=0, max_memory_idle=0, timeout=0, dry_run=False):
-        killed = set()
-        num_checked = 0
-        for worker in self.killable_workers:
-            if worker.pid not in killed:
-                kill_worker = False
-                memory_usage_threshold = max_memory_active if worker.is_active else max_memory_idle
-                if memory_usage_threshold and worker.memory_usage > memory_usage_threshold:
-                    logger.info("Killing %s using %s (%s) ..",
-                                worker, format_size(worker.memory_usage),
-                                worker.request or 'last request unknown')
-                    kill_worker = True
-                elif timeout and worker.is_active and getattr(worker, 'ss', 0) > timeout:
-                    logger.info("Killing %s hanging for %s since last request (%s) ..",
-                                worker, format_timespan(worker.ss),
-                                worker.request or 'unknown')
-                    kill_worker = True
-                if kill_worker:
-                    if not dry_run:
-                        worker.process.kill()
-                    killed.add(worker.pid)
-                    if worker.is_active:
-                        self.num_killed_active += 1
-                    else:
-                        self.num_killed_idle += 1
-            num_checked += 1
-        if killed:
-            logger.info("Killed %i of %s.", len(killed), pluralize(num_checked, "Apache worker"))
+        from perf_moon.processes import summarize_memory_usage
+        return summarize_memory_usage(self.apache_workers, self.measure_memory)
+
+    @traced('kill_workers')
+    def kill_workers(self, max_memory_active=0, max_memory_idle=0, timeout=0, horizon=0, dry_run=False):
+        if horizon and not self.growth_horizon:
+            # Growth is tracked from the next cycle on.
+            self.growth_horizon = horizon
+        same_thresholds = (max_memory_active or 0) == (max_memory_idle or 0)
+        if self.collection_mode == 'lean' and not timeout and not horizon and same_thresholds:
+            # With a single memory threshold and no timeout the per-PID details
+            # from the HTML status page don't influence which workers are
+            # killed, so we don't fetch it. Note that this means all workers
+            # are reported as non-native and active.
+            candidates = [NonNativeWorker(process=p) for p in self.apache_workers]
         else:
+            candidates = self.killable_workers
+        if self.memory_accounting != 'rss':
+            # The memory maps of all candidates are read before any worker is
+            # checked against the thresholds.
+            for worker in candidates:
+                if worker.process:
+                    worker.memory_usage = self.measure_memory(worker.process)
+        timed_out = set()
+        if timeout:
+            timed_out = set(w.pid for w in self.slots.select(
+                self.slots.mode_mask(IDLE_MODES, negate=True),
+                self.slots.threshold_mask(self.slots.ss, timeout, operator.gt),
+            ))
+        projections = None
+        if horizon:
+            # This needs a few samples from earlier cycles, so it only has an
+            # effect in long running processes (e.g. the collector daemon).
+            projections = self.growth_tracker.projections(self.apache_workers, horizon)
+        victims = self.kill_scheduler.plan(
+            candidates,
+            max_memory_active=max_memory_active,
+            max_memory_idle=max_memory_idle,
+            timeout=timeout,
+            timed_out=timed_out,
+            projections=projections,
+        )
+        self.kill_results = self.kill_scheduler.execute(victims, dry_run=dry_run)
+        killed = [v for v in self.kill_results if v.is_killed]
+        for victim in killed:
+            if victim.worker.is_active:
+                self.num_killed_active += 1
+            else:
+                self.num_killed_idle += 1
+        if killed:
+            logger.info("Killed %i of %s.", len(killed), pluralize(len(candidates), "Apache worker"))
+        elif not victims:
             logger.info("No Apache workers killed (found %s within resource usage limits).",
-                        pluralize(num_checked, "worker"))
-        return list(killed)
+                        pluralize(len(candidates), "worker"))
+        return [v.worker.pid for v in killed]
+
+    def snapshot_workers(self):
+        # (pid, mode, ss, memory usage) tuples of the kill candidates, for
+        # replaying kill policies offline (see perf_moon.replay).
+        return [(worker.pid, getattr(worker, 'm', None) or '?', getattr(worker, 'ss', None),
+                 self.measure_memory(worker.process) if worker.process else None)
+                for worker in self.killable_workers]
 
+    @traced('save_metrics')
     def save_metrics(self, data_file):
         
         if data_file == '-':
             logger.debug("Reporting metrics on standard output ..")
         else:
             logger.debug("Storing metrics in %s ..", data_file)
+        self.record_metrics()
+        # The memory usage is summarized first so that the time spent
+        # scanning processes is included in the manager metrics.
+        groups = self.memory_groups
         output = ['# Global Apache server metrics.']
         for name, value in sorted(self.server_metrics.items()):
             output.append('%s\t%s' % (name.replace('_', '-'), value))
@@ -288,9 +627,7 @@ class ApacheManager(PropertyManager):
             if isinstance(value, bool):
                 value = 0 if value else 1
             output.append('%s\t%s' % (name.replace('_', '-'), value))
-        groups = dict(self.wsgi_process_groups)
-        ordered_group_names = [NATIVE_WORKERS_LABEL] + sorted(groups.keys())
-        groups[NATIVE_WORKERS_LABEL] = self.memory_usage
+        ordered_group_names = [NATIVE_WORKERS_LABEL] + sorted(self.wsgi_process_groups.keys())
         metric_names = ('count', 'min', 'max', 'average', 'median')
         for group_name in ordered_group_names:
             output.append('')
@@ -305,16 +642,27 @@ class ApacheManager(PropertyManager):
                         else getattr(groups[group_name], metric)
                     ),
                 ]))
-        if data_file == '-':
-            print('\n'.join(output))
-        else:
-            temporary_file = '%s.tmp' % data_file
-            with open(temporary_file, 'w') as handle:
-                handle.write('\n'.join(output) + '\n')
-            os.rename(temporary_file, data_file)
-
-    def refresh(self):
-        self.clear_cached_properties()
+        write_data_file(data_file, output)
+        if self.snapshot_file and self.have_worker_details:
+            from perf_moon.replay import SnapshotWriter
+            SnapshotWriter(self.snapshot_file).append(self.sample_time, self.snapshot_workers())
+        if self.activity_file and self.activity_tracker.timestamp is not None:
+            self.activity_tracker.save(self.activity_file)
+        if self.history_file:
+            from perf_moon.store import HistoryWriter, flatten_metrics
+            metrics = flatten_metrics(self.server_metrics, self.manager_metrics, groups)
+            HistoryWriter(self.history_file).append(self.sample_time, metrics)
+
+    def refresh(self, reload_config=False):
+        # Long running processes pick up changes to the Apache configuration
+        # (checking costs one stat() call per configuration file).
+        if not reload_config and 'apache_config' in self.__dict__ and self.apache_config.is_stale:
+            logger.info("Apache configuration changed, discovering status page again ..")
+            reload_config = True
+        self.trace.reset()
+        for name in self.find_properties(cached=True, resettable=True):
+            if reload_config or name not in CONFIG_PROPERTIES:
+                delattr(self, name)
 
 
 class NetworkAddress(PropertyManager):
@@ -336,6 +684,7 @@ class NetworkAddress(PropertyManager):
 
     @required_property
     def port(self):
+        pass
         
     def __str__(self):
         return self.url
@@ -345,12 +694,13 @@ class KillableWorker(PropertyManager):
 
     @required_property
     def is_active(self):
+        pass
         
     @property
     def is_alive(self):
         return self.process.is_alive if self.process else False
 
-    @lazy_property
+    @mutable_property(cached=True)
     def memory_usage(self):
         return self.process.rss if self.process else None
 
@@ -360,15 +710,18 @@ class KillableWorker(PropertyManager):
 
     @mutable_property(cached=True)
     def process(self):
+        from proc.core import Process
         return Process.from_pid(self.pid) if self.pid else None
 
     @mutable_property
     def request(self):
+        pass
         
 
 class NonNativeWorker(KillableWorker):
     @required_property
     def process(self):
+        pass
         
     @required_property
     def is_active(self):
@@ -382,6 +735,7 @@ class WorkerStatus(KillableWorker):
 
     @required_property
     def status_fields(self):
+        pass
         
     @lazy_property
     def acc(self):
@@ -450,37 +804,109 @@ class WorkerStatus(KillableWorker):
         return "native worker %i (%s)" % (self.pid, "active" if self.is_active else "idle")
 
 
-def parse_status_table(table):
-    headings = dict((i, normalize_text(coerce_tag(th))) for i, th in enumerate(table.findAll('th')))
-    logger.debug("Parsed table headings: %r", headings)
-    for tr in table.findAll('tr'):
-        values_by_index = [coerce_tag(td) for td in tr.findAll('td')]
-        logger.debug("Parsed values by index: %r", values_by_index)
-        if values_by_index:
-            try:
-                values_by_name = dict((headings[i], v) for i, v in enumerate(values_by_index))
-                logger.debug("Parsed values by name: %r", values_by_name)
-                yield values_by_name
-            except Exception:
-                pass
-
-
-def coerce_tag(tag):
-    try:
-        return u''.join(tag.findAll(text=True)).strip()
-    except Exception:
-        return ''
-
-
-def coerce_value(type, value):
-    try:
-        return type(value)
-    except Exception:
+class ScoreboardRow(WorkerStatus):
+
+    def __init__(self, scoreboard, index):
+        # Row views are created in bulk so the validation done by the
+        # PropertyManager constructor is skipped, the fields are read from
+        # the columns of the scoreboard on demand.
+        self.scoreboard = scoreboard
+        self.index = index
+
+    @lazy_property
+    def status_fields(self):
+        fields = dict((n, c[self.index]) for n, c in self.scoreboard.text_columns.items() if c[self.index] is not None)
+        for name in ('child', 'conn', 'cpu', 'm', 'pid', 'req', 'slot', 'ss'):
+            value = getattr(self, name)
+            if value is not None:
+                fields[name] = str(value)
+        fields['acc'] = '/'.join(str(n) for n in self.acc)
+        fields['srv'] = '-'.join(str(n) for n in self.srv)
+        return fields
+
+    @property
+    def acc(self):
+        sb, i = self.scoreboard, self.index
+        return tuple(integer_field(c[i]) for c in (sb.acc_connection, sb.acc_child, sb.acc_slot))
+
+    @property
+    def child(self):
+        return float_field(self.scoreboard.child[self.index])
+
+    @property
+    def client(self):
+        return self.scoreboard.text('client', self.index)
+
+    @property
+    def conn(self):
+        return float_field(self.scoreboard.conn[self.index])
+
+    @property
+    def cpu(self):
+        return float_field(self.scoreboard.cpu[self.index])
+
+    @property
+    def m(self):
+        value = self.scoreboard.modes[self.index]
+        return chr(value) if value else None
+
+    @property
+    def pid(self):
+        return integer_field(self.scoreboard.pid[self.index])
+
+    @property
+    def req(self):
+        return integer_field(self.scoreboard.req[self.index])
+
+    @property
+    def request(self):
+        value = self.scoreboard.text('request', self.index)
+        return value if value != 'NULL' else None
+
+    @property
+    def slot(self):
+        return float_field(self.scoreboard.slot[self.index])
+
+    @property
+    def srv(self):
+        sb, i = self.scoreboard, self.index
+        return (integer_field(sb.srv_child[i]), integer_field(sb.srv_generation[i]))
+
+    @property
+    def ss(self):
+        return integer_field(self.scoreboard.ss[self.index])
+
+    @property
+    def vhost(self):
+        return self.scoreboard.text('vhost', self.index)
+
+
+def integer_field(value):
+    return value if value != MISSING else None
+
+
+def float_field(value):
+    return value if value == value else None
+
+
+def open_private_file(filename):
+    # Opens a file for reading, but only when it can't have been written by
+    # other users (for files in world writable directories that influence
+    # which workers get killed). Returns None (with a warning) otherwise.
+    handle = os.fdopen(os.open(filename, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0)))
+    info = os.fstat(handle.fileno())
+    if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        handle.close()
+        logger.warning("Ignoring %s (not owned by us or writable by others)!", filename)
         return None
+    return handle
 
 
-def normalize_text(value):
-    try:
-        return re.sub('[^a-z0-9]', '', value.lower())
-    except Exception:
-        return ''
+def write_data_file(data_file, lines):
+    if data_file == '-':
+        print('\n'.join(lines))
+    else:
+        temporary_file = '%s.tmp' % data_file
+        with open(temporary_file, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        os.rename(temporary_file, data_file)
@@ -0,0 +1,229 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import itertools
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+import time
+
+from perf_moon import IDLE_MODES, open_private_file
+from perf_moon.processes import STARTTIME_FIELD
+
+# Field indexes of the user and system CPU time (in clock ticks) in /proc/[pid]/stat.
+UTIME_FIELD = 13
+
+STIME_FIELD = 14
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# The state of established connections in /proc/net/tcp.
+TCP_ESTABLISHED = '01'
+
+# Kernel functions that a worker waits in while a keep-alive connection is
+# idle (the event and worker MPMs wait in epoll, prefork in poll).
+KEEPALIVE_WCHANS = frozenset(['do_epoll_wait', 'ep_poll', 'do_poll', 'do_sys_poll', 'poll_schedule_timeout'])
+
+# The number of workers whose sockets are inspected per cycle, this bounds
+# the cost of a fallback cycle on servers with thousands of workers.
+DEFAULT_MAX_WORKERS = 1024
+
+# State saved by an earlier run is ignored when it's older than this (in
+# seconds), the busy periods in it can't be trusted anymore.
+MAX_STATE_AGE = 60 * 5
+
+STATE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityTracker(object):
+
+    # Tracks the CPU time of each worker between cycles (this only needs the
+    # /proc/[pid]/stat fields that were read by the process scan anyway). When
+    # the status page can't be fetched, the scoreboard is derived from /proc
+    # instead: CPU time deltas, the wait channel and the TCP connections of
+    # each worker. Workers are identified by PID and start time. Busy periods
+    # (SS) are taken from the status page while it's available and extended
+    # by the fallback, one-shot runs save and load the state between runs
+    # (so SS has the granularity of the interval between runs).
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, proc_root='/proc'):
+        self.max_workers = max_workers
+        self.proc_root = proc_root
+        self.cpu_times = {}
+        self.cpu_deltas = {}
+        self.busy_since = {}
+        self.timestamp = None
+
+    def observe(self, timestamp, processes):
+        cpu_times = {}
+        cpu_deltas = {}
+        for process in processes:
+            key = (process.pid, process.stat_fields[STARTTIME_FIELD])
+            ticks = int(process.stat_fields[UTIME_FIELD]) + int(process.stat_fields[STIME_FIELD])
+            cpu_times[key] = ticks
+            if key in self.cpu_times:
+                cpu_deltas[key] = (ticks - self.cpu_times[key]) / float(CLOCK_TICKS)
+        self.cpu_times = cpu_times
+        self.cpu_deltas = cpu_deltas
+        self.busy_since = dict((k, v) for k, v in self.busy_since.items() if k in cpu_times)
+        self.timestamp = timestamp
+
+    def note_scoreboard(self, slots):
+        # Takes the busy periods from a real scoreboard (the longest busy
+        # thread of each process).
+        if self.timestamp is None:
+            return
+        keys = dict((key[0], key) for key in self.cpu_times)
+        busy = {}
+        for index in itertools.compress(range(len(slots)), slots.mode_mask(IDLE_MODES, negate=True)):
+            key = keys.get(slots.pid[index])
+            if key is not None and slots.ss[index] >= 0:
+                busy[key] = max(busy.get(key, 0), slots.ss[index])
+        self.busy_since = dict((key, self.timestamp - ss) for key, ss in busy.items())
+
+    def load(self, filename):
+        try:
+            handle = open_private_file(filename)
+            if handle is None:
+                return False
+            with handle:
+                state = json.load(handle)
+            if state['version'] != STATE_VERSION:
+                return False
+            age = time.time() - state['timestamp']
+            if not 0 <= age <= MAX_STATE_AGE:
+                logger.debug("Ignoring activity state in %s (%i seconds old).", filename, age)
+                return False
+            self.cpu_times = dict(((pid, starttime), ticks) for pid, starttime, ticks in state['cpu_times'])
+            self.busy_since = dict(((pid, starttime), since) for pid, starttime, since in state['busy_since'])
+            self.timestamp = state['timestamp']
+        except Exception as e:
+            if os.path.exists(filename):
+                logger.debug("Ignoring unreadable activity state %s! (%s)", filename, e)
+            return False
+        logger.debug("Loaded activity state of %i workers from %s.", len(self.cpu_times), filename)
+        return True
+
+    def save(self, filename):
+        state = dict(
+            version=STATE_VERSION,
+            timestamp=self.timestamp,
+            cpu_times=[[pid, starttime, ticks] for (pid, starttime), ticks in self.cpu_times.items()],
+            busy_since=[[pid, starttime, since] for (pid, starttime), since in self.busy_since.items()],
+        )
+        # Written to a private temporary file that's renamed into place (see
+        # open_private_file()).
+        try:
+            fd, temporary_file = tempfile.mkstemp(prefix='.perf-moon-', dir=os.path.dirname(filename) or '.')
+            with os.fdopen(fd, 'w') as handle:
+                json.dump(state, handle)
+            os.rename(temporary_file, filename)
+        except Exception as e:
+            logger.warning("Failed to save activity state to %s! (%s)", filename, e)
+
+    def scoreboard_rows(self, processes, ports=None):
+        # Returns one row (like the rows of the HTML status page) per worker
+        # process. Modes are approximated: a worker without connections that
+        # doesn't use CPU is waiting, a connection with queued data is being
+        # read or written, a connection idling in poll is a keep-alive and
+        # anything else (e.g. blocked on a backend) counts as sending.
+        connections = read_connections(self.proc_root, ports)
+        rows = []
+        for process in processes[:self.max_workers]:
+            key = (process.pid, process.stat_fields[STARTTIME_FIELD])
+            cpu = self.cpu_deltas.get(key, 0.0)
+            sockets = [connections[i] for i in find_socket_inodes(process) if i in connections]
+            wchan = read_wchan(process)
+            if sockets:
+                if any(rx for remote, tx, rx in sockets):
+                    mode = 'R'
+                elif cpu or any(tx for remote, tx, rx in sockets):
+                    mode = 'W'
+                else:
+                    mode = 'K' if wchan in KEEPALIVE_WCHANS else 'W'
+            else:
+                mode = 'W' if cpu else '_'
+            if mode == '_':
+                self.busy_since.pop(key, None)
+                ss = 0
+            else:
+                ss = self.timestamp - self.busy_since.setdefault(key, self.timestamp)
+            rows.append(dict(
+                pid=str(process.pid),
+                m=mode,
+                ss=str(int(ss)),
+                cpu='%.2f' % cpu,
+                client=sockets[0][0] if sockets else None,
+                wchan=wchan,
+            ))
+        logger.debug("Derived %i scoreboard rows from /proc (%i connections).", len(rows), len(connections))
+        return rows
+
+
+def read_connections(proc_root='/proc', ports=None):
+    # Returns a dictionary with (remote address, transmit queue, receive
+    # queue) tuples of established TCP connections by socket inode. When
+    # ports are given only connections to those (local) ports are included.
+    connections = {}
+    for filename in ('tcp', 'tcp6'):
+        try:
+            with open(os.path.join(proc_root, 'net', filename)) as handle:
+                next(handle)
+                for line in handle:
+                    tokens = line.split()
+                    if len(tokens) < 10 or tokens[3] != TCP_ESTABLISHED:
+                        continue
+                    local_port = int(tokens[1].rpartition(':')[2], 16)
+                    if ports and local_port not in ports:
+                        continue
+                    tx_queue, _, rx_queue = tokens[4].partition(':')
+                    connections[tokens[9]] = (decode_address(tokens[2]), int(tx_queue, 16), int(rx_queue, 16))
+        except (IOError, OSError, StopIteration):
+            continue
+    return connections
+
+
+def decode_address(value):
+    # Translates e.g. "0100007F:D431" to "127.0.0.1".
+    address = value.partition(':')[0]
+    try:
+        words = struct.pack('<%iI' % (len(address) // 8),
+                            *(int(address[i:i + 8], 16) for i in range(0, len(address), 8)))
+        if len(words) == 4:
+            return socket.inet_ntoa(words)
+        return socket.inet_ntop(socket.AF_INET6, words)
+    except (ValueError, struct.error, socket.error):
+        return address
+
+
+def find_socket_inodes(process):
+    inodes = []
+    directory = os.path.join(process.proc_tree, 'fd')
+    try:
+        entries = os.listdir(directory)
+    except (IOError, OSError):
+        return inodes
+    for entry in entries:
+        try:
+            target = os.readlink(os.path.join(directory, entry))
+        except (IOError, OSError):
+            # The file descriptor was closed in the mean time.
+            continue
+        if target.startswith('socket:['):
+            inodes.append(target[8:-1])
+    return inodes
+
+
+def read_wchan(process):
+    try:
+        with open(os.path.join(process.proc_tree, 'wchan')) as handle:
+            # The wait channel is "0" while the process is running.
+            wchan = handle.read().strip()
+            return wchan if wchan and wchan != '0' else None
+    except (IOError, OSError):
+        return None
@@ -0,0 +1,485 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import collections
+import json
+import logging
+import math
+import numbers
+import signal
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from humanfriendly import format_timespan, pluralize
+from property_manager import PropertyManager, lazy_property, mutable_property, writable_property
+from six.moves import socketserver
+
+from perf_moon import NATIVE_WORKERS_LABEL, write_data_file
+from perf_moon.fleet import combine_metrics
+
+DEFAULT_ADDRESS = '127.0.0.1'
+
+DEFAULT_PORT = 9118
+
+# Hosts that stopped pushing reports are left out of the aggregates after
+# this many seconds.
+DEFAULT_EXPIRY = 60
+
+# Hosts that stopped pushing reports are forgotten (and no longer counted in
+# hosts-total) after this many times the expiry.
+RETENTION_FACTOR = 10
+
+DEFAULT_BATCH_SIZE = 10
+
+# The number of reports an agent buffers while the aggregator is unreachable
+# (the oldest reports are dropped first).
+DEFAULT_BACKLOG = 360
+
+RECONNECT_DELAY = 1
+
+MAX_RECONNECT_DELAY = 60
+
+# Frames are length prefixed, zlib compressed JSON documents.
+FRAME_HEADER = struct.Struct('>I')
+
+MAX_FRAME_SIZE = 1024 * 1024 * 16
+
+# The maximum size of a decompressed frame.
+MAX_BATCH_SIZE = 1024 * 1024 * 64
+
+# The relative error of the percentiles of the mergeable summaries.
+DEFAULT_ACCURACY = 0.01
+
+PERCENTILES = (50, 90, 99)
+
+# Manager metrics that are added up over the fleet (the other manager
+# metrics describe the agents themselves).
+SUMMED_MANAGER_METRICS = (
+    'fallback_slots',
+    'workers_hanging',
+    'workers_killed_active',
+    'workers_killed_idle',
+    'workers_recycled',
+)
+
+logger = logging.getLogger(__name__)
+
+
+class MergeableSummary(object):
+
+    # A logarithmically bucketed histogram (like DDSketch): every bucket
+    # covers values within a relative error of `accuracy`, so percentiles are
+    # accurate to that relative error and the summaries of several hosts
+    # merge exactly by adding up the bucket counts.
+
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = collections.Counter()
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else None
+
+    def add(self, value):
+        if value > 0:
+            self.buckets[int(math.ceil(math.log(value) / self.log_gamma))] += 1
+        else:
+            self.zeros += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Can't merge summaries with a different accuracy!")
+        self.buckets.update(other.buckets)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = (self.count - 1) * percent / 100.0
+        seen = self.zeros
+        if rank < seen:
+            return min(0, self.max)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # The middle of the bucket (in relative terms).
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return max(self.min, min(self.max, value))
+        return self.max
+
+    def to_dict(self):
+        return dict(
+            accuracy=self.accuracy,
+            buckets=sorted(self.buckets.items()),
+            zeros=self.zeros,
+            count=self.count,
+            total=self.total,
+            min=self.min,
+            max=self.max,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls(data['accuracy'])
+        summary.buckets.update(dict((int(i), c) for i, c in data['buckets']))
+        summary.zeros = data['zeros']
+        summary.count = data['count']
+        summary.total = data['total']
+        summary.min = data['min']
+        summary.max = data['max']
+        return summary
+
+    @classmethod
+    def from_values(cls, values, accuracy=DEFAULT_ACCURACY):
+        summary = cls(accuracy)
+        for value in values:
+            summary.add(value)
+        return summary
+
+
+class PushAgent(PropertyManager):
+
+    # Subscribes to the snapshots of the collector daemon and pushes them to
+    # an aggregator over a persistent connection. Reports are queued and
+    # sent in batches from a background thread, so a slow or unreachable
+    # aggregator never delays a collection cycle.
+
+    @mutable_property
+    def address(self):
+        return DEFAULT_ADDRESS
+
+    @mutable_property
+    def port(self):
+        return DEFAULT_PORT
+
+    @mutable_property
+    def host(self):
+        return socket.gethostname()
+
+    @mutable_property
+    def batch_size(self):
+        return DEFAULT_BATCH_SIZE
+
+    @mutable_property
+    def backlog(self):
+        return DEFAULT_BACKLOG
+
+    @writable_property
+    def connection(self):
+        return None
+
+    @writable_property
+    def num_sent(self):
+        return 0
+
+    @writable_property
+    def num_dropped(self):
+        return 0
+
+    @lazy_property
+    def reports(self):
+        return collections.deque()
+
+    @lazy_property
+    def condition(self):
+        return threading.Condition()
+
+    @lazy_property
+    def stop_event(self):
+        return threading.Event()
+
+    @lazy_property
+    def thread(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        return thread
+
+    def update(self, snapshot):
+        report = encode_report(snapshot)
+        with self.condition:
+            if len(self.reports) >= self.backlog:
+                self.reports.popleft()
+                self.num_dropped += 1
+            self.reports.append(report)
+            self.condition.notify()
+
+    def start(self):
+        self.thread.start()
+        logger.info("Pushing reports to %s:%i as %s ..", self.address, self.port, self.host)
+
+    def stop(self, timeout=5):
+        # Reports that are still queued get one chance to be sent.
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+        self.thread.join(timeout)
+        self.disconnect()
+
+    def run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            with self.condition:
+                while not self.reports and not self.stop_event.is_set():
+                    self.condition.wait()
+                batch = [self.reports.popleft() for i in range(min(self.batch_size, len(self.reports)))]
+            if not batch:
+                return
+            try:
+                self.send(batch)
+                self.num_sent += len(batch)
+                delay = RECONNECT_DELAY
+            except (socket.error, IOError) as e:
+                logger.warning("Failed to push %s to %s:%i! (%s)",
+                               pluralize(len(batch), "report"), self.address, self.port, e)
+                self.disconnect()
+                with self.condition:
+                    self.reports.extendleft(reversed(batch))
+                    while len(self.reports) > self.backlog:
+                        self.reports.popleft()
+                        self.num_dropped += 1
+                if self.stop_event.wait(delay):
+                    return
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def send(self, reports):
+        payload = encode_batch(self.host, reports)
+        if self.connection is None:
+            self.connection = socket.create_connection((self.address, self.port))
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class MetricsAggregator(PropertyManager):
+
+    # Receives reports from many agents and keeps the latest report of each
+    # host, the fleet-wide metrics are computed from those on demand.
+
+    @mutable_property
+    def address(self):
+        return DEFAULT_ADDRESS
+
+    @mutable_property
+    def port(self):
+        return DEFAULT_PORT
+
+    @mutable_property
+    def expiry(self):
+        return DEFAULT_EXPIRY
+
+    @mutable_property
+    def retention(self):
+        return self.expiry * RETENTION_FACTOR
+
+    @writable_property
+    def num_reports(self):
+        return 0
+
+    @lazy_property
+    def hosts(self):
+        return {}
+
+    @lazy_property
+    def received(self):
+        # The time each host last pushed a report according to our own clock
+        # (the clocks of the agents may be skewed).
+        return {}
+
+    @lazy_property
+    def lock(self):
+        return threading.Lock()
+
+    @lazy_property
+    def server(self):
+        server = AggregatorServer((self.address, self.port), AggregatorRequestHandler)
+        server.aggregator = self
+        return server
+
+    @lazy_property
+    def thread(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        return thread
+
+    def ingest(self, host, reports, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            for report in reports:
+                previous = self.hosts.get(host)
+                if previous is None or report['timestamp'] >= previous['timestamp']:
+                    self.hosts[host] = report
+            if reports:
+                self.received[host] = now
+            self.num_reports += len(reports)
+
+    def current_reports(self, now=None):
+        # Returns the latest report of each host that reported recently.
+        return self.select_reports(now)[0]
+
+    def select_reports(self, now=None):
+        # Returns the recent reports and the number of known hosts, hosts
+        # that have been silent for longer than the retention are forgotten.
+        now = time.time() if now is None else now
+        with self.lock:
+            for host, received in list(self.received.items()):
+                if now - received > self.retention:
+                    logger.info("Forgetting host %s (no reports for %s).", host, format_timespan(now - received))
+                    del self.hosts[host]
+                    del self.received[host]
+            reports = dict((h, self.hosts[h]) for h, t in self.received.items() if now - t <= self.expiry)
+            return reports, len(self.hosts)
+
+    def aggregate(self, now=None):
+        # Returns the fleet-wide metrics and merged memory summaries by group.
+        reports, num_hosts = self.select_reports(now)
+        aggregated = combine_metrics(r['server_metrics'] for r in reports.values())
+        memory_usage = {}
+        for report in reports.values():
+            for name in SUMMED_MANAGER_METRICS:
+                if name in report['manager_metrics']:
+                    aggregated[name] = aggregated.get(name, 0) + report['manager_metrics'][name]
+            for group_name, data in report['memory_usage'].items():
+                summary = MergeableSummary.from_dict(data)
+                if group_name in memory_usage:
+                    memory_usage[group_name].merge(summary)
+                else:
+                    memory_usage[group_name] = summary
+        aggregated['hosts_total'] = num_hosts
+        aggregated['hosts_stale'] = aggregated['hosts_total'] - len(reports)
+        aggregated['reports_received'] = self.num_reports
+        return aggregated, memory_usage
+
+    def save_metrics(self, data_file):
+        logger.debug("Storing aggregated metrics in %s ..", data_file)
+        metrics, memory_usage = self.aggregate()
+        output = ['# Aggregated Apache server metrics.']
+        for name, value in sorted(metrics.items()):
+            output.append('%s\t%s' % (name.replace('_', '-'), value))
+        for group_name in [NATIVE_WORKERS_LABEL] + sorted(n for n in memory_usage if n != NATIVE_WORKERS_LABEL):
+            summary = memory_usage.get(group_name) or MergeableSummary()
+            output.append('')
+            if group_name == NATIVE_WORKERS_LABEL:
+                output.append('# Memory usage of native Apache worker processes (all hosts).')
+            else:
+                output.append('# Memory usage of %r WSGI worker processes (all hosts).' % group_name)
+            statistics = [('count', summary.count), ('min', summary.min), ('max', summary.max),
+                          ('average', summary.average)]
+            statistics.extend(('p%i' % p, summary.percentile(p)) for p in PERCENTILES)
+            for name, value in statistics:
+                output.append('\t'.join(['memory-usage', group_name, name, str(int(round(value or 0)))]))
+        for host, report in sorted(self.current_reports().items()):
+            output.extend(['', '# Apache server metrics of %s.' % host])
+            for name, value in sorted(report['server_metrics'].items()):
+                output.append('\t'.join([host, name.replace('_', '-'), str(value)]))
+        write_data_file(data_file, output)
+
+    def run(self, data_file, interval):
+        # Serves agents until interrupted, writing the aggregated metrics to
+        # the data file every interval.
+        stop_event = threading.Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                signal.signal(signal_number, lambda *args: stop_event.set())
+            except ValueError:
+                pass
+        self.start()
+        try:
+            while not stop_event.wait(interval):
+                self.save_metrics(data_file)
+        finally:
+            self.stop()
+
+    def start(self):
+        self.thread.start()
+        logger.info("Aggregating reports from agents on %s:%i (hosts expire after %s) ..",
+                    self.server.server_address[0], self.server.server_address[1],
+                    format_timespan(self.expiry))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AggregatorServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    daemon_threads = True
+
+    allow_reuse_address = True
+
+
+class AggregatorRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # Agents keep their connection open and send one frame per batch.
+        while True:
+            header = self.rfile.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            length = FRAME_HEADER.unpack(header)[0]
+            if length > MAX_FRAME_SIZE:
+                logger.warning("Closing connection from %s (frame of %i bytes)!", self.client_address[0], length)
+                return
+            payload = self.rfile.read(length)
+            if len(payload) < length:
+                return
+            try:
+                host, reports = decode_batch(payload)
+            except Exception as e:
+                logger.warning("Closing connection from %s (invalid frame: %s)!", self.client_address[0], e)
+                return
+            self.server.aggregator.ingest(host, reports)
+
+
+def encode_report(snapshot):
+    return dict(
+        timestamp=snapshot.timestamp,
+        server_metrics=numeric_metrics(snapshot.server_metrics),
+        manager_metrics=numeric_metrics(snapshot.manager_metrics),
+        memory_usage=dict((n, MergeableSummary.from_values(v).to_dict()) for n, v in snapshot.memory_usage.items()),
+    )
+
+
+def encode_batch(host, reports):
+    document = json.dumps(dict(host=host, reports=reports), separators=(',', ':'))
+    return zlib.compress(document.encode('UTF-8'))
+
+
+def decode_batch(payload):
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, MAX_BATCH_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Batch exceeds %i bytes when decompressed" % MAX_BATCH_SIZE)
+    document = json.loads(data.decode('UTF-8'))
+    return document['host'], document['reports']
+
+
+def numeric_metrics(metrics):
+    return dict((n, int(v) if isinstance(v, bool) else v) for n, v in metrics.items()
+                if isinstance(v, numbers.Number))
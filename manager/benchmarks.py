@@ -0,0 +1,517 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import getopt
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from humanfriendly import format_size
+from six.moves import BaseHTTPServer, socketserver
+
+from perf_moon import NATIVE_WORKERS_LABEL, STATUS_COLUMNS, ApacheManager, __version__
+from perf_moon.parsers import STATUS_PARSERS, normalize_text
+from perf_moon.processes import ProcessSnapshot
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 doesn't have tracemalloc, allocations aren't reported there.
+    tracemalloc = None
+
+BENCHMARK_SIZES = (256, 4096, 16384)
+
+FIRST_PID = 1000
+
+HTML_HEADER = b"""<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html><head>
+<title>Apache Status</title>
+</head><body>
+<h1>Apache Server Status for localhost (via 127.0.0.1)</h1>
+<dl><dt>Server Version: Apache/2.4.29 (Ubuntu)</dt>
+<dt>Server MPM: prefork</dt>
+</dl><hr /><dl>
+<dt>Current Time: Thursday, 17-Oct-2026 12:00:00 UTC</dt>
+</dl>
+<table border="0"><tr><th>Srv</th><th>PID</th><th>Acc</th><th>M</th><th>CPU
+</th><th>SS</th><th>Req</th><th>Dur</th><th>Conn</th><th>Child</th><th>Slot</th><th>Client</th><th>Protocol</th><th>VHost</th><th>Request</th></tr>
+
+"""
+
+HTML_ROW = (u'<tr><td><b>%i-0</b></td><td>%i</td><td>%i/%i/%i</td><td>%s\n</td><td>%.2f</td><td>%i</td>'
+            u'<td>%i</td><td>%i</td><td>%.1f</td><td>%.2f</td><td>%.2f\n</td><td>%s</td><td>http/1.1</td>'
+            u'<td nowrap>%s</td><td nowrap>%s</td></tr>\n\n')
+
+HTML_FOOTER = b"""</table>
+ <hr /> <table>
+ <tr><th>Srv</th><td>Child Server number - generation</td></tr>
+ <tr><th>PID</th><td>OS process ID</td></tr>
+ <tr><th>Acc</th><td>Number of accesses this connection / this child / this slot</td></tr>
+ <tr><th>M</th><td>Mode of operation</td></tr>
+ </table>
+</body></html>
+"""
+
+# The time a one-shot invocation (from cron) may spend importing the command
+# line interface, in seconds.
+STARTUP_BUDGET = 0.15
+
+# Modules that only some of the modes need, importing any of them on startup
+# is a regression.
+DEFERRED_MODULES = (
+    'bs4',
+    'curses',
+    'perf_moon.aggregator',
+    'perf_moon.exporter',
+    'perf_moon.fleet',
+    'perf_moon.interactive',
+    'perf_moon.processes',
+    'perf_moon.store',
+    'perf_moon.transport',
+    'proc.core',
+)
+
+STARTUP_SCRIPT = """
+import sys, time
+started = time.time()
+import perf_moon.cli
+sys.stdout.write('%%f\\n' %% (time.time() - started))
+sys.stdout.write(' '.join(m for m in %r if m in sys.modules) + '\\n')
+""" % (DEFERRED_MODULES,)
+
+MODE_MIX = '_' * 6 + 'W' * 2 + 'K' + 'R' + 'C' + 'L' + 'G' + 'I'
+
+TEXT_STATUS = u"""localhost
+ServerVersion: Apache/2.4.29 (Ubuntu)
+ServerMPM: prefork
+ServerUptimeSeconds: 97200
+Load1: 0.52
+Load5: 0.48
+Load15: 0.40
+Total Accesses: %(total_accesses)i
+Total kBytes: %(total_kbytes)i
+Total Duration: %(total_duration)i
+CPUUser: 12.5
+CPUSystem: 3.2
+CPULoad: .0161523
+Uptime: 97200
+ReqPerSec: %(requests_per_second)f
+BytesPerSec: %(bytes_per_second)f
+BytesPerReq: %(bytes_per_request)f
+DurationPerReq: .983176
+BusyWorkers: %(busy_workers)i
+IdleWorkers: %(idle_workers)i
+Scoreboard: %(scoreboard)s
+"""
+
+REQUESTS = (
+    u'GET /server-status HTTP/1.1',
+    u'GET /api/v1/users/%i HTTP/1.1',
+    u'POST /api/v1/orders HTTP/1.1',
+    u'GET /static/app.js?v=%i HTTP/1.1',
+    u'GET /search?q=a&amp;page=%i HTTP/1.1',
+)
+
+
+def generate_html_status(num_slots, seed=42, mode_mix=MODE_MIX, threads=1):
+    # With more than one thread per process the scoreboard looks like that
+    # of the event and worker MPMs: consecutive slots share a process (PID)
+    # and server slot number.
+    rng = random.Random(seed)
+    rows = [HTML_HEADER if threads == 1 else HTML_HEADER.replace(b'prefork', b'event')]
+    for slot in range(num_slots):
+        mode = rng.choice(mode_mix)
+        request = rng.choice(REQUESTS)
+        if '%i' in request:
+            request = request % rng.randint(1, 100000)
+        rows.append((HTML_ROW % (
+            slot // threads, FIRST_PID + slot // threads, rng.randint(0, 5), rng.randint(0, 500), rng.randint(0, 5000),
+            mode, rng.random() * 10, rng.randint(0, 600), rng.randint(0, 900), rng.randint(0, 90000),
+            rng.random() * 50, rng.random() * 50, rng.random() * 500,
+            '10.0.%i.%i' % (rng.randint(0, 255), rng.randint(1, 254)),
+            'www.example.com:80', request,
+        )).encode('UTF-8'))
+    rows.append(HTML_FOOTER)
+    return b''.join(rows)
+
+
+def generate_text_status(num_slots, seed=42, mode_mix=MODE_MIX):
+    # The scoreboard matches the modes of generate_html_status() when the
+    # same seed and mode mix are used.
+    rng = random.Random(seed)
+    scoreboard = []
+    for slot in range(num_slots):
+        scoreboard.append(rng.choice(mode_mix))
+        rng.choice(REQUESTS)
+        rng.randint(1, 100000)
+    num_idle = sum(1 for m in scoreboard if m in '_I')
+    return (TEXT_STATUS % dict(
+        total_accesses=num_slots * 250,
+        total_kbytes=num_slots * 850,
+        total_duration=num_slots * 240,
+        requests_per_second=num_slots / 97200.0 * 250,
+        bytes_per_second=num_slots / 97200.0 * 850 * 1024,
+        bytes_per_request=3481.6,
+        busy_workers=sum(1 for m in scoreboard if m not in '_I.'),
+        idle_workers=num_idle,
+        scoreboard=''.join(scoreboard),
+    )).encode('UTF-8')
+
+
+class StatusServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, html_status, text_status):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StatusRequestHandler)
+        self.html_status = html_status
+        self.text_status = text_status
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://%s:%i/server-status' % self.server_address
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        self.shutdown()
+        self.server_close()
+
+
+class StatusRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep-alive connections, like Apache (and the connection pool) use.
+    protocol_version = 'HTTP/1.1'
+
+    # Send the headers and body in one write to avoid delayed ACK stalls.
+    wbufsize = -1
+
+    def do_GET(self):
+        if self.path.startswith('/server-status'):
+            body = self.server.text_status if self.path.endswith('?auto') else self.server.html_status
+            self.send_response(200)
+        else:
+            body = b'Not Found'
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeProcTree(object):
+
+    def __init__(self, num_workers, wsgi_groups=('app',), wsgi_workers=4, seed=42):
+        self.num_workers = num_workers
+        self.wsgi_groups = wsgi_groups
+        self.wsgi_workers = wsgi_workers
+        self.seed = seed
+        self.directory = None
+
+    def __enter__(self):
+        rng = random.Random(self.seed)
+        self.directory = tempfile.mkdtemp(prefix='perf-moon-proc-')
+        master_pid = FIRST_PID - 1
+        self.add_process(1, 0, '/sbin/init', ['/sbin/init'], 0, 0)
+        self.add_process(master_pid, 1, '/usr/sbin/apache2', ['/usr/sbin/apache2', '-k', 'start'], 0, 2048)
+        pid = FIRST_PID
+        for i in range(self.num_workers):
+            self.add_process(pid, master_pid, '/usr/sbin/apache2', ['/usr/sbin/apache2', '-k', 'start'],
+                             33, rng.randint(2048, 16384))
+            pid += 1
+        for group in self.wsgi_groups:
+            for i in range(self.wsgi_workers):
+                self.add_process(pid, master_pid, '/usr/sbin/apache2', ['(wsgi:%s)' % group, '-k', 'start'],
+                                 33, rng.randint(16384, 65536))
+                pid += 1
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        shutil.rmtree(self.directory)
+
+    def add_process(self, pid, ppid, exe, cmdline, uid, rss_pages):
+        directory = os.path.join(self.directory, str(pid))
+        os.mkdir(directory)
+        fields = [str(pid), '(%s)' % os.path.basename(exe), 'S', str(ppid)] + ['0'] * 48
+        fields[21] = str(pid * 10)
+        fields[22] = str(rss_pages * 4096 * 4)
+        fields[23] = str(rss_pages)
+        with open(os.path.join(directory, 'stat'), 'w') as handle:
+            handle.write(' '.join(fields) + '\n')
+        with open(os.path.join(directory, 'cmdline'), 'w') as handle:
+            handle.write('\0'.join(cmdline) + '\0')
+        with open(os.path.join(directory, 'status'), 'w') as handle:
+            handle.write('Name:\t%s\nPid:\t%i\nPPid:\t%i\nUid:\t%i\t%i\t%i\t%i\n' % (
+                os.path.basename(exe), pid, ppid, uid, uid, uid, uid,
+            ))
+        os.symlink(exe, os.path.join(directory, 'exe'))
+
+
+def measure(function, traced=False):
+    # Latency is measured on untraced runs, tracemalloc slows down the
+    # allocation heavy stages far more than the others.
+    if traced and tracemalloc:
+        tracemalloc.start()
+        try:
+            function()
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        return dict(
+            allocated_blocks=sum(s.count for s in snapshot.statistics('filename')),
+            allocated_bytes=current,
+            peak_bytes=peak,
+        )
+    start = time.time()
+    function()
+    return dict(seconds=time.time() - start)
+
+
+def benchmark_pipeline(sizes=BENCHMARK_SIZES, repeat=3, mode_mix=MODE_MIX, threads=1):
+    results = []
+    for num_slots in sizes:
+        html_status = generate_html_status(num_slots, mode_mix=mode_mix, threads=threads)
+        text_status = generate_text_status(num_slots, mode_mix=mode_mix)
+        handle, data_file = tempfile.mkstemp(prefix='perf-moon-', suffix='.txt')
+        os.close(handle)
+        num_processes = -(-num_slots // threads)
+        with StatusServer(html_status, text_status) as server, FakeProcTree(num_processes) as proc_tree:
+            manager = ApacheManager(
+                html_status_url=server.url,
+                process_snapshot=ProcessSnapshot(proc_root=proc_tree.directory),
+            )
+            stages = (
+                ('fetch_html_status', lambda: manager.html_status),
+                ('slots', lambda: manager.slots),
+                ('slot_events', lambda: manager.slot_events),
+                ('fetch_text_status', lambda: manager.text_status),
+                ('server_metrics', lambda: manager.server_metrics),
+                ('scan_processes', lambda: manager.apache_workers),
+                ('killable_workers', lambda: manager.killable_workers),
+                ('kill_workers', lambda: manager.kill_workers(max_memory_active=1024 ** 3, max_memory_idle=1024 ** 3,
+                                                              timeout=300, dry_run=True)),
+                ('save_metrics', lambda: manager.save_metrics(data_file)),
+            )
+            timings = dict((name, []) for name, function in stages)
+            for i in range(repeat):
+                manager.refresh()
+                for name, function in stages:
+                    timings[name].append(measure(function)['seconds'])
+            manager.refresh()
+            for name, function in stages:
+                stage = measure(function, traced=True)
+                stage.update(
+                    seconds=min(timings[name]),
+                    seconds_median=sorted(timings[name])[len(timings[name]) // 2],
+                )
+                results.append(dict(stage, stage=name, slots=num_slots))
+            manager.connection_pool.close()
+        if os.path.exists(data_file):
+            os.unlink(data_file)
+    return results
+
+
+def benchmark_parsers(sizes=BENCHMARK_SIZES, repeat=3):
+    required_columns = [normalize_text(c) for c in STATUS_COLUMNS]
+    results = []
+    for num_slots in sizes:
+        html = generate_html_status(num_slots)
+        timings = {}
+        for name, backend in sorted(STATUS_PARSERS.items()):
+            best = None
+            for i in range(repeat):
+                start = time.time()
+                rows = backend(html, required_columns)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if len(rows) != num_slots:
+                raise AssertionError("Parser %r returned %i rows (expected %i)!" % (name, len(rows), num_slots))
+            timings[name] = best
+        results.append((num_slots, timings))
+    return results
+
+
+def benchmark_startup(repeat=3):
+    # Imports the command line interface in fresh interpreters, returns the
+    # fastest time and the deferred modules that were imported anyway.
+    import perf_moon
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [
+        os.path.dirname(os.path.dirname(os.path.abspath(perf_moon.__file__))),
+        environment.get('PYTHONPATH'),
+    ]))
+    timings = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], env=environment)
+        seconds, _, modules = output.decode('ascii').partition('\n')
+        timings.append(float(seconds))
+    return min(timings), modules.split()
+
+
+def benchmark_aggregation(num_agents=8, num_reports=100, num_workers=64, seed=42):
+    # Pushes reports from simulated agents to an aggregator on localhost and
+    # checks that the fleet-wide totals add up. Returns the elapsed time and
+    # the number of reports received.
+    from perf_moon.aggregator import PERCENTILES, MetricsAggregator, PushAgent
+    from perf_moon.daemon import Snapshot
+    generator = random.Random(seed)
+    aggregator = MetricsAggregator(port=0)
+    aggregator.start()
+    agents = []
+    expected_workers = 0
+    expected_memory = []
+    try:
+        start = time.time()
+        for i in range(num_agents):
+            agent = PushAgent(port=aggregator.server.server_address[1], host='agent-%i' % i,
+                              backlog=num_reports)
+            agent.start()
+            agents.append(agent)
+            for j in range(num_reports):
+                memory_usage = [generator.randint(10, 200) * 1024 ** 2 for k in range(num_workers)]
+                agent.update(Snapshot(
+                    timestamp=time.time(),
+                    server_metrics=dict(busy_workers=j, idle_workers=num_workers - j % num_workers),
+                    manager_metrics=dict(workers_killed_active=1, status_fallback=False),
+                    memory_usage={NATIVE_WORKERS_LABEL: memory_usage},
+                ))
+            expected_workers += num_reports - 1
+            expected_memory.extend(memory_usage)
+        for agent in agents:
+            agent.stop()
+        while aggregator.num_reports < num_agents * num_reports and time.time() - start < 30:
+            time.sleep(0.01)
+        elapsed = time.time() - start
+        metrics, memory_usage = aggregator.aggregate()
+    finally:
+        aggregator.stop()
+    if metrics.get('busy_workers') != expected_workers or metrics.get('hosts_total') != num_agents:
+        raise AssertionError("Aggregated %r busy workers on %r hosts (expected %i on %i)!" % (
+            metrics.get('busy_workers'), metrics.get('hosts_total'), expected_workers, num_agents,
+        ))
+    summary = memory_usage[NATIVE_WORKERS_LABEL]
+    expected_memory.sort()
+    for percent in PERCENTILES:
+        exact = expected_memory[int((len(expected_memory) - 1) * percent / 100.0)]
+        if abs(summary.percentile(percent) - exact) > exact * summary.accuracy * 2:
+            raise AssertionError("Aggregated p%i of %i is off (expected %i)!" % (
+                percent, summary.percentile(percent), exact,
+            ))
+    return elapsed, aggregator.num_reports
+
+
+def compare_results(baseline, current):
+    # Yields (stage, slots, baseline seconds, current seconds) tuples.
+    previous = dict(((r['stage'], r['slots']), r) for r in baseline['results'])
+    for result in current['results']:
+        before = previous.get((result['stage'], result['slots']))
+        if before:
+            yield result['stage'], result['slots'], before['seconds'], result['seconds']
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    sizes = BENCHMARK_SIZES
+    repeat = 3
+    mode_mix = MODE_MIX
+    output_file = None
+    baseline_file = None
+    parsers_only = False
+    startup_only = False
+    num_agents = None
+    threads = 1
+    options, arguments = getopt.getopt(sys.argv[1:], 's:r:m:T:o:c:pSA:', [
+        'sizes=', 'repeat=', 'modes=', 'threads=', 'output=', 'compare=', 'parsers', 'startup', 'agents=',
+    ])
+    for option, value in options:
+        if option in ('-s', '--sizes'):
+            sizes = [int(n) for n in value.split(',')]
+        elif option in ('-r', '--repeat'):
+            repeat = int(value)
+        elif option in ('-m', '--modes'):
+            mode_mix = value
+        elif option in ('-T', '--threads'):
+            threads = int(value)
+        elif option in ('-o', '--output'):
+            output_file = value
+        elif option in ('-c', '--compare'):
+            baseline_file = value
+        elif option in ('-p', '--parsers'):
+            parsers_only = True
+        elif option in ('-S', '--startup'):
+            startup_only = True
+        elif option in ('-A', '--agents'):
+            num_agents = int(value)
+    if num_agents:
+        seconds, num_reports = benchmark_aggregation(num_agents)
+        sys.stdout.write("Aggregated %i reports from %i agents in %.4fs (%.0f reports/s).\n" % (
+            num_reports, num_agents, seconds, num_reports / max(seconds, 1e-9),
+        ))
+        return
+    if startup_only:
+        seconds, modules = benchmark_startup(repeat)
+        sys.stdout.write("Imported perf_moon.cli in %.4fs (budget %.4fs).\n" % (seconds, STARTUP_BUDGET))
+        if modules:
+            sys.stdout.write("Imported on startup: %s\n" % ', '.join(modules))
+        # Exits nonzero so that this can be used as a check in CI.
+        sys.exit(1 if seconds > STARTUP_BUDGET or modules else 0)
+    if parsers_only:
+        for num_slots, timings in benchmark_parsers(sizes, repeat):
+            speedup = timings['beautifulsoup'] / max(timings['streaming'], 1e-9)
+            sys.stdout.write("%6i slots: %s (%.1fx speedup)\n" % (num_slots, ', '.join(
+                '%s %.4fs' % (name, seconds) for name, seconds in sorted(timings.items())
+            ), speedup))
+        return
+    report = dict(
+        version=__version__,
+        python=platform.python_version(),
+        timestamp=time.time(),
+        mode_mix=mode_mix,
+        threads=threads,
+        results=benchmark_pipeline(sizes, repeat, mode_mix, threads),
+    )
+    if resource:
+        # ru_maxrss is reported in kilobytes on Linux.
+        report['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    for result in report['results']:
+        sys.stderr.write("%6i slots %-18s %.4fs%s\n" % (
+            result['slots'], result['stage'], result['seconds'],
+            (" (peak %s)" % format_size(result['peak_bytes'])) if 'peak_bytes' in result else '',
+        ))
+    if baseline_file:
+        with open(baseline_file) as handle:
+            baseline = json.load(handle)
+        for stage, num_slots, before, after in compare_results(baseline, report):
+            sys.stderr.write("%6i slots %-18s %.4fs -> %.4fs (%+.1f%%)\n" % (
+                num_slots, stage, before, after, (after - before) / max(before, 1e-9) * 100,
+            ))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if output_file:
+        with open(output_file, 'w') as handle:
+            handle.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import getopt
 import json
 import logging
 import sys
+import time
 
 import coloredlogs
 from humanfriendly import (
@@ -18,28 +19,61 @@ from humanfriendly.terminal import (
     usage,
 )
 
-from perf_moon import ApacheManager, NATIVE_WORKERS_LABEL
-from perf_moon.interactive import watch_metrics
+from perf_moon import (
+    DEFAULT_ACCOUNTING,
+    DEFAULT_ACTIVITY_FILE,
+    MEMORY_ACCOUNTING_MODES,
+    NATIVE_WORKERS_LABEL,
+    ApacheManager,
+)
+from perf_moon.daemon import DEFAULT_INTERVAL
 
 logger = logging.getLogger(__name__)
 
 
 def main():
-    coloredlogs.install(syslog=True)
+    # The modules needed by only some of the modes (the fleet, the daemon,
+    # the exporter, the aggregator, watch mode and the history file) are
+    # imported on demand, cron runs every minute on many hosts so startup
+    # time matters.
     data_file = '/tmp/perf-moon.txt'
+    history_file = None
+    snapshot_file = None
+    query_period = None
+    query_metrics = None
     dry_run = False
+    collection_mode = 'full'
+    memory_accounting = DEFAULT_ACCOUNTING
+    connection_options = {}
+    kill_scheduler_options = {}
+    fleet_targets = []
+    all_targets = False
+    daemon = False
+    interval = DEFAULT_INTERVAL
+    adaptive = False
+    scheduler_options = {}
+    exporter_address = None
+    push_address = None
+    aggregator_address = None
     max_memory_active = None
     max_memory_idle = None
     max_ss = None
+    growth_horizon = None
     watch = False
     zabbix_discovery = False
+    status_fallback = True
+    profile = False
     verbosity = 0
 
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'wa:i:t:f:znvqh', [
+        options, arguments = getopt.getopt(sys.argv[1:], 'wa:i:t:f:zldnvqh', [
             'watch', 'max-memory-active=', 'max-memory-idle=', 'max-ss=',
-            'max-time=', 'data-file=', 'zabbix-discovery', 'dry-run',
-            'simulate', 'verbose', 'quiet', 'help',
+            'max-time=', 'max-kills=', 'grace-period=', 'growth-horizon=',
+            'memory-accounting=', 'data-file=', 'history-file=', 'snapshot-file=', 'query=',
+            'metrics=', 'zabbix-discovery', 'lean', 'no-fallback',
+            'connect-timeout=', 'read-timeout=', 'target=', 'all-targets',
+            'daemon', 'interval=', 'adaptive', 'cpu-budget=', 'exporter=', 'push=', 'aggregate=',
+            'profile', 'dry-run', 'simulate', 'verbose', 'quiet', 'help',
         ])
         for option, value in options:
             if option in ('-w', '--watch'):
@@ -50,54 +84,283 @@ def main():
                 max_memory_idle = parse_size(value)
             elif option in ('-t', '--max-ss', '--max-time'):
                 max_ss = parse_timespan(value)
+            elif option == '--growth-horizon':
+                growth_horizon = parse_timespan(value)
+            elif option == '--max-kills':
+                kill_scheduler_options['max_kills'] = int(value)
+            elif option == '--grace-period':
+                kill_scheduler_options['grace_period'] = parse_timespan(value)
+            elif option == '--memory-accounting':
+                if value not in MEMORY_ACCOUNTING_MODES:
+                    raise ValueError("Invalid memory accounting mode %r (expected one of %s)" % (
+                        value, ', '.join(MEMORY_ACCOUNTING_MODES),
+                    ))
+                memory_accounting = value
             elif option in ('-f', '--data-file'):
                 data_file = value
+            elif option == '--history-file':
+                history_file = value
+            elif option == '--snapshot-file':
+                snapshot_file = value
+            elif option == '--query':
+                query_period = parse_timespan(value)
+            elif option == '--metrics':
+                query_metrics = [n.strip().replace('-', '_') for n in value.split(',')]
             elif option in ('-z', '--zabbix-discovery'):
                 zabbix_discovery = True
+            elif option in ('-l', '--lean'):
+                collection_mode = 'lean'
+            elif option == '--connect-timeout':
+                connection_options['connect_timeout'] = parse_timespan(value)
+            elif option == '--read-timeout':
+                connection_options['read_timeout'] = parse_timespan(value)
+            elif option == '--target':
+                fleet_targets.append(value)
+            elif option == '--all-targets':
+                all_targets = True
+            elif option in ('-d', '--daemon'):
+                daemon = True
+            elif option == '--interval':
+                interval = parse_timespan(value)
+            elif option == '--adaptive':
+                adaptive = True
+            elif option == '--cpu-budget':
+                scheduler_options['cpu_budget'] = float(value.rstrip('%')) / 100
+            elif option == '--exporter':
+                # The exporter serves the snapshots of the collector daemon.
+                address, _, port = value.rpartition(':')
+                exporter_address = (address, int(port))
+                daemon = True
+            elif option == '--push':
+                # Agents push the snapshots of the collector daemon.
+                address, _, port = value.rpartition(':')
+                push_address = (address, int(port))
+                daemon = True
+            elif option == '--aggregate':
+                address, _, port = value.rpartition(':')
+                aggregator_address = (address, int(port))
+            elif option == '--no-fallback':
+                status_fallback = False
+            elif option == '--profile':
+                profile = True
             elif option in ('-n', '--dry-run', '--simulate'):
-                logger.info("Performing a dry run ..")
                 dry_run = True
             elif option in ('-v', '--verbose'):
-                coloredlogs.increase_verbosity()
                 verbosity += 1
             elif option in ('-q', '--quiet'):
-                coloredlogs.decrease_verbosity()
                 verbosity -= 1
             elif option in ('-h', '--help'):
                 usage(__doc__)
                 return
+        if growth_horizon and not daemon:
+            # Projections need the memory usage of earlier cycles, which
+            # only a long running process has.
+            raise ValueError("--growth-horizon requires --daemon")
+        if growth_horizon and not (max_memory_active or max_memory_idle):
+            raise ValueError("--growth-horizon requires --max-memory-active or --max-memory-idle")
     except Exception as e:
         sys.stderr.write("Error: %s!\n" % e)
         sys.exit(1)
+    killing = bool(max_memory_active or max_memory_idle or max_ss or growth_horizon)
+    # Actions taken by perf-moon (killing workers) are logged to the system
+    # log, connecting to it isn't worth it for reporting metrics.
+    coloredlogs.install(syslog=daemon or killing)
+    for i in range(abs(verbosity)):
+        if verbosity > 0:
+            coloredlogs.increase_verbosity()
+        else:
+            coloredlogs.decrease_verbosity()
+    if dry_run:
+        logger.info("Performing a dry run ..")
+    if collection_mode == 'lean':
+        logger.info("Lean mode: workers-hanging and workers-recycled are only reported when"
+                    " per-PID details are needed (e.g. for --max-ss).")
     # Execute the requested action(s).
-    manager = ApacheManager()
-    try:
-        if max_memory_active or max_memory_idle or max_ss:
-            manager.kill_workers(
+    if query_period:
+        from perf_moon.store import DEFAULT_HISTORY_FILE
+        for line in report_history(history_file or DEFAULT_HISTORY_FILE, query_period, query_metrics):
+            print(line)
+        return
+    if aggregator_address:
+        from perf_moon.aggregator import MetricsAggregator
+        aggregator = MetricsAggregator(port=aggregator_address[1])
+        if aggregator_address[0]:
+            aggregator.address = aggregator_address[0]
+        aggregator.run(data_file, interval)
+        return
+    if fleet_targets or all_targets:
+        from perf_moon.fleet import ApacheFleet
+        from perf_moon.transport import ConnectionPool
+        fleet = ApacheFleet(connection_pool=ConnectionPool(**connection_options))
+        if fleet_targets:
+            fleet.targets = fleet_targets
+        if data_file != '-' and verbosity >= 0:
+            for line in report_fleet_metrics(fleet):
+                if line_is_heading(line):
+                    line = ansi_wrap(line, color=HIGHLIGHT_COLOR)
+                print(line)
+        if data_file == '-' or not dry_run:
+            fleet.save_metrics(data_file)
+        return
+    manager = ApacheManager(
+        collection_mode=collection_mode,
+        memory_accounting=memory_accounting,
+        history_file=history_file,
+        snapshot_file=snapshot_file,
+        status_fallback=status_fallback,
+        growth_horizon=growth_horizon,
+    )
+    if status_fallback and not (daemon or watch):
+        # Lets the /proc fallback of the next run derive SS.
+        manager.activity_file = DEFAULT_ACTIVITY_FILE
+    if connection_options:
+        from perf_moon.transport import ConnectionPool
+        manager.connection_pool = ConnectionPool(**connection_options)
+    if kill_scheduler_options:
+        from perf_moon.killer import KillScheduler
+        manager.kill_scheduler = KillScheduler(**kill_scheduler_options)
+    if daemon:
+        from perf_moon.daemon import CollectorDaemon
+        kill_options = {}
+        if killing:
+            kill_options = dict(
                 max_memory_active=max_memory_active,
                 max_memory_idle=max_memory_idle,
                 timeout=max_ss,
+                horizon=growth_horizon,
                 dry_run=dry_run,
             )
-        elif watch and connected_to_terminal(sys.stdout):
-            watch_metrics(manager)
-        elif zabbix_discovery:
-            report_zabbix_discovery(manager)
-        elif data_file != '-' and verbosity >= 0:
-            for line in report_metrics(manager):
-                if line_is_heading(line):
-                    line = ansi_wrap(line, color=HIGHLIGHT_COLOR)
-                print(line)
-    finally:
-        if (not watch) and (data_file == '-' or not dry_run):
-            manager.save_metrics(data_file)
+        collector = CollectorDaemon(
+            manager=manager,
+            interval=interval,
+            data_file=data_file if (data_file == '-' or not dry_run) else None,
+            kill_options=kill_options,
+        )
+        if adaptive:
+            from perf_moon.scheduler import AdaptiveScheduler
+            # The configured interval becomes the slowest polling rate.
+            collector.scheduler = AdaptiveScheduler(max_interval=interval, **scheduler_options)
+        exporter = None
+        if exporter_address:
+            from perf_moon.exporter import MetricsExporter
+            exporter = MetricsExporter(port=exporter_address[1])
+            if exporter_address[0]:
+                exporter.address = exporter_address[0]
+            collector.subscribe(exporter.update)
+            exporter.start()
+        agent = None
+        if push_address:
+            from perf_moon.aggregator import PushAgent
+            agent = PushAgent(port=push_address[1])
+            if push_address[0]:
+                agent.address = push_address[0]
+            collector.subscribe(agent.update)
+            agent.start()
+        try:
+            collector.run()
+        finally:
+            if exporter:
+                exporter.stop()
+            if agent:
+                agent.stop()
+        return
+    if not watch and data_file != '-':
+        manager.history.load_data_file(data_file)
+
+    def run_cycle():
+        try:
+            if killing:
+                manager.kill_workers(
+                    max_memory_active=max_memory_active,
+                    max_memory_idle=max_memory_idle,
+                    timeout=max_ss,
+                    horizon=growth_horizon,
+                    dry_run=dry_run,
+                )
+            elif watch and connected_to_terminal(sys.stdout):
+                from perf_moon.interactive import watch_metrics
+                from perf_moon.scheduler import AdaptiveScheduler
+                watch_metrics(manager, AdaptiveScheduler(**scheduler_options))
+            elif zabbix_discovery:
+                report_zabbix_discovery(manager)
+            elif data_file != '-' and verbosity >= 0:
+                for line in report_metrics(manager):
+                    if line_is_heading(line):
+                        line = ansi_wrap(line, color=HIGHLIGHT_COLOR)
+                    print(line)
+        finally:
+            if (not watch) and (data_file == '-' or not dry_run):
+                manager.save_metrics(data_file)
+
+    if profile and not watch:
+        # Profiles a single cycle, followed by the time spent per stage.
+        from perf_moon.tracing import profile_cycle
+        try:
+            profile_cycle(run_cycle)
+        finally:
+            for name, value in sorted(manager.trace.metrics().items()):
+                sys.stderr.write("%s\t%s\n" % (name.replace('_', '-'), value))
+    else:
+        run_cycle()
 
 
 def report_metrics(manager):
     lines = ["Server metrics:"]
-    for name, value in sorted(manager.server_metrics.items()):
-        if name in ('total_traffic', 'bytes_per_second', 'bytes_per_request'):
+    report_server_metrics(lines, manager.server_metrics)
+    manager.record_metrics()
+    current_metrics = manager.history.current_metrics()
+    if current_metrics:
+        lines.extend(["", "Current throughput:"])
+        report_server_metrics(lines, current_metrics)
+    if manager.have_worker_details:
+        report_request_hotspots(lines, manager)
+    main_label = "main Apache workers" if manager.wsgi_process_groups else "Apache workers"
+    report_memory_usage(lines, main_label, manager.memory_usage)
+    for name, memory_usage in sorted(manager.wsgi_process_groups.items()):
+        report_memory_usage(lines, "WSGI process group '%s'" % name, memory_usage)
+    return lines
+
+
+def report_history(history_file, period, names=None):
+    from perf_moon.store import query_history
+    end = time.time()
+    series = query_history(history_file, end - period, end, names)
+    lines = ["Metrics of the last %s (%s):" % (format_timespan(period), history_file)]
+    for name, samples in sorted(series.items()):
+        if samples:
+            values = [v for t, v in samples]
+            lines.append(" - %s: last %s, min %s, average %s, max %s (%s)" % (
+                name, format_number(values[-1]), format_number(min(values)),
+                format_number(sum(values) / len(values)), format_number(max(values)),
+                pluralize(len(values), "sample"),
+            ))
+    if len(lines) == 1:
+        lines.append(" - No samples found.")
+    return lines
+
+
+def format_number(value):
+    return '%i' % value if value == int(value) else '%.2f' % value
+
+
+def report_fleet_metrics(fleet):
+    lines = ["Aggregated server metrics:"]
+    report_server_metrics(lines, fleet.aggregated_metrics)
+    for url, metrics in sorted(fleet.server_metrics.items()):
+        lines.extend(["", "Server metrics of %s:" % url])
+        report_server_metrics(lines, metrics)
+    if fleet.failed_targets:
+        lines.extend(["", "Failed targets:"])
+        lines.extend(" - %s" % url for url in fleet.failed_targets)
+    return lines
+
+
+def report_server_metrics(lines, metrics):
+    for name, value in sorted(metrics.items()):
+        if name in ('total_traffic', 'bytes_per_request') or name.startswith('bytes_per_second'):
             value = format_size(value)
+        elif name.startswith('requests_per_second'):
+            value = '%.2f' % value
         elif name == 'cpu_load':
             value = '%.1f%%' % value
         elif name == 'uptime':
@@ -105,11 +368,20 @@ def report_metrics(manager):
         name = ' '.join(name.split('_'))
         name = name[0].upper() + name[1:]
         lines.append(" - %s: %s" % (name, value))
-    main_label = "main Apache workers" if manager.wsgi_process_groups else "Apache workers"
-    report_memory_usage(lines, main_label, manager.memory_usage)
-    for name, memory_usage in sorted(manager.wsgi_process_groups.items()):
-        report_memory_usage(lines, "WSGI process group '%s'" % name, memory_usage)
-    return lines
+
+
+def report_request_hotspots(lines, manager, count=5):
+    if manager.request_hotspots:
+        lines.extend(["", "Request hot spots:"])
+        for group in manager.request_hotspots[:count]:
+            lines.append(" - %s %s: %s, %s max SS, %.2f CPU" % (
+                group.vhost or 'unknown vhost', group.route or 'unknown request',
+                pluralize(group.count, "worker"), format_timespan(group.ss_max), group.cpu,
+            ))
+    if len(manager.history) > 1 and manager.heavy_hitters:
+        lines.extend(["", "Busiest requests (worker slots over %s):" % pluralize(len(manager.history), "sample")])
+        for (vhost, route), value, error in manager.heavy_hitters.top(count):
+            lines.append(" - %s %s: %i" % (vhost or 'unknown vhost', route or 'unknown request', value))
 
 
 def report_memory_usage(lines, label, memory_usage):
@@ -0,0 +1,283 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import glob
+import json
+import logging
+import os
+import re
+import tempfile
+
+from perf_moon.exceptions import AddressDiscoveryError
+
+APACHE_CONFIG = '/etc/apache2/apache2.conf'
+
+# The results of discovery are cached in this file (keyed by the main
+# configuration file) together with the modification times and inode numbers
+# of the files and directories that were read.
+DEFAULT_CACHE_FILE = '/tmp/perf-moon.config-cache'
+
+CACHE_VERSION = 1
+
+STATUS_HANDLER = 'server-status'
+
+DEFAULT_STATUS_PATH = '/server-status'
+
+# Include directives nested deeper than this are assumed to be a loop.
+MAX_INCLUDE_DEPTH = 32
+
+TOKEN_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+VARIABLE_PATTERN = re.compile(r'\$\{(\w+)\}')
+
+LISTEN_PATTERN = re.compile(r'^(.+):(\d+)$')
+
+# Modules that are usually compiled into Apache (so there's no LoadModule).
+STATIC_MODULES = frozenset([
+    'core_module', 'core.c', 'http_module', 'http_core.c', 'log_config_module', 'mod_log_config.c',
+    'logio_module', 'mod_logio.c', 'so_module', 'mod_so.c', 'unixd_module', 'mod_unixd.c',
+    'version_module', 'mod_version.c', 'watchdog_module', 'mod_watchdog.c',
+])
+
+# Listen addresses that mean "all interfaces", the status page is fetched
+# through the loopback interface instead.
+WILDCARD_ADDRESSES = ('0.0.0.0', '*', '[::]')
+
+logger = logging.getLogger(__name__)
+
+
+class ApacheConfig(object):
+
+    def __init__(self, filename, server_root=None):
+        self.filename = os.path.abspath(filename)
+        self.server_root = server_root or os.path.dirname(self.filename)
+        # (address, port, protocol) tuples in the order of the configuration.
+        self.listen = []
+        # (path, port) tuples, the port is None outside of virtual hosts.
+        self.status_locations = []
+        self.modules = set()
+        self.stamps = []
+
+    @classmethod
+    def from_dict(cls, data):
+        config = cls(data['filename'], data['server_root'])
+        config.listen = [tuple(value) for value in data['listen']]
+        config.status_locations = [tuple(value) for value in data['status_locations']]
+        config.modules = set(data['modules'])
+        config.stamps = [tuple(value) for value in data['stamps']]
+        return config
+
+    def to_dict(self):
+        return dict(
+            filename=self.filename,
+            server_root=self.server_root,
+            listen=self.listen,
+            status_locations=self.status_locations,
+            modules=sorted(self.modules),
+            stamps=self.stamps,
+        )
+
+    @property
+    def is_stale(self):
+        # True when one of the files or directories that were read changed
+        # (including files that didn't exist and now do).
+        return any(stamp_path(path) != [path, mtime, inode] for path, mtime, inode in self.stamps)
+
+    def parse(self):
+        if not os.path.isfile(self.filename):
+            raise AddressDiscoveryError("Apache configuration file %s doesn't exist!" % self.filename)
+        logger.debug("Parsing Apache configuration %s ..", self.filename)
+        self.parse_file(self.filename, [], 0)
+        logger.debug("Parsed %i configuration files, found %i listen directive(s) and %i status location(s).",
+                     sum(1 for path, mtime, inode in self.stamps if os.path.isfile(path)),
+                     len(self.listen), len(self.status_locations))
+        return self
+
+    def parse_file(self, filename, sections, depth):
+        if depth > MAX_INCLUDE_DEPTH:
+            logger.warning("Ignoring %s (includes nested more than %i levels deep).", filename, MAX_INCLUDE_DEPTH)
+            return
+        self.stamps.append(tuple(stamp_path(filename)))
+        try:
+            with open(filename) as handle:
+                lines = list(join_continuations(handle))
+        except (IOError, OSError) as e:
+            logger.warning("Failed to read Apache configuration file %s! (%s)", filename, e)
+            return
+        for lnum, line in lines:
+            tokens = tokenize(line)
+            if not tokens:
+                continue
+            directive = tokens[0].lower()
+            if directive.startswith('</'):
+                if sections and sections[-1][0] == directive[2:].rstrip('>'):
+                    sections.pop()
+                else:
+                    logger.debug("Ignoring unbalanced %s on line %i of %s.", tokens[0], lnum, filename)
+            elif directive.startswith('<'):
+                name = directive[1:].rstrip('>')
+                argument = ' '.join(tokens[1:]).rstrip('>').strip()
+                sections.append((name, argument, self.evaluate_section(name, argument)))
+            elif all(active for name, argument, active in sections):
+                self.parse_directive(directive, tokens[1:], sections, filename, lnum, depth)
+
+    def evaluate_section(self, name, argument):
+        if name == 'ifmodule':
+            negate = argument.startswith('!')
+            module = argument.lstrip('!')
+            # When the configuration doesn't load any modules (e.g. because
+            # only ports.conf is parsed) every section counts as enabled.
+            loaded = module in self.modules or module in STATIC_MODULES if self.modules else not negate
+            return loaded != negate
+        return True
+
+    def parse_directive(self, directive, arguments, sections, filename, lnum, depth):
+        if directive == 'serverroot' and arguments:
+            self.server_root = arguments[0]
+        elif directive == 'loadmodule' and len(arguments) >= 2:
+            # <IfModule> accepts the module identifier or the source file.
+            self.modules.add(arguments[0])
+            self.modules.add('%s.c' % os.path.splitext(os.path.basename(arguments[1]))[0])
+        elif directive in ('include', 'includeoptional') and arguments:
+            self.include(arguments[0], directive == 'includeoptional', sections, filename, depth)
+        elif directive == 'listen' and arguments:
+            parsed_value = parse_listen(arguments)
+            if parsed_value:
+                logger.debug("Parsed listen directive on line %i of %s: %s", lnum, filename, parsed_value)
+                self.listen.append(parsed_value)
+            else:
+                logger.warning("Failed to parse listen directive on line %i of %s: %s",
+                               lnum, filename, ' '.join(arguments))
+        elif directive == 'sethandler' and arguments and arguments[0].lower() == STATUS_HANDLER:
+            location = self.find_location(sections)
+            if location:
+                logger.debug("Found status handler on line %i of %s: %s", lnum, filename, location)
+                self.status_locations.append(location)
+
+    def find_location(self, sections):
+        path = None
+        port = None
+        for name, argument, active in sections:
+            if name == 'location':
+                path = argument.strip('"')
+            elif name == 'virtualhost':
+                ports = [parse_listen([a])[1] for a in argument.split() if LISTEN_PATTERN.match(a)]
+                port = ports[0] if ports else None
+        return (path, port) if path else None
+
+    def include(self, pattern, optional, sections, filename, depth):
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(self.server_root, pattern)
+        # The directory is stamped so that files added to it invalidate the cache.
+        directory = pattern if os.path.isdir(pattern) else os.path.dirname(pattern)
+        self.stamps.append(tuple(stamp_path(directory)))
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, n) for n in os.listdir(pattern)]
+        else:
+            matches = glob.glob(pattern)
+        if not matches and not optional and not glob.has_magic(pattern):
+            logger.warning("Included file %s (from %s) doesn't exist!", pattern, filename)
+        for path in sorted(matches):
+            if os.path.isfile(path):
+                self.parse_file(path, sections, depth + 1)
+            elif os.path.isdir(path):
+                self.include(path, optional, sections, filename, depth + 1)
+
+
+def discover_config(filename=APACHE_CONFIG, cache_file=DEFAULT_CACHE_FILE):
+    # Returns an ApacheConfig object, from the cache file when none of the
+    # configuration files changed since they were parsed.
+    filename = os.path.abspath(filename)
+    cache = load_cache(cache_file) if cache_file else {}
+    if filename in cache:
+        config = ApacheConfig.from_dict(cache[filename])
+        if not config.is_stale:
+            logger.debug("Using cached Apache configuration of %s.", filename)
+            return config
+    config = ApacheConfig(filename).parse()
+    if cache_file:
+        cache[filename] = config.to_dict()
+        save_cache(cache_file, cache)
+    return config
+
+
+def load_cache(cache_file):
+    # The cache decides which status page is fetched (and so which workers
+    # get killed), so it's only trusted when it can't have been written by
+    # other users (it lives in a world writable directory by default).
+    from perf_moon import open_private_file
+    try:
+        handle = open_private_file(cache_file)
+        if handle is None:
+            return {}
+        with handle:
+            data = json.load(handle)
+        if data.get('version') == CACHE_VERSION:
+            return data['entries']
+    except Exception as e:
+        if os.path.exists(cache_file):
+            logger.debug("Ignoring unreadable configuration cache %s! (%s)", cache_file, e)
+    return {}
+
+
+def save_cache(cache_file, entries):
+    # The cache is replaced atomically because cron runs and the collector
+    # daemon can update it concurrently.
+    try:
+        fd, temporary_file = tempfile.mkstemp(prefix='.perf-moon-', dir=os.path.dirname(cache_file) or '.')
+        with os.fdopen(fd, 'w') as handle:
+            json.dump(dict(version=CACHE_VERSION, entries=entries), handle)
+        os.rename(temporary_file, cache_file)
+    except Exception as e:
+        logger.debug("Failed to update configuration cache %s! (%s)", cache_file, e)
+
+
+def stamp_path(path):
+    try:
+        stat = os.stat(path)
+        return [path, stat.st_mtime, stat.st_ino]
+    except OSError:
+        return [path, None, None]
+
+
+def join_continuations(lines):
+    # Yields (line number, line) tuples with comments removed and lines
+    # ending in a backslash joined to the next line.
+    buffer = []
+    start = None
+    for lnum, line in enumerate(lines, start=1):
+        line = line.strip()
+        if start is None:
+            if not line or line.startswith('#'):
+                continue
+            start = lnum
+        if line.endswith('\\'):
+            buffer.append(line[:-1])
+            continue
+        buffer.append(line)
+        yield start, ' '.join(buffer)
+        buffer = []
+        start = None
+    if buffer:
+        yield start, ' '.join(buffer)
+
+
+def tokenize(line):
+    line = VARIABLE_PATTERN.sub(lambda m: os.environ.get(m.group(1), m.group(0)), line)
+    return [m.group(1) if m.group(1) is not None else m.group(2) for m in TOKEN_PATTERN.finditer(line)]
+
+
+def parse_listen(arguments):
+    # Translates e.g. "Listen 127.0.0.1:8080 http" to ('127.0.0.1', 8080, 'http').
+    address = '127.0.0.1'
+    if arguments[0].isdigit():
+        port = int(arguments[0])
+    else:
+        match = LISTEN_PATTERN.match(arguments[0])
+        if not match:
+            return None
+        port = int(match.group(2))
+        if match.group(1) not in WILDCARD_ADDRESSES:
+            address = match.group(1)
+    protocol = arguments[1] if len(arguments) >= 2 else None
+    return (address, port, protocol)
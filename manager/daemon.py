@@ -0,0 +1,157 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import logging
+import signal
+import threading
+import time
+
+from humanfriendly import Timer, format_timespan
+from property_manager import PropertyManager, lazy_property, mutable_property, required_property
+
+from perf_moon import NATIVE_WORKERS_LABEL
+
+DEFAULT_INTERVAL = 10
+
+logger = logging.getLogger(__name__)
+
+
+class CollectorDaemon(PropertyManager):
+
+    @required_property
+    def manager(self):
+        pass
+
+    @mutable_property
+    def interval(self):
+        return DEFAULT_INTERVAL
+
+    @mutable_property
+    def data_file(self):
+        return None
+
+    @mutable_property
+    def kill_options(self):
+        return {}
+
+    @mutable_property
+    def scheduler(self):
+        # An AdaptiveScheduler replaces the fixed interval.
+        return None
+
+    @mutable_property
+    def snapshot(self):
+        return None
+
+    @lazy_property
+    def stop_event(self):
+        return threading.Event()
+
+    @lazy_property
+    def subscribers(self):
+        return []
+
+    def run(self, max_ticks=None):
+        if self.scheduler:
+            logger.info("Collecting Apache metrics every %s to %s (depending on load) ..",
+                        format_timespan(self.scheduler.min_interval),
+                        format_timespan(self.scheduler.max_interval))
+        else:
+            logger.info("Collecting Apache metrics every %s ..", format_timespan(self.interval))
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                signal.signal(signal_number, lambda *args: self.stop())
+            except ValueError:
+                # Signal handlers can only be installed from the main thread.
+                pass
+        num_ticks = 0
+        next_tick = time.time()
+        while not self.stop_event.is_set():
+            started = self.scheduler.start_sample() if self.scheduler else None
+            self.tick()
+            num_ticks += 1
+            if max_ticks and num_ticks >= max_ticks:
+                break
+            # Ticks are scheduled relative to the start of the daemon so that
+            # the interval doesn't drift by the time spent collecting. When a
+            # tick takes longer than the interval the missed ticks are skipped.
+            if self.scheduler:
+                next_tick += self.scheduler.finish_sample(time.time(), started, self.manager)
+            else:
+                next_tick += self.interval
+            now = time.time()
+            if next_tick < now:
+                next_tick = now
+            self.stop_event.wait(next_tick - now)
+        logger.info("Stopped collecting Apache metrics.")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def tick(self):
+        timer = Timer()
+        # Only the time-varying properties are invalidated, the configuration
+        # derived state (listen addresses, status page URLs) stays warm.
+        self.manager.refresh()
+        if self.kill_options:
+            try:
+                self.manager.kill_workers(**self.kill_options)
+            except Exception as e:
+                logger.warning("Failed to kill Apache workers! (%s)", e)
+        try:
+            self.manager.record_metrics()
+            manager_metrics = self.manager.manager_metrics
+            if self.scheduler:
+                manager_metrics.update(self.scheduler.metrics())
+            snapshot = Snapshot(
+                timestamp=time.time(),
+                server_metrics=self.manager.server_metrics,
+                manager_metrics=manager_metrics,
+                memory_usage=self.manager.memory_groups,
+            )
+        except Exception as e:
+            logger.warning("Failed to collect Apache metrics! (%s)", e)
+            return
+        self.publish(snapshot)
+        if self.data_file:
+            try:
+                self.manager.save_metrics(self.data_file)
+            except Exception as e:
+                logger.warning("Failed to save Apache metrics! (%s)", e)
+        logger.debug("Collected Apache metrics in %s.", timer)
+
+    def publish(self, snapshot):
+        # Snapshots are never modified after they're published, so readers in
+        # other threads can use the current one without any locking.
+        self.snapshot = snapshot
+        for callback in self.subscribers:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logger.warning("Snapshot subscriber %r failed! (%s)", callback, e)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+
+class Snapshot(PropertyManager):
+
+    @required_property
+    def timestamp(self):
+        pass
+
+    @required_property
+    def server_metrics(self):
+        pass
+
+    @required_property
+    def manager_metrics(self):
+        pass
+
+    @required_property
+    def memory_usage(self):
+        pass
+
+    @property
+    def group_names(self):
+        return [NATIVE_WORKERS_LABEL] + sorted(n for n in self.memory_usage if n != NATIVE_WORKERS_LABEL)
@@ -2,5 +2,12 @@
 # Last Change: Nov 05, 2019
 
 class ApacheManagerError(Exception):
+    pass
+
+
 class AddressDiscoveryError(ApacheManagerError):
-class StatusPageError(ApacheManagerError):
\ No newline at end of file
+    pass
+
+
+class StatusPageError(ApacheManagerError):
+    pass
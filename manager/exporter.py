@@ -0,0 +1,210 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import gzip
+import io
+import logging
+import numbers
+import re
+import threading
+
+from property_manager import PropertyManager, lazy_property, mutable_property, writable_property
+from six.moves import BaseHTTPServer, socketserver
+
+DEFAULT_ADDRESS = '127.0.0.1'
+
+DEFAULT_PORT = 9117
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+METRIC_PREFIX = 'perf_moon'
+
+# Lifetime counters reported by Apache, exposed as OpenMetrics counters
+# (server metric name, metric family name). All other metrics are gauges.
+COUNTER_METRICS = {
+    'total_accesses': 'accesses',
+    'total_traffic': 'traffic_bytes',
+    'total_duration': 'duration',
+    'status_fetch_errors': 'status_fetch_errors',
+    'workers_killed_active': 'workers_killed_active',
+    'workers_killed_idle': 'workers_killed_idle',
+}
+
+# Latency histograms in the manager metrics (see LatencyHistogram.metrics()).
+HISTOGRAM_METRICS = ('status_fetch',)
+
+MEMORY_STATISTICS = ('min', 'max', 'average', 'median')
+
+# Suffixes of the sample names of counters and histograms. Other metrics
+# with such a name (like the ConnsTotal field of the event MPM, a gauge)
+# get a "_value" suffix so that they can't be mistaken for those samples.
+RESERVED_SUFFIXES = ('_bucket', '_count', '_created', '_gcount', '_gsum', '_info', '_sum', '_total')
+
+INVALID_NAME_PATTERN = re.compile(r'[^a-zA-Z0-9_]+')
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsExporter(PropertyManager):
+
+    @mutable_property
+    def address(self):
+        return DEFAULT_ADDRESS
+
+    @mutable_property
+    def port(self):
+        return DEFAULT_PORT
+
+    @writable_property
+    def payload(self):
+        # Until the first snapshot is published scrapes get an empty (but
+        # valid) exposition instead of blocking on a status page fetch.
+        return encode_payload(b'# EOF\n')
+
+    @lazy_property
+    def server(self):
+        server = ExporterServer((self.address, self.port), ExporterRequestHandler)
+        server.exporter = self
+        return server
+
+    @lazy_property
+    def thread(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        return thread
+
+    def update(self, snapshot):
+        # Rendering and compressing happens once per snapshot (in the thread
+        # that publishes it), scrapes only swap in the reference.
+        self.payload = encode_payload(render_snapshot(snapshot))
+
+    def start(self):
+        self.thread.start()
+        logger.info("Serving OpenMetrics exposition on http://%s:%i/metrics ..", *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ExporterServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    allow_reuse_address = True
+
+
+class ExporterRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    wbufsize = -1
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        plain, compressed = self.server.exporter.payload
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = compressed if use_gzip else plain
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Exporter request from %s: %s", self.client_address[0], format % args)
+
+
+def render_snapshot(snapshot):
+    lines = []
+    add_family(lines, 'snapshot_timestamp_seconds', 'gauge', [((), snapshot.timestamp)])
+    for name, value in sorted(snapshot.server_metrics.items()):
+        add_metric(lines, name, value)
+    manager_metrics = dict(snapshot.manager_metrics)
+    for prefix in HISTOGRAM_METRICS:
+        add_histogram(lines, prefix, manager_metrics)
+    for name, value in sorted(manager_metrics.items()):
+        add_metric(lines, name, value)
+    workers = []
+    memory_usage = []
+    for group_name in snapshot.group_names:
+        group = snapshot.memory_usage[group_name]
+        workers.append(((('group', group_name),), len(group)))
+        if group:
+            for statistic in MEMORY_STATISTICS:
+                labels = (('group', group_name), ('statistic', statistic))
+                memory_usage.append((labels, getattr(group, statistic)))
+    add_family(lines, 'workers', 'gauge', workers)
+    add_family(lines, 'memory_usage_bytes', 'gauge', memory_usage)
+    lines.append('# EOF')
+    return ('\n'.join(lines) + '\n').encode('UTF-8')
+
+
+def add_metric(lines, name, value):
+    if isinstance(value, bool):
+        value = int(value)
+    elif not isinstance(value, numbers.Number):
+        return
+    if name in COUNTER_METRICS:
+        add_family(lines, COUNTER_METRICS[name], 'counter', [((), value)])
+    else:
+        add_family(lines, name, 'gauge', [((), value)])
+
+
+def add_histogram(lines, prefix, metrics):
+    count = metrics.pop('%s_count' % prefix, None)
+    total = metrics.pop('%s_seconds' % prefix, None)
+    if count is None or total is None:
+        return
+    buckets = []
+    for name in list(metrics):
+        if name.startswith('%s_le_' % prefix):
+            bound = name[len(prefix) + 4:]
+            buckets.append((float(bound), bound, metrics.pop(name)))
+    name = '%s_%s_seconds' % (METRIC_PREFIX, prefix)
+    lines.append('# TYPE %s histogram' % name)
+    for value, bound, cumulative in sorted(buckets):
+        lines.append('%s_bucket{le="%s"} %s' % (name, bound, cumulative))
+    lines.append('%s_bucket{le="+Inf"} %s' % (name, count))
+    lines.append('%s_sum %s' % (name, format_value(total)))
+    lines.append('%s_count %s' % (name, count))
+
+
+def add_family(lines, name, metric_type, samples):
+    name = '%s_%s' % (METRIC_PREFIX, INVALID_NAME_PATTERN.sub('_', name))
+    if name.endswith(RESERVED_SUFFIXES):
+        name += '_value'
+    lines.append('# TYPE %s %s' % (name, metric_type))
+    sample_name = '%s_total' % name if metric_type == 'counter' else name
+    for labels, value in samples:
+        if labels:
+            lines.append('%s{%s} %s' % (sample_name, ','.join(
+                '%s="%s"' % (k, escape_label(v)) for k, v in labels
+            ), format_value(value)))
+        else:
+            lines.append('%s %s' % (sample_name, format_value(value)))
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def encode_payload(body):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as handle:
+        handle.write(body)
+    return body, buffer.getvalue()
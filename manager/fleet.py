@@ -0,0 +1,171 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import logging
+import threading
+import time
+
+from humanfriendly import format_timespan, pluralize
+from property_manager import PropertyManager, cached_property, mutable_property, writable_property
+from six.moves import queue
+
+from perf_moon import PORTS_CONF, ApacheManager, write_data_file
+from perf_moon.transport import ConnectionPool
+
+DEFAULT_CONCURRENCY = 8
+
+DEFAULT_DEADLINE = 15
+
+# Metrics that don't make sense to add up over several Apache instances,
+# everything else (counters, rates and worker counts) is added up.
+AVERAGED_METRICS = ('cpu_load', 'load1', 'load5', 'load15')
+
+# Per request averages are weighted by the number of requests of each
+# instance, so that a nearly idle instance counts for less than a busy one.
+WEIGHTED_METRICS = {
+    'bytes_per_request': 'total_accesses',
+    'duration_per_req': 'total_accesses',
+}
+
+MINIMUM_METRICS = ('server_uptime_seconds', 'uptime')
+
+# Metrics that describe the state of an instance (adding up configuration
+# generations is meaningless), their range is reported as <name>_min and
+# <name>_max instead.
+RANGE_METRICS = ('parent_server_config_generation', 'parent_server_mpm_generation')
+
+logger = logging.getLogger(__name__)
+
+
+class ApacheFleet(PropertyManager):
+
+    @mutable_property
+    def targets(self):
+        return ApacheManager(ports_config=self.ports_config).status_urls
+
+    @mutable_property
+    def ports_config(self):
+        return PORTS_CONF
+
+    @mutable_property
+    def concurrency(self):
+        return DEFAULT_CONCURRENCY
+
+    @mutable_property
+    def deadline(self):
+        return DEFAULT_DEADLINE
+
+    @writable_property(cached=True)
+    def connection_pool(self):
+        return ConnectionPool()
+
+    @cached_property
+    def managers(self):
+        # The managers are recreated on every cycle (refreshing them would
+        # rediscover their status page URL), the connection pool is shared
+        # so that the keep-alive connections survive.
+        return [ApacheManager(html_status_url=url, connection_pool=self.connection_pool) for url in self.targets]
+
+    @cached_property
+    def results(self):
+        pending = queue.Queue()
+        for manager in self.managers:
+            pending.put(manager)
+        results = {}
+        lock = threading.Lock()
+
+        def poll_targets():
+            while True:
+                try:
+                    manager = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    value = manager.server_metrics
+                except Exception as e:
+                    logger.warning("Failed to collect metrics from %s! (%s)", manager.html_status_url, e)
+                    value = e
+                with lock:
+                    results[manager.html_status_url] = value
+
+        threads = []
+        for i in range(min(self.concurrency, len(self.managers))):
+            thread = threading.Thread(target=poll_targets)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        deadline = time.time() + self.deadline
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        with lock:
+            # Targets that didn't respond before the deadline are reported as
+            # failed, their threads are left to finish in the background.
+            snapshot = dict(results)
+        for url in self.targets:
+            if url not in snapshot:
+                logger.warning("Giving up on %s after %s!", url, format_timespan(self.deadline))
+                snapshot[url] = None
+        return snapshot
+
+    @cached_property
+    def server_metrics(self):
+        return dict((url, value) for url, value in self.results.items() if isinstance(value, dict))
+
+    @cached_property
+    def failed_targets(self):
+        return sorted(url for url, value in self.results.items() if not isinstance(value, dict))
+
+    @cached_property
+    def aggregated_metrics(self):
+        aggregated = combine_metrics(self.server_metrics.values())
+        aggregated['targets_total'] = len(self.targets)
+        aggregated['targets_failed'] = len(self.failed_targets)
+        return aggregated
+
+    def save_metrics(self, data_file):
+        logger.debug("Storing metrics of %s in %s ..", pluralize(len(self.targets), "target"), data_file)
+        output = ['# Aggregated Apache server metrics.']
+        for name, value in sorted(self.aggregated_metrics.items()):
+            output.append('%s\t%s' % (name.replace('_', '-'), value))
+        for url, metrics in sorted(self.server_metrics.items()):
+            output.extend(['', '# Apache server metrics of %s.' % url])
+            for name, value in sorted(metrics.items()):
+                output.append('\t'.join([url, name.replace('_', '-'), str(value)]))
+        write_data_file(data_file, output)
+
+    def refresh(self):
+        self.clear_cached_properties()
+
+
+def combine_metrics(metrics_list):
+    # Combines the server metrics of several Apache instances.
+    combined = {}
+    counts = {}
+    weights = {}
+    weighted = {}
+    for metrics in metrics_list:
+        for name, value in metrics.items():
+            if name in RANGE_METRICS:
+                for suffix, function in (('min', min), ('max', max)):
+                    key = '%s_%s' % (name, suffix)
+                    combined[key] = function(combined[key], value) if key in combined else value
+                continue
+            if name in WEIGHTED_METRICS:
+                weight = metrics.get(WEIGHTED_METRICS[name], 0)
+                weights[name] = weights.get(name, 0) + weight
+                weighted[name] = weighted.get(name, 0) + value * weight
+            if name not in combined:
+                combined[name] = value
+            elif name in MINIMUM_METRICS:
+                combined[name] = min(combined[name], value)
+            else:
+                combined[name] += value
+            counts[name] = counts.get(name, 0) + 1
+    for name in AVERAGED_METRICS + tuple(WEIGHTED_METRICS):
+        if name in combined:
+            if weights.get(name):
+                combined[name] = weighted[name] / float(weights[name])
+            else:
+                # Without any requests the instances count equally.
+                combined[name] /= float(counts[name])
+    return combined
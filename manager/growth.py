@@ -0,0 +1,65 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import collections
+import logging
+
+from perf_moon.processes import STARTTIME_FIELD
+
+DEFAULT_SAMPLES = 10
+
+DEFAULT_MAX_WORKERS = 4096
+
+# The minimum number of samples before the growth of a worker is estimated.
+MIN_SAMPLES = 3
+
+logger = logging.getLogger(__name__)
+
+
+class GrowthTracker(object):
+
+    def __init__(self, samples=DEFAULT_SAMPLES, max_workers=DEFAULT_MAX_WORKERS):
+        self.samples = samples
+        self.max_workers = max_workers
+        self.series = {}
+
+    def __len__(self):
+        return len(self.series)
+
+    def observe(self, timestamp, processes, measure=None):
+        # Processes are identified by their PID and start time so that a
+        # reused PID doesn't inherit the history of a previous worker. The
+        # history of workers that are gone is evicted on every cycle.
+        series = {}
+        for process in processes[:self.max_workers]:
+            key = (process.pid, process.stat_fields[STARTTIME_FIELD])
+            samples = self.series.get(key)
+            if samples is None:
+                samples = collections.deque(maxlen=self.samples)
+            samples.append((timestamp, measure(process) if measure else process.rss))
+            series[key] = samples
+        self.series = series
+
+    def growth_rate(self, process):
+        # Least squares slope of the memory usage in bytes per second.
+        samples = self.series.get((process.pid, process.stat_fields[STARTTIME_FIELD]))
+        if not samples or len(samples) < MIN_SAMPLES:
+            return None
+        mean_time = sum(t for t, r in samples) / float(len(samples))
+        mean_usage = sum(r for t, r in samples) / float(len(samples))
+        variance = sum((t - mean_time) ** 2 for t, r in samples)
+        if not variance:
+            return None
+        return sum((t - mean_time) * (r - mean_usage) for t, r in samples) / variance
+
+    def projections(self, processes, horizon):
+        # Projected memory usage (in bytes) after `horizon` seconds of the
+        # workers whose memory usage is growing.
+        projections = {}
+        for process in processes:
+            rate = self.growth_rate(process)
+            if rate and rate > 0:
+                samples = self.series[(process.pid, process.stat_fields[STARTTIME_FIELD])]
+                projections[process.pid] = samples[-1][1] + rate * horizon
+        logger.debug("Projected memory growth of %i of %i workers.", len(projections), len(processes))
+        return projections
@@ -0,0 +1,130 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import array
+import logging
+import numbers
+import os
+
+DEFAULT_CAPACITY = 360
+
+DEFAULT_WINDOW = 6
+
+# Lifetime counters reported by Apache from which per-interval rates are
+# derived: (counter name, rate name).
+RATE_COUNTERS = (
+    ('total_accesses', 'requests_per_second'),
+    ('total_traffic', 'bytes_per_second'),
+)
+
+# The metrics derived from the rates by current_metrics().
+DERIVED_METRICS = frozenset('%s_%s' % (name, statistic) for counter, name in RATE_COUNTERS
+                            for statistic in ('current', 'average', 'p95'))
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsHistory(object):
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = array.array('d', [0.0] * capacity)
+        self.columns = {}
+        self.size = 0
+        self.position = 0
+
+    def __len__(self):
+        return self.size
+
+    def record(self, timestamp, metrics):
+        index = self.position
+        self.timestamps[index] = timestamp
+        # Derived metrics passed in were computed before this sample was
+        # appended, they're recomputed including the sample instead.
+        metrics = dict((n, v) for n, v in metrics.items() if n not in DERIVED_METRICS)
+        self.store(index, metrics)
+        self.position = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        derived = self.current_metrics()
+        self.store(index, derived)
+        for name, column in self.columns.items():
+            if name not in metrics and name not in derived:
+                column[index] = float('nan')
+
+    def store(self, index, metrics):
+        for name, value in metrics.items():
+            if isinstance(value, bool) or not isinstance(value, numbers.Number):
+                continue
+            column = self.columns.get(name)
+            if column is None:
+                column = array.array('d', [float('nan')] * self.capacity)
+                self.columns[name] = column
+            column[index] = value
+
+    def indexes(self, count=None):
+        # Ring buffer indexes from oldest to newest.
+        count = self.size if count is None else min(count, self.size)
+        start = self.position - count
+        return [(start + i) % self.capacity for i in range(count)]
+
+    def values(self, name, count=None):
+        column = self.columns.get(name)
+        if column is None:
+            return []
+        return [column[i] for i in self.indexes(count) if column[i] == column[i]]
+
+    def rates(self, name, count=None):
+        column = self.columns.get(name)
+        if column is None:
+            return []
+        indexes = self.indexes(None if count is None else count + 1)
+        rates = []
+        for previous, current in zip(indexes, indexes[1:]):
+            elapsed = self.timestamps[current] - self.timestamps[previous]
+            delta = column[current] - column[previous]
+            # Negative deltas mean Apache was restarted (its counters were
+            # reset) and NaN deltas mean the counter wasn't reported.
+            if elapsed > 0 and delta >= 0:
+                rates.append(delta / elapsed)
+        return rates
+
+    def current_metrics(self, window=DEFAULT_WINDOW):
+        metrics = {}
+        for counter, name in RATE_COUNTERS:
+            rates = self.rates(counter, window)
+            if rates:
+                metrics['%s_current' % name] = rates[-1]
+                metrics['%s_average' % name] = sum(rates) / len(rates)
+                metrics['%s_p95' % name] = percentile(rates, 95)
+        return metrics
+
+    def load_data_file(self, data_file):
+        # One-shot runs (e.g. from cron) have no history of their own, the
+        # previous data file provides a sample to compute rates against.
+        try:
+            timestamp = os.path.getmtime(data_file)
+            metrics = {}
+            with open(data_file) as handle:
+                for line in handle:
+                    tokens = line.split('\t')
+                    if len(tokens) == 2:
+                        try:
+                            metrics[tokens[0].replace('-', '_')] = float(tokens[1])
+                        except ValueError:
+                            pass
+        except (IOError, OSError):
+            return False
+        if metrics:
+            self.record(timestamp, metrics)
+            logger.debug("Loaded previous sample of %i metrics from %s.", len(metrics), data_file)
+        return bool(metrics)
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * percent / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
@@ -0,0 +1,107 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import itertools
+import re
+
+DEFAULT_CAPACITY = 100
+
+# Path segments that identify a resource rather than a route: numbers, hex
+# digests and UUIDs.
+IDENTIFIER_PATTERN = re.compile(r'^(?:\d+|[0-9a-fA-F]{16,}|[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12})$')
+
+# Apache truncates the Request column (to 63 characters) so there's a long tail
+# of distinct values, the route cache is simply reset when it gets this large.
+MAX_CACHED_ROUTES = 10000
+
+routes = {}
+
+
+class RequestGroup(object):
+
+    def __init__(self, vhost, route):
+        self.vhost = vhost
+        self.route = route
+        self.count = 0
+        self.ss_total = 0
+        self.ss_max = 0
+        self.cpu = 0.0
+
+    def add(self, ss, cpu):
+        self.count += 1
+        if ss >= 0:
+            self.ss_total += ss
+            self.ss_max = max(self.ss_max, ss)
+        if cpu == cpu:
+            self.cpu += cpu
+
+
+class HeavyHitters(object):
+
+    # The Space-Saving algorithm: at most `capacity` keys are tracked, when a
+    # new key arrives and the sketch is full it replaces the key with the
+    # lowest count and inherits that count as its (over)estimation error.
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, weight=1):
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            self.errors[key] = 0
+        else:
+            victim = min(self.counts, key=self.counts.get)
+            minimum = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[key] = minimum + weight
+            self.errors[key] = minimum
+
+    def top(self, count=10):
+        # Returns (key, estimated count, maximum error) tuples.
+        ranked = sorted(self.counts.items(), key=lambda i: i[1], reverse=True)
+        return [(key, value, self.errors[key]) for key, value in ranked[:count]]
+
+
+def aggregate_requests(scoreboard, modes):
+    # Groups the slots whose mode is in `modes` by virtual host and route,
+    # working directly on the columns of the scoreboard.
+    groups = {}
+    vhosts = scoreboard.text_columns.get('vhost') or itertools.repeat(None)
+    requests = scoreboard.text_columns.get('request') or itertools.repeat(None)
+    mask = scoreboard.mode_mask(modes)
+    for selected, vhost, request, ss, cpu in zip(mask, vhosts, requests, scoreboard.ss, scoreboard.cpu):
+        if selected:
+            key = (vhost, normalize_request(request))
+            group = groups.get(key)
+            if group is None:
+                group = RequestGroup(*key)
+                groups[key] = group
+            group.add(ss, cpu)
+    return sorted(groups.values(), key=lambda g: (g.count, g.ss_total), reverse=True)
+
+
+def normalize_request(request):
+    # Translates e.g. "GET /api/users/42?page=2 HTTP/1.1" to "GET /api/users/:id".
+    try:
+        return routes[request]
+    except KeyError:
+        if len(routes) >= MAX_CACHED_ROUTES:
+            routes.clear()
+        tokens = request.split() if request and request != 'NULL' else []
+        if tokens:
+            method = tokens[0]
+            path = tokens[1].split('?')[0] if len(tokens) > 1 else ''
+            route = ('%s %s' % (method, '/'.join(
+                ':id' if IDENTIFIER_PATTERN.match(s) else s for s in path.split('/')
+            ))).rstrip()
+        else:
+            route = None
+        routes[request] = route
+        return route
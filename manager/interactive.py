@@ -1,42 +1,289 @@
 # Author: Girardon <ggirardon@gmail.com>
-# Last Change: Nov 05, 2019
+# Last Change: Oct 17, 2026
 
 import curses
+import heapq
+import itertools
+import locale
 import logging
 import time
 
 import coloredlogs
+from humanfriendly import format_size, format_timespan, pluralize
 
+from perf_moon import NATIVE_WORKERS_LABEL
+from perf_moon.scheduler import AdaptiveScheduler
 
-def watch_metrics(manager):
+# How often the keyboard is checked while waiting for the next sample.
+KEYBOARD_POLL_INTERVAL = 0.05
+
+SPARKLINE_CHARACTERS = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+ASCII_SPARKLINE_CHARACTERS = ' .:-=+*#@'
+
+# The width of the labels and values next to the sparklines.
+SPARKLINE_LABEL_WIDTH = 14
+
+SPARKLINE_VALUE_WIDTH = 12
+
+# The worker table can be sorted on these columns (the first is the default).
+SORT_ORDERS = ('ss', 'memory', 'pid', 'mode')
+
+# Formatted strings are reused between redraws, the cache is simply reset
+# when it gets this large.
+MAX_CACHED_STRINGS = 10000
+
+TABLE_HEADING = "%7s %1s %8s %10s  %s" % ("PID", "M", "SS", "Memory", "Request")
+
+TABLE_ROW = "%7i %1s %8s %10s  %s"
+
+
+def watch_metrics(manager, scheduler=None):
+    # Required for curses to render the sparklines (wide characters).
+    locale.setlocale(locale.LC_ALL, '')
     try:
-        curses.wrapper(redraw_loop, manager)
+        curses.wrapper(redraw_loop, manager, scheduler or AdaptiveScheduler())
     except KeyboardInterrupt:
         pass
 
 
-def redraw_loop(screen, manager):
-    from perf_moon.cli import report_metrics, line_is_heading
+def redraw_loop(screen, manager, scheduler):
     coloredlogs.set_level(logging.ERROR)
     cursor_mode = curses.curs_set(0)
     curses.noraw()
     screen.nodelay(True)
+    screen.keypad(True)
+    buffer = ScreenBuffer(screen)
+    view = WatchView()
     try:
         while True:
-            lnum = 0
-            for line in report_metrics(manager):
-                attributes = 0
-                if line_is_heading(line):
-                    attributes |= curses.A_BOLD
-                screen.addstr(lnum, 0, line, attributes)
-                lnum += 1
-            screen.refresh()
-            for i in range(10):
-                if screen.getch() == ord('q'):
+            started = scheduler.start_sample()
+            sample_time = time.time()
+            manager.record_metrics()
+            delay = scheduler.finish_sample(sample_time, started, manager)
+            deadline = sample_time + delay
+            changed = True
+            while True:
+                if changed:
+                    buffer.draw(view.render(manager, scheduler, buffer.height, buffer.width))
+                key = screen.getch()
+                if key == ord('q'):
                     return
-                time.sleep(0.1)
+                elif key == curses.KEY_RESIZE:
+                    buffer.resize()
+                    changed = True
+                else:
+                    changed = view.handle_key(key)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if not changed:
+                    time.sleep(min(remaining, KEYBOARD_POLL_INTERVAL))
             manager.refresh()
-            screen.erase()
     finally:
         curses.curs_set(cursor_mode)
         screen.erase()
+
+
+class ScreenBuffer(object):
+
+    # Remembers what's on the screen so that only the changed part of each
+    # line is written (instead of erasing and redrawing the whole screen,
+    # which flickers and sends a lot of output over slow SSH connections).
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.resize()
+
+    def resize(self):
+        self.height, self.width = self.screen.getmaxyx()
+        self.lines = []
+        self.screen.clear()
+
+    def draw(self, lines):
+        lines = [(text[:self.width - 1], attributes) for text, attributes in lines[:self.height]]
+        for lnum, (text, attributes) in enumerate(lines):
+            previous_text, previous_attributes = self.lines[lnum] if lnum < len(self.lines) else ('', 0)
+            if text == previous_text and attributes == previous_attributes:
+                continue
+            column = 0
+            if attributes == previous_attributes:
+                # Skip the unchanged prefix of the line.
+                while column < min(len(text), len(previous_text)) and text[column] == previous_text[column]:
+                    column += 1
+            self.screen.move(lnum, column)
+            self.screen.clrtoeol()
+            if column < len(text):
+                self.screen.addstr(lnum, column, text[column:], attributes)
+        for lnum in range(len(lines), len(self.lines)):
+            self.screen.move(lnum, 0)
+            self.screen.clrtoeol()
+        self.lines = lines
+        self.screen.refresh()
+
+
+class StringCache(object):
+
+    def __init__(self, capacity=MAX_CACHED_STRINGS):
+        self.capacity = capacity
+        self.strings = {}
+
+    def __call__(self, function, value):
+        key = (function, value)
+        try:
+            return self.strings[key]
+        except KeyError:
+            if len(self.strings) >= self.capacity:
+                self.strings.clear()
+            text = function(value)
+            self.strings[key] = text
+            return text
+
+
+class WatchView(object):
+
+    def __init__(self):
+        self.format = StringCache()
+        self.sort_order = SORT_ORDERS[0]
+        self.reverse = False
+        self.offset = 0
+        self.page_size = 1
+        self.memory = {}
+        self.memory_sample = None
+        try:
+            SPARKLINE_CHARACTERS.encode(locale.getpreferredencoding() or 'ascii')
+            self.sparkline_characters = SPARKLINE_CHARACTERS
+        except (LookupError, UnicodeError):
+            self.sparkline_characters = ASCII_SPARKLINE_CHARACTERS
+
+    def handle_key(self, key):
+        # Returns True when the screen needs to be redrawn.
+        if key == ord('s'):
+            self.sort_order = SORT_ORDERS[(SORT_ORDERS.index(self.sort_order) + 1) % len(SORT_ORDERS)]
+            self.offset = 0
+        elif key == ord('r'):
+            self.reverse = not self.reverse
+            self.offset = 0
+        elif key in (curses.KEY_DOWN, ord('j')):
+            self.offset += 1
+        elif key in (curses.KEY_UP, ord('k')):
+            self.offset -= 1
+        elif key in (curses.KEY_NPAGE, ord(' ')):
+            self.offset += self.page_size
+        elif key == curses.KEY_PPAGE:
+            self.offset -= self.page_size
+        elif key == curses.KEY_HOME:
+            self.offset = 0
+        else:
+            return False
+        return True
+
+    def render(self, manager, scheduler, height, width):
+        lines = []
+        self.render_summary(lines, manager, width)
+        if manager.have_worker_details:
+            self.render_workers(lines, manager, height - len(lines) - 2)
+        lines.append(("", 0))
+        lines.append(("Sampling every %s (%s), sorted by %s%s. Keys: q quit, s sort, r reverse, arrows scroll." % (
+            self.format(format_timespan, round(scheduler.interval, 1)),
+            "%.1f samples/s" % scheduler.sampling_rate if scheduler.sampling_rate else "first sample",
+            self.sort_order, " (reversed)" if self.reverse else "",
+        ), curses.A_DIM))
+        return lines
+
+    def render_summary(self, lines, manager, width):
+        metrics = manager.server_metrics
+        lines.append(("Apache: %i busy and %i idle workers, %.2f requests/s, %s/s, CPU load %.1f%%, uptime %s" % (
+            metrics.get('busy_workers', 0), metrics.get('idle_workers', 0),
+            metrics.get('requests_per_second', 0), self.format(format_size, metrics.get('bytes_per_second', 0)),
+            metrics.get('cpu_load', 0), self.format(format_timespan, metrics.get('uptime', 0)),
+        ), curses.A_BOLD))
+        # The sparklines show as many samples as fit on the screen (bounded
+        # by the capacity of the metrics history).
+        count = max(1, width - SPARKLINE_LABEL_WIDTH - SPARKLINE_VALUE_WIDTH - 3)
+        rates = manager.history.rates('total_accesses', count)
+        lines.append(self.render_sparkline("Requests/s", rates, '%.1f' % rates[-1] if rates else '-'))
+        busy = manager.history.values('busy_workers', count)
+        lines.append(self.render_sparkline("Busy workers", busy, '%i' % busy[-1] if busy else '-'))
+        memory_groups = [(NATIVE_WORKERS_LABEL, manager.memory_usage)]
+        memory_groups.extend(sorted(manager.wsgi_process_groups.items()))
+        for label, memory_usage in memory_groups:
+            if memory_usage:
+                lines.append(("Memory of %s (%s): min %s, average %s, max %s" % (
+                    label, pluralize(len(memory_usage), "worker"),
+                    self.format(format_size, memory_usage.min),
+                    self.format(format_size, int(memory_usage.average)),
+                    self.format(format_size, memory_usage.max),
+                ), 0))
+        if manager.have_worker_details:
+            for group in manager.request_hotspots[:3]:
+                lines.append(("Hot spot: %s %s (%s, %s max)" % (
+                    group.vhost or 'unknown vhost', group.route or 'unknown request',
+                    pluralize(group.count, "worker"), self.format(format_seconds, group.ss_max),
+                ), 0))
+
+    def render_sparkline(self, label, values, current):
+        characters = self.sparkline_characters
+        if values:
+            highest = max(values) or 1
+            scale = (len(characters) - 1) / float(highest)
+            sparkline = ''.join(characters[int(round(max(v, 0) * scale))] for v in values)
+        else:
+            sparkline = ''
+        return ("%-*s %*s %s" % (SPARKLINE_LABEL_WIDTH, label, SPARKLINE_VALUE_WIDTH, current, sparkline), 0)
+
+    def render_workers(self, lines, manager, height):
+        # Only the visible rows are formatted, which keeps the cost of a
+        # redraw flat as the number of worker slots grows (selecting the
+        # visible rows is a partial sort over the columns of the scoreboard).
+        slots = manager.slots
+        indexes = list(itertools.compress(range(len(slots)), slots.mode_mask('.', negate=True)))
+        lines.append(("", 0))
+        lines.append((TABLE_HEADING, curses.A_BOLD))
+        # Room for the heading and the position in the table.
+        self.page_size = max(1, height - 3)
+        self.offset = max(0, min(self.offset, len(indexes) - self.page_size))
+        memory = self.measure_memory(manager) if manager.apache_workers else {}
+        pids, modes, ss = slots.pid, slots.modes, slots.ss
+        if self.sort_order == 'memory':
+            def key(i):
+                return -memory.get(pids[i], 0)
+        elif self.sort_order == 'pid':
+            key = pids.__getitem__
+        elif self.sort_order == 'mode':
+            key = modes.__getitem__
+        else:
+            def key(i):
+                return -ss[i]
+        select = heapq.nlargest if self.reverse else heapq.nsmallest
+        visible = select(self.offset + self.page_size, indexes, key=key)[self.offset:]
+        for index in visible:
+            usage = memory.get(pids[index])
+            request = slots.text('request', index)
+            vhost = slots.text('vhost', index)
+            lines.append((TABLE_ROW % (
+                pids[index], chr(modes[index]) if modes[index] else '?',
+                self.format(format_seconds, ss[index]) if ss[index] >= 0 else '-',
+                self.format(format_size, usage) if usage is not None else '-',
+                ' '.join(t for t in (vhost, request) if t and t != 'NULL'),
+            ), 0))
+        if len(indexes) > self.page_size:
+            lines.append(("Workers %i-%i of %i" % (
+                self.offset + 1, self.offset + len(visible), len(indexes),
+            ), curses.A_DIM))
+
+    def measure_memory(self, manager):
+        # The memory usage by PID is computed once per sample.
+        if self.memory_sample != manager.sample_time:
+            self.memory = dict((p.pid, manager.measure_memory(p)) for p in manager.apache_workers)
+            self.memory_sample = manager.sample_time
+        return self.memory
+
+
+def format_seconds(seconds):
+    # A compact alternative to format_timespan() for the worker table.
+    if seconds < 60:
+        return '%is' % seconds
+    elif seconds < 60 * 60:
+        return '%im%02is' % divmod(seconds, 60)
+    return '%ih%02im' % divmod(seconds // 60, 60)
@@ -0,0 +1,198 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import collections
+import errno
+import logging
+import os
+import signal
+import time
+
+from humanfriendly import Timer, format_size, format_timespan, pluralize
+from property_manager import PropertyManager, lazy_property, mutable_property, required_property, writable_property
+
+DEFAULT_BUDGET_INTERVAL = 60
+
+DEFAULT_GRACE_PERIOD = 5
+
+# How long to wait for a process to disappear after SIGKILL.
+KILL_TIMEOUT = 5
+
+POLL_INTERVAL = 0.05
+
+# Memory victims are killed before hanging workers (memory exhaustion can
+# take down the whole host) and workers that are merely projected to exceed
+# the limit come last, within each reason the worst offenders first.
+REASON_PRIORITY = dict(memory=0, timeout=1, growth=2)
+
+logger = logging.getLogger(__name__)
+
+
+class KillScheduler(PropertyManager):
+
+    @mutable_property
+    def max_kills(self):
+        # Zero means there's no limit on the number of kills per interval.
+        return 0
+
+    @mutable_property
+    def budget_interval(self):
+        return DEFAULT_BUDGET_INTERVAL
+
+    @mutable_property
+    def grace_period(self):
+        # Zero means workers are killed with SIGKILL right away.
+        return DEFAULT_GRACE_PERIOD
+
+    @lazy_property
+    def kill_times(self):
+        return collections.deque()
+
+    @property
+    def remaining_budget(self):
+        if not self.max_kills:
+            return None
+        cutoff = time.time() - self.budget_interval
+        while self.kill_times and self.kill_times[0] < cutoff:
+            self.kill_times.popleft()
+        return max(0, self.max_kills - len(self.kill_times))
+
+    def plan(self, candidates, max_memory_active=0, max_memory_idle=0, timeout=0, timed_out=(), projections=None):
+        # The memory usage of all candidates is gathered up front from the
+        # process objects of the /proc snapshot, before any worker is killed.
+        victims = []
+        seen = set()
+        for worker in candidates:
+            if worker.pid in seen:
+                continue
+            seen.add(worker.pid)
+            memory_usage_threshold = max_memory_active if worker.is_active else max_memory_idle
+            memory_usage = worker.memory_usage if memory_usage_threshold else None
+            if memory_usage_threshold and memory_usage and memory_usage > memory_usage_threshold:
+                victims.append(Victim(worker=worker, reason='memory', excess=memory_usage - memory_usage_threshold))
+            elif timeout and worker.pid in timed_out:
+                victims.append(Victim(worker=worker, reason='timeout', excess=worker.ss - timeout))
+            elif projections and worker.pid in projections and not worker.is_active:
+                # Workers that are about to outgrow the limit for active
+                # workers are recycled while they're idle, before they start
+                # serving the request that would push them over the limit.
+                growth_threshold = max_memory_active or max_memory_idle
+                if growth_threshold and projections[worker.pid] > growth_threshold:
+                    victims.append(Victim(worker=worker, reason='growth',
+                                          excess=projections[worker.pid] - growth_threshold))
+        victims.sort(key=lambda v: (REASON_PRIORITY[v.reason], -v.excess))
+        budget = self.remaining_budget
+        if budget is not None and len(victims) > budget:
+            logger.warning("Deferring %s to stay within the budget of %s per %s!",
+                           pluralize(len(victims) - budget, "kill"),
+                           pluralize(self.max_kills, "kill"),
+                           format_timespan(self.budget_interval))
+            for victim in victims[budget:]:
+                victim.outcome = 'deferred'
+        return victims
+
+    def execute(self, victims, dry_run=False):
+        pending = [v for v in victims if v.outcome is None]
+        for victim in pending:
+            logger.info("Killing %s (%s) ..", victim.worker, victim.description)
+            if dry_run:
+                victim.outcome = 'simulated'
+        if dry_run or not pending:
+            return victims
+        timer = Timer()
+        # All victims are signaled at once and then polled together, so the
+        # grace period is spent in parallel instead of once per worker.
+        first_signal = signal.SIGTERM if self.grace_period else signal.SIGKILL
+        alive = [v for v in pending if v.send_signal(first_signal)]
+        self.kill_times.extend(time.time() for v in alive)
+        alive = self.wait_for_exit(alive, self.grace_period, 'terminated' if self.grace_period else 'killed', timer)
+        if alive and self.grace_period:
+            logger.info("Escalating to SIGKILL for %s still alive after %s ..",
+                        pluralize(len(alive), "worker"), format_timespan(self.grace_period))
+            alive = [v for v in alive if v.send_signal(signal.SIGKILL)]
+            alive = self.wait_for_exit(alive, KILL_TIMEOUT, 'killed', timer)
+        for victim in alive:
+            victim.outcome = 'failed'
+            victim.error = "still alive after SIGKILL"
+        for victim in pending:
+            if victim.outcome in ('terminated', 'killed'):
+                logger.info("Worker %i %s in %s.", victim.worker.pid, victim.outcome, format_timespan(victim.latency))
+            elif victim.outcome == 'failed':
+                logger.warning("Failed to kill %s! (%s)", victim.worker, victim.error)
+        return victims
+
+    def wait_for_exit(self, victims, timeout, outcome, timer):
+        deadline = time.time() + timeout
+        while victims:
+            survivors = []
+            for victim in victims:
+                if victim.worker.is_alive:
+                    survivors.append(victim)
+                else:
+                    victim.outcome = outcome
+                    victim.latency = timer.elapsed_time
+            victims = survivors
+            if not victims or time.time() >= deadline:
+                break
+            time.sleep(POLL_INTERVAL)
+        return victims
+
+
+class Victim(PropertyManager):
+
+    @required_property
+    def worker(self):
+        pass
+
+    @required_property
+    def reason(self):
+        pass
+
+    @required_property
+    def excess(self):
+        pass
+
+    @writable_property
+    def outcome(self):
+        return None
+
+    @writable_property
+    def latency(self):
+        return None
+
+    @writable_property
+    def error(self):
+        return None
+
+    @property
+    def description(self):
+        if self.reason == 'memory':
+            return "using %s, %s over the limit, %s" % (
+                format_size(self.worker.memory_usage), format_size(self.excess),
+                self.worker.request or 'last request unknown',
+            )
+        if self.reason == 'growth':
+            return "using %s, projected to exceed the limit by %s" % (
+                format_size(self.worker.memory_usage), format_size(self.excess),
+            )
+        return "hanging for %s since last request, %s" % (
+            format_timespan(self.worker.ss), self.worker.request or 'unknown',
+        )
+
+    @property
+    def is_killed(self):
+        return self.outcome in ('terminated', 'killed', 'simulated')
+
+    def send_signal(self, signal_number):
+        # Returns True when the signal was delivered to a running process.
+        try:
+            os.kill(self.worker.pid, signal_number)
+            return True
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                self.outcome = 'vanished'
+                self.latency = 0
+            else:
+                self.outcome = 'failed'
+                self.error = str(e)
+            return False
@@ -0,0 +1,179 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARSER = 'auto'
+
+# A single pattern that tokenizes the status page into table cells (with
+# their contents) and row / table boundaries. Cells end at their closing tag or
+# at the start of the next cell, row or table (Apache always closes its cells
+# but we don't want to depend on that).
+TOKEN_PATTERN = re.compile(br'''
+    <(?:
+        (t[hd])\b[^>]*>(.*?)(?:</t[hd]>|(?=</?t(?:[hdr]\b|able\b)))
+        |
+        (/?)(tr|table)\b[^>]*>
+    )
+''', re.IGNORECASE | re.DOTALL | re.VERBOSE)
+
+MARKUP_PATTERN = re.compile(br'<[^>]*>')
+
+ENTITY_PATTERN = re.compile(r'&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z]+);')
+
+NAMED_ENTITIES = dict(amp=u'&', lt=u'<', gt=u'>', quot=u'"', apos=u"'", nbsp=u'\xa0')
+
+# Tokenizes the plain text status page (?auto) into "Key: value" pairs.
+FIELD_PATTERN = re.compile(r'^([A-Za-z][A-Za-z0-9 ]*?)[ \t]*:[ \t]*(.*?)[ \t\r]*$', re.MULTILINE)
+
+FLOAT_PATTERN = re.compile(r'^-?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?$')
+
+WORD_BOUNDARY_PATTERN = re.compile(r'(?<=[a-z]{2})(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+
+metric_names = {}
+
+
+def parse_status_page(html, required_columns, parser=DEFAULT_PARSER):
+    if parser == 'auto':
+        rows = parse_status_streaming(html, required_columns)
+        if not rows:
+            logger.debug("Streaming parser didn't find any rows, falling back to BeautifulSoup ..")
+            rows = parse_status_soup(html, required_columns)
+        return rows
+    try:
+        backend = STATUS_PARSERS[parser]
+    except KeyError:
+        raise ValueError("Unknown status page parser %r! (supported: %s)" % (parser, ', '.join(sorted(STATUS_PARSERS))))
+    return backend(html, required_columns)
+
+
+def parse_status_streaming(html, required_columns):
+    if not isinstance(html, bytes):
+        html = html.encode('UTF-8')
+    headings = []
+    values = []
+    rows = []
+    for kind, content, closing, tag in TOKEN_PATTERN.findall(html):
+        if kind:
+            if kind in (b'td', b'TD'):
+                values.append(coerce_bytes(content))
+            else:
+                headings.append(normalize_text(coerce_bytes(content)))
+            continue
+        if values:
+            if len(values) <= len(headings):
+                rows.append(dict(zip(headings, values)))
+            values = []
+        if tag.lower() == b'table':
+            if closing:
+                validated_rows = [r for r in rows if all(c in r for c in required_columns)]
+                if validated_rows:
+                    return validated_rows
+            headings = []
+            rows = []
+    if values and len(values) <= len(headings):
+        rows.append(dict(zip(headings, values)))
+    return [r for r in rows if all(c in r for c in required_columns)]
+
+
+def parse_status_soup(html, required_columns):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    for table in soup.findAll('table'):
+        matched_rows = list(parse_status_table(table))
+        validated_rows = [r for r in matched_rows if all(c in r for c in required_columns)]
+        if validated_rows:
+            return validated_rows
+    return []
+
+
+STATUS_PARSERS = dict(
+    beautifulsoup=parse_status_soup,
+    streaming=parse_status_streaming,
+)
+
+
+def parse_text_status(text):
+    fields = {}
+    for key, value in FIELD_PATTERN.findall(text):
+        fields[metric_name(key)] = coerce_number(value)
+    return fields
+
+
+def metric_name(key):
+    # Translates e.g. "ConnsAsyncKeepAlive" to "conns_async_keep_alive". The
+    # set of keys emitted by Apache is small so the translations are memoized.
+    try:
+        return metric_names[key]
+    except KeyError:
+        name = WORD_BOUNDARY_PATTERN.sub('_', key).replace(' ', '_').lower()
+        metric_names[key] = name
+        return name
+
+
+def parse_status_table(table):
+    headings = dict((i, normalize_text(coerce_tag(th))) for i, th in enumerate(table.findAll('th')))
+    logger.debug("Parsed table headings: %r", headings)
+    for tr in table.findAll('tr'):
+        values_by_index = [coerce_tag(td) for td in tr.findAll('td')]
+        logger.debug("Parsed values by index: %r", values_by_index)
+        if values_by_index:
+            try:
+                values_by_name = dict((headings[i], v) for i, v in enumerate(values_by_index))
+                logger.debug("Parsed values by name: %r", values_by_name)
+                yield values_by_name
+            except Exception:
+                pass
+
+
+def coerce_bytes(raw_value):
+    if b'<' in raw_value:
+        raw_value = MARKUP_PATTERN.sub(b'', raw_value)
+    text = raw_value.decode('UTF-8', 'replace')
+    if '&' in text:
+        text = ENTITY_PATTERN.sub(replace_entity, text)
+    return text.strip()
+
+
+def coerce_number(value):
+    if value.isdigit():
+        return int(value)
+    elif FLOAT_PATTERN.match(value):
+        return float(value)
+    else:
+        return value
+
+
+def coerce_tag(tag):
+    try:
+        return tag.get_text().strip()
+    except Exception:
+        return ''
+
+
+def coerce_value(type, value):
+    try:
+        return type(value)
+    except Exception:
+        return None
+
+
+def normalize_text(value):
+    try:
+        return re.sub('[^a-z0-9]', '', value.lower())
+    except Exception:
+        return ''
+
+
+def replace_entity(match):
+    name = match.group(1)
+    try:
+        if name.startswith('#'):
+            code = int(name[2:], 16) if name[1] in 'xX' else int(name[1:])
+            return u'%c' % code
+        return NAMED_ENTITIES[name]
+    except (KeyError, ValueError, OverflowError):
+        return match.group(0)
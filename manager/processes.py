@@ -0,0 +1,139 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import collections
+import logging
+import os
+
+from humanfriendly import Timer
+from proc.apache import ApacheDaemonNotRunning, MaybeApacheWorker, StatsList
+from proc.core import parse_process_status
+from property_manager import PropertyManager, mutable_property, writable_property
+
+from perf_moon import DEFAULT_ACCOUNTING
+
+# Field index of the process start time in /proc/[pid]/stat. Together with the
+# process ID this uniquely identifies a process, even when PIDs are reused.
+STARTTIME_FIELD = 21
+
+# Lazy properties of proc.core.Process objects that are expensive to compute
+# (they require additional reads from /proc) but never change during the
+# lifetime of a process, so they're carried over between scans.
+STATIC_PROPERTIES = ('cmdline', 'exe', 'exe_name', 'exe_path', 'user_ids')
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessSnapshot(PropertyManager):
+
+    @mutable_property
+    def proc_root(self):
+        return '/proc'
+
+    @mutable_property
+    def exe_name(self):
+        return 'apache2'
+
+    @writable_property
+    def processes(self):
+        return {}
+
+    @writable_property
+    def children(self):
+        return {}
+
+    @writable_property
+    def num_scans(self):
+        return 0
+
+    @writable_property
+    def memory_cache(self):
+        return {}
+
+    def update(self):
+        timer = Timer()
+        previous = self.processes
+        processes = {}
+        children = collections.defaultdict(list)
+        num_reused = 0
+        for entry in os.listdir(self.proc_root):
+            if entry.isdigit():
+                directory = os.path.join(self.proc_root, entry)
+                fields = parse_process_status(directory)
+                if not fields:
+                    continue
+                process = MaybeApacheWorker(directory, fields)
+                old_process = previous.get(process.pid)
+                if old_process is not None and old_process.stat_fields[STARTTIME_FIELD] == fields[STARTTIME_FIELD]:
+                    for name in STATIC_PROPERTIES:
+                        if name in old_process.__dict__:
+                            process.__dict__[name] = old_process.__dict__[name]
+                    num_reused += 1
+                processes[process.pid] = process
+                children[process.ppid].append(process)
+        self.processes = processes
+        self.children = dict(children)
+        self.memory_cache = {}
+        self.num_scans += 1
+        logger.debug("Scanned %i processes in %s (%i carried over from previous scan).",
+                     len(processes), timer, num_reused)
+
+    def get(self, pid):
+        return self.processes.get(pid)
+
+    def memory_usage(self, process, accounting=DEFAULT_ACCOUNTING):
+        if accounting == 'rss':
+            return process.rss
+        # The memory maps of a process are read at most once per scan.
+        fields = self.memory_cache.get(process.pid)
+        if fields is None:
+            fields = parse_smaps_rollup(os.path.join(self.proc_root, str(process.pid)))
+            self.memory_cache[process.pid] = fields
+        if not fields:
+            # Kernels before 4.14 don't have smaps_rollup and reading another
+            # user's memory maps requires privileges, fall back to RSS.
+            return process.rss
+        if accounting == 'pss':
+            return fields.get('Pss', 0)
+        return fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+
+    def find_apache_workers(self):
+        # This mirrors proc.apache.find_apache_workers() but uses the PID and
+        # parent PID indexes instead of building a process tree.
+        candidates = [p for p in self.children.get(1, []) if p.exe_name == self.exe_name]
+        if len(candidates) > 1:
+            candidates = [p for p in candidates if p.user_ids.real == 0]
+        if not candidates:
+            raise ApacheDaemonNotRunning("Could not find Apache master process! Is it running?")
+        master = sorted(candidates, key=lambda p: p.pid)[0]
+        return sorted((p for p in self.children.get(master.pid, []) if p.exe_path == master.exe_path),
+                      key=lambda p: p.pid)
+
+
+def parse_smaps_rollup(directory):
+    # Returns a dictionary with the memory usage totals in bytes (an empty
+    # dictionary when the file can't be read).
+    fields = {}
+    try:
+        with open(os.path.join(directory, 'smaps_rollup'), 'rb') as handle:
+            contents = handle.read()
+    except (IOError, OSError):
+        return fields
+    for line in contents.splitlines()[1:]:
+        name, _, value = line.partition(b':')
+        tokens = value.split()
+        if len(tokens) == 2 and tokens[1] == b'kB':
+            fields[name.decode('ascii')] = int(tokens[0]) * 1024
+    return fields
+
+
+def summarize_memory_usage(workers, measure=None):
+    worker_rss = StatsList()
+    wsgi_rss = collections.defaultdict(StatsList)
+    for worker in workers:
+        value = measure(worker) if measure else worker.rss
+        if worker.wsgi_process_group:
+            wsgi_rss[worker.wsgi_process_group].append(value)
+        else:
+            worker_rss.append(value)
+    return worker_rss, wsgi_rss
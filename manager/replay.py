@@ -0,0 +1,249 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import array
+import collections
+import getopt
+import itertools
+import logging
+import operator
+import os
+import struct
+import sys
+
+from humanfriendly import format_size, format_timespan, parse_size, parse_timespan
+
+from perf_moon import IDLE_MODES
+from perf_moon.exceptions import ApacheManagerError
+from perf_moon.killer import DEFAULT_BUDGET_INTERVAL
+
+DEFAULT_SNAPSHOT_FILE = '/tmp/perf-moon.snapshots'
+
+# The file is rotated (one previous generation is kept) when it grows beyond
+# this size.
+DEFAULT_MAX_SIZE = 1024 * 1024 * 64
+
+MAGIC = b'PMSNAP01'
+
+# Every frame starts with the timestamp and the number of workers, followed
+# by the columns: PIDs, modes (one byte each), SS and memory usage in bytes.
+FRAME_HEADER = struct.Struct('<dI')
+
+# Memory usage and SS are stored as -1 when unknown (e.g. for workers that
+# aren't on the scoreboard).
+MISSING = -1
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayError(ApacheManagerError):
+    pass
+
+
+class SnapshotWriter(object):
+
+    def __init__(self, path=DEFAULT_SNAPSHOT_FILE, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def append(self, timestamp, workers):
+        # Expects (pid, mode, ss, memory usage) tuples.
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_size:
+            os.rename(self.path, '%s.1' % self.path)
+        count = len(workers)
+        frame = [FRAME_HEADER.pack(timestamp, count)]
+        if count:
+            pids, modes, ss, memory = zip(*workers)
+            frame.append(struct.pack('<%ii' % count, *pids))
+            frame.append(bytes(bytearray(ord(m) if m else 0 for m in modes)))
+            frame.append(struct.pack('<%ii' % count, *(MISSING if s is None else s for s in ss)))
+            frame.append(struct.pack('<%iq' % count, *(MISSING if m is None else m for m in memory)))
+        with open(self.path, 'ab') as handle:
+            if not handle.tell():
+                handle.write(MAGIC)
+            handle.write(b''.join(frame))
+
+
+class SnapshotData(object):
+
+    # The workers of all frames, stored in flat typed columns (one entry per
+    # worker per frame) so that policies are evaluated over whole columns.
+    # PIDs are reused over hours of recordings, so a process is identified
+    # by its PID and the frame it first appeared in (a PID that's missing
+    # from a frame belongs to a new process when it reappears).
+
+    def __init__(self):
+        self.timestamps = array.array('d')
+        self.frames = array.array('l')
+        self.pids = array.array('l')
+        self.first_frames = array.array('l')
+        self.appearances = {}
+        self.active = bytearray()
+        self.ss = array.array('l')
+        self.memory = array.array('d')
+
+    def __len__(self):
+        return len(self.pids)
+
+    @classmethod
+    def load(cls, *paths):
+        data = cls()
+        for path in paths:
+            if os.path.exists(path):
+                data.read_file(path)
+        return data
+
+    def read_file(self, path):
+        idle_modes = bytearray(ord(m) for m in IDLE_MODES)
+        with open(path, 'rb') as handle:
+            contents = handle.read()
+        if contents[:len(MAGIC)] != MAGIC:
+            raise ReplayError("%s is not a perf-moon snapshot file!" % path)
+        offset = len(MAGIC)
+        while offset + FRAME_HEADER.size <= len(contents):
+            timestamp, count = FRAME_HEADER.unpack_from(contents, offset)
+            end = offset + FRAME_HEADER.size + count * 17
+            if end > len(contents):
+                # A frame that's still being written.
+                break
+            offset += FRAME_HEADER.size
+            frame = len(self.timestamps)
+            self.timestamps.append(timestamp)
+            self.frames.extend(itertools.repeat(frame, count))
+            pids = struct.unpack_from('<%ii' % count, contents, offset)
+            self.pids.extend(pids)
+            appearances = {}
+            for pid in pids:
+                first_frame, last_frame = self.appearances.get(pid, (frame, None))
+                if last_frame is not None and last_frame != frame - 1:
+                    first_frame = frame
+                appearances[pid] = (first_frame, frame)
+                self.first_frames.append(first_frame)
+            self.appearances = appearances
+            modes = bytearray(contents[offset + count * 4:offset + count * 5])
+            self.active.extend(0 if m in idle_modes else 1 for m in modes)
+            self.ss.extend(struct.unpack_from('<%ii' % count, contents, offset + count * 5))
+            self.memory.extend(struct.unpack_from('<%iq' % count, contents, offset + count * 9))
+            offset = end
+
+    @property
+    def duration(self):
+        return self.timestamps[-1] - self.timestamps[0] if len(self.timestamps) > 1 else 0
+
+
+class Policy(collections.namedtuple('Policy', 'max_memory_active, max_memory_idle, timeout, max_kills')):
+
+    __slots__ = ()
+
+    def __str__(self):
+        return ', '.join([
+            "active %s" % (format_size(self.max_memory_active) if self.max_memory_active else 'unlimited'),
+            "idle %s" % (format_size(self.max_memory_idle) if self.max_memory_idle else 'unlimited'),
+            "max SS %s" % (format_timespan(self.timeout) if self.timeout else 'unlimited'),
+        ] + (["at most %i kills/minute" % self.max_kills] if self.max_kills else []))
+
+
+class PolicyResult(object):
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.kills = 0
+        self.deferred = 0
+        self.memory_reclaimed = 0
+        self.interrupted = 0
+
+
+def replay(data, policies):
+    # Evaluates kill policies (like KillScheduler.plan()) against recorded
+    # snapshots. A worker is killed the first time it violates a policy, the
+    # later records of the same process are ignored (in reality it would be
+    # gone).
+    # The masks for each threshold value are computed once over the whole
+    # columns and shared by all policies using that value.
+    size = len(data)
+    idle = bytearray(1 - a for a in data.active)
+    masks = {}
+
+    def threshold_mask(kind, value):
+        key = (kind, value)
+        if key not in masks:
+            if kind == 'active':
+                over = map(operator.gt, data.memory, itertools.repeat(value, size))
+                masks[key] = bytearray(map(operator.and_, data.active, over))
+            elif kind == 'idle':
+                over = map(operator.gt, data.memory, itertools.repeat(value, size))
+                masks[key] = bytearray(map(operator.and_, idle, over))
+            else:
+                over = map(operator.gt, data.ss, itertools.repeat(value, size))
+                masks[key] = bytearray(map(operator.and_, data.active, over))
+        return masks[key]
+
+    results = []
+    for policy in policies:
+        mask = bytearray(size)
+        for kind, value in (('active', policy.max_memory_active),
+                            ('idle', policy.max_memory_idle),
+                            ('timeout', policy.timeout)):
+            if value:
+                mask = bytearray(map(operator.or_, mask, threshold_mask(kind, value)))
+        result = PolicyResult(policy)
+        killed = set()
+        kill_times = collections.deque()
+        for index in itertools.compress(range(size), mask):
+            process = (data.pids[index], data.first_frames[index])
+            if process in killed:
+                continue
+            if policy.max_kills:
+                timestamp = data.timestamps[data.frames[index]]
+                while kill_times and kill_times[0] <= timestamp - DEFAULT_BUDGET_INTERVAL:
+                    kill_times.popleft()
+                if len(kill_times) >= policy.max_kills:
+                    # Deferred kills are retried in the next frame.
+                    result.deferred += 1
+                    continue
+                kill_times.append(timestamp)
+            killed.add(process)
+            result.kills += 1
+            result.memory_reclaimed += max(0, data.memory[index])
+            result.interrupted += data.active[index]
+        results.append(result)
+    return results
+
+
+def generate_policies(max_memory_active=(0,), max_memory_idle=(0,), timeouts=(0,), max_kills=(0,)):
+    return [Policy(*values) for values in itertools.product(max_memory_active, max_memory_idle, timeouts, max_kills)]
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    options, arguments = getopt.getopt(sys.argv[1:], 'a:i:t:k:', [
+        'max-memory-active=', 'max-memory-idle=', 'max-ss=', 'max-kills=',
+    ])
+    grid = {}
+    for option, value in options:
+        values = value.split(',')
+        if option in ('-a', '--max-memory-active'):
+            grid['max_memory_active'] = [parse_size(v) for v in values]
+        elif option in ('-i', '--max-memory-idle'):
+            grid['max_memory_idle'] = [parse_size(v) for v in values]
+        elif option in ('-t', '--max-ss'):
+            grid['timeouts'] = [parse_timespan(v) for v in values]
+        elif option in ('-k', '--max-kills'):
+            grid['max_kills'] = [int(v) for v in values]
+    paths = arguments or ['%s.1' % DEFAULT_SNAPSHOT_FILE, DEFAULT_SNAPSHOT_FILE]
+    data = SnapshotData.load(*paths)
+    if not data.timestamps:
+        sys.stderr.write("No snapshots found in %s!\n" % ', '.join(paths))
+        sys.exit(1)
+    sys.stdout.write("Replaying %i snapshots (%i workers) covering %s.\n" % (
+        len(data.timestamps), len(data), format_timespan(data.duration),
+    ))
+    for result in sorted(replay(data, generate_policies(**grid)), key=lambda r: (r.kills, -r.memory_reclaimed)):
+        sys.stdout.write("%s: %i kills (%i interrupting requests, %i deferrals), reclaimed %s\n" % (
+            result.policy, result.kills, result.interrupted, result.deferred,
+            format_size(result.memory_reclaimed),
+        ))
+
+
+if __name__ == '__main__':
+    main()
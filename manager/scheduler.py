@@ -0,0 +1,126 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import collections
+import logging
+import os
+import random
+
+from property_manager import PropertyManager, lazy_property, mutable_property, writable_property
+
+DEFAULT_MIN_INTERVAL = 0.25
+
+DEFAULT_MAX_INTERVAL = 5
+
+# The fraction of one CPU core that collection is allowed to use.
+DEFAULT_CPU_BUDGET = 0.05
+
+DEFAULT_JITTER = 0.1
+
+# When the server calms down the interval grows by at most this factor per
+# sample (when it gets busy the interval drops to the target right away).
+BACKOFF_FACTOR = 1.5
+
+# A relative change in the request rate between samples of this size (or
+# more) counts as full activity. Below the minimum request rate changes are
+# relative to the minimum (so that a quiet server doesn't look busy when it
+# goes from one request per second to two).
+RATE_CHANGE_THRESHOLD = 0.5
+
+MIN_REQUEST_RATE = 10.0
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveScheduler(PropertyManager):
+
+    @mutable_property
+    def min_interval(self):
+        return DEFAULT_MIN_INTERVAL
+
+    @mutable_property
+    def max_interval(self):
+        return DEFAULT_MAX_INTERVAL
+
+    @mutable_property
+    def cpu_budget(self):
+        return DEFAULT_CPU_BUDGET
+
+    @mutable_property
+    def jitter(self):
+        return DEFAULT_JITTER
+
+    @writable_property
+    def interval(self):
+        return self.min_interval
+
+    @writable_property
+    def activity(self):
+        return 0.0
+
+    @writable_property
+    def collection_cost(self):
+        return 0.0
+
+    @lazy_property
+    def sample_times(self):
+        return collections.deque(maxlen=20)
+
+    @lazy_property
+    def random(self):
+        return random.Random()
+
+    @property
+    def sampling_rate(self):
+        # The actual number of samples per second (over the recent samples).
+        if len(self.sample_times) < 2:
+            return None
+        elapsed = self.sample_times[-1] - self.sample_times[0]
+        return (len(self.sample_times) - 1) / elapsed if elapsed > 0 else None
+
+    def start_sample(self):
+        return sum(os.times()[:2])
+
+    def finish_sample(self, timestamp, started, manager):
+        # Returns the number of seconds until the next sample should start.
+        self.collection_cost = max(0.0, sum(os.times()[:2]) - started)
+        self.sample_times.append(timestamp)
+        self.activity = measure_activity(manager)
+        # The interval is interpolated geometrically, so that moderate
+        # activity already polls a lot faster than an idle server.
+        target = self.min_interval * (self.max_interval / float(self.min_interval)) ** (1 - self.activity)
+        if target > self.interval:
+            target = min(target, self.interval * BACKOFF_FACTOR)
+        # The CPU time spent collecting a sample bounds the polling rate.
+        target = max(target, self.collection_cost / self.cpu_budget)
+        self.interval = target
+        # Jitter keeps many collectors started at the same time (e.g. by
+        # configuration management) from polling in lock step.
+        return target * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def metrics(self):
+        metrics = dict(sampling_interval=self.interval, sampling_cpu_seconds=self.collection_cost)
+        if self.sampling_rate is not None:
+            metrics['sampling_rate'] = self.sampling_rate
+        return metrics
+
+
+def measure_activity(manager):
+    # Returns a number between 0 (idle) and 1 (busy) based on the fraction of
+    # busy workers, hanging workers and changes in the request rate.
+    try:
+        metrics = manager.server_metrics
+        busy = metrics.get('busy_workers', 0)
+        idle = metrics.get('idle_workers', 0)
+        activity = busy / float(busy + idle) if busy + idle else 0.0
+        if manager.have_worker_details and manager.hanging_workers:
+            activity = 1.0
+        rates = manager.history.rates('total_accesses', 2)
+        if len(rates) == 2:
+            change = abs(rates[1] - rates[0]) / max(rates[0], MIN_REQUEST_RATE)
+            activity = max(activity, min(1.0, change / RATE_CHANGE_THRESHOLD))
+    except Exception as e:
+        # When Apache is unreachable there's no point in polling fast.
+        logger.debug("Failed to measure Apache activity! (%s)", e)
+        return 0.0
+    return activity
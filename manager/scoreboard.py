@@ -0,0 +1,265 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import array
+import itertools
+import logging
+import operator
+
+# Sentinel for integer fields that are missing or can't be parsed (the row
+# views translate this back to None, like WorkerStatus does).
+MISSING = -1
+
+NAN = float('nan')
+
+INTEGER_COLUMNS = ('pid', 'ss', 'req', 'acc_connection', 'acc_child', 'acc_slot', 'srv_child', 'srv_generation')
+
+FLOAT_COLUMNS = ('cpu', 'conn', 'child', 'slot')
+
+# Fields stored in typed columns, all other fields are kept as text.
+TYPED_FIELDS = ('acc', 'child', 'conn', 'cpu', 'm', 'pid', 'req', 'slot', 'srv', 'ss')
+
+# Modes of slots that aren't handling a request (a subset of IDLE_MODES
+# defined in perf_moon, which imports this module).
+IDLE_MODE_CODES = frozenset(ord(m) for m in ('_', 'I', '.')) | frozenset([0])
+
+logger = logging.getLogger(__name__)
+
+
+class Scoreboard(object):
+
+    def __init__(self, row_type):
+        self.row_type = row_type
+        self.modes = bytearray()
+        for name in INTEGER_COLUMNS:
+            setattr(self, name, array.array('l'))
+        for name in FLOAT_COLUMNS:
+            setattr(self, name, array.array('d'))
+        self.text_columns = {}
+        self.size = 0
+
+    @classmethod
+    def from_rows(cls, rows, row_type):
+        scoreboard = cls(row_type)
+        for fields in rows:
+            scoreboard.append(fields)
+        return scoreboard
+
+    def append(self, fields):
+        self.pid.append(parse_integer(fields.get('pid')))
+        self.ss.append(parse_integer(fields.get('ss', '0')))
+        self.req.append(parse_integer(fields.get('req')))
+        self.cpu.append(parse_float(fields.get('cpu', '0')))
+        self.conn.append(parse_float(fields.get('conn', '0')))
+        self.child.append(parse_float(fields.get('child', '0')))
+        self.slot.append(parse_float(fields.get('slot', '0')))
+        connection, child, slot = split_integers(fields.get('acc', '0/0/0'), '/', 3)
+        self.acc_connection.append(connection)
+        self.acc_child.append(child)
+        self.acc_slot.append(slot)
+        child, generation = split_integers(fields.get('srv', '0-0'), '-', 2)
+        self.srv_child.append(child)
+        self.srv_generation.append(generation)
+        mode = fields.get('m')
+        self.modes.append(ord(mode[0]) if mode else 0)
+        for name, value in fields.items():
+            if name not in TYPED_FIELDS:
+                column = self.text_columns.get(name)
+                if column is None:
+                    column = [None] * self.size
+                    self.text_columns[name] = column
+                column.append(value)
+        self.size += 1
+        for column in self.text_columns.values():
+            if len(column) < self.size:
+                column.append(None)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        row_type = self.row_type
+        for index in range(self.size):
+            yield row_type(self, index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.row_type(self, i) for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("Scoreboard index out of range")
+        return self.row_type(self, index)
+
+    def text(self, name, index):
+        column = self.text_columns.get(name)
+        return column[index] if column is not None else None
+
+    def mode_mask(self, modes, negate=False):
+        table = bytearray([1 if negate else 0]) * 256
+        for mode in modes:
+            table[ord(mode)] = 0 if negate else 1
+        return bytearray(self.modes.translate(bytes(table)))
+
+    def threshold_mask(self, column, threshold, compare=operator.ge):
+        return bytearray(map(compare, column, itertools.repeat(threshold, self.size)))
+
+    def take(self, indexes):
+        # Returns a new scoreboard with the typed columns of the given rows.
+        scoreboard = Scoreboard(self.row_type)
+        scoreboard.modes = bytearray(self.modes[i] for i in indexes)
+        for name in INTEGER_COLUMNS + FLOAT_COLUMNS:
+            column = getattr(self, name)
+            setattr(scoreboard, name, array.array(column.typecode, (column[i] for i in indexes)))
+        scoreboard.text_columns = dict((n, [c[i] for i in indexes]) for n, c in self.text_columns.items())
+        scoreboard.size = len(indexes)
+        return scoreboard
+
+    def select(self, *masks):
+        combined = masks[0]
+        for mask in masks[1:]:
+            combined = bytearray(map(operator.and_, combined, mask))
+        row_type = self.row_type
+        return [row_type(self, i) for i in itertools.compress(range(self.size), combined)]
+
+
+class SlotEvent(object):
+
+    # kind is one of 'mode_changed', 'request_started', 'request_finished',
+    # 'pid_replaced' or 'hanging'.
+
+    def __init__(self, kind, slot, pid, previous_pid=None, mode=None, previous_mode=None, ss=None):
+        self.kind = kind
+        self.slot = slot
+        self.pid = pid
+        self.previous_pid = previous_pid
+        self.mode = mode
+        self.previous_mode = previous_mode
+        self.ss = ss
+
+    def __repr__(self):
+        return "SlotEvent(%s, slot=%s, pid=%s)" % (self.kind, self.slot, self.pid)
+
+
+class ScoreboardTracker(object):
+
+    def __init__(self, hanging_threshold):
+        self.hanging_threshold = hanging_threshold
+        self.previous = None
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        # The callback is called with the list of events of each cycle.
+        self.subscribers.append(callback)
+
+    def reset(self):
+        # Forgets the previous scoreboard (the next update has no events).
+        self.previous = None
+
+    def update(self, scoreboard):
+        events = diff_scoreboards(self.previous, scoreboard, self.hanging_threshold) if self.previous else []
+        self.previous = scoreboard
+        if events:
+            logger.debug("Detected %i scoreboard changes.", len(events))
+        for callback in self.subscribers:
+            try:
+                callback(events)
+            except Exception as e:
+                logger.warning("Scoreboard event subscriber %r failed! (%s)", callback, e)
+        return events
+
+
+def diff_scoreboards(previous, current, hanging_threshold):
+    # Slots are identified by their server slot number and their position
+    # among the slots with that number (on the event and worker MPMs all
+    # threads of a process share the server slot number). Usually the slots
+    # are listed in the same order so the columns can be compared as they are.
+    events = []
+    if previous.srv_child != current.srv_child:
+        positions = dict(zip(slot_keys(previous), range(len(previous))))
+        pairs = []
+        for index, key in enumerate(slot_keys(current)):
+            position = positions.pop(key, None)
+            if position is None:
+                # A slot that's new in this scoreboard.
+                mode = current.modes[index]
+                if mode not in IDLE_MODE_CODES:
+                    events.append(SlotEvent('request_started', current.srv_child[index], current.pid[index],
+                                            mode=chr(mode)))
+                    if current.ss[index] >= hanging_threshold:
+                        events.append(SlotEvent('hanging', current.srv_child[index], current.pid[index],
+                                                mode=chr(mode), ss=current.ss[index]))
+            else:
+                pairs.append((position, index))
+        for position in sorted(positions.values()):
+            # A slot that's no longer in this scoreboard.
+            mode = previous.modes[position]
+            if mode not in IDLE_MODE_CODES:
+                events.append(SlotEvent('request_finished', previous.srv_child[position], previous.pid[position],
+                                        previous_mode=chr(mode)))
+        previous = previous.take([p for p, c in pairs])
+        current = current.take([c for p, c in pairs])
+    # Only the slots whose mode, PID or request counter changed (or whose
+    # SS crossed the threshold) are inspected one by one.
+    changed = bytearray(map(operator.ne, previous.modes, current.modes))
+    changed = bytearray(map(operator.or_, changed, map(operator.ne, previous.pid, current.pid)))
+    changed = bytearray(map(operator.or_, changed, map(operator.ne, previous.acc_slot, current.acc_slot)))
+    crossed = bytearray(map(operator.and_,
+                            map(operator.lt, previous.ss, itertools.repeat(hanging_threshold)),
+                            map(operator.ge, current.ss, itertools.repeat(hanging_threshold))))
+    changed = bytearray(map(operator.or_, changed, crossed))
+    for index in itertools.compress(range(len(changed)), changed):
+        slot = current.srv_child[index]
+        pid = current.pid[index]
+        old_pid = previous.pid[index]
+        mode = current.modes[index]
+        old_mode = previous.modes[index]
+        busy = mode not in IDLE_MODE_CODES
+        was_busy = old_mode not in IDLE_MODE_CODES
+        replaced = pid != old_pid and pid != MISSING and old_pid != MISSING
+        # The PID is part of the identity of a slot: a request handled by a
+        # new process is a different request, even if the counters match.
+        new_request = replaced or current.acc_slot[index] != previous.acc_slot[index]
+        mode_name = chr(mode) if mode else None
+        old_mode_name = chr(old_mode) if old_mode else None
+        if replaced:
+            events.append(SlotEvent('pid_replaced', slot, pid, previous_pid=old_pid))
+        if mode != old_mode:
+            events.append(SlotEvent('mode_changed', slot, pid, mode=mode_name, previous_mode=old_mode_name))
+        if was_busy and (not busy or new_request):
+            events.append(SlotEvent('request_finished', slot, old_pid, mode=mode_name, previous_mode=old_mode_name))
+        if busy and (not was_busy or new_request):
+            events.append(SlotEvent('request_started', slot, pid, mode=mode_name, previous_mode=old_mode_name))
+        if busy and (crossed[index] or (replaced and current.ss[index] >= hanging_threshold)):
+            events.append(SlotEvent('hanging', slot, pid, mode=mode_name, ss=current.ss[index]))
+    return events
+
+
+def slot_keys(scoreboard):
+    # Generates (server slot number, thread index) tuples.
+    counts = {}
+    for srv_child in scoreboard.srv_child:
+        thread = counts.get(srv_child, 0)
+        counts[srv_child] = thread + 1
+        yield srv_child, thread
+
+
+def parse_integer(value):
+    try:
+        return int(value)
+    except Exception:
+        return MISSING
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except Exception:
+        return NAN
+
+
+def split_integers(value, separator, count):
+    tokens = value.split(separator) if value else []
+    values = [parse_integer(t) for t in tokens[:count]]
+    values.extend([MISSING] * (count - len(values)))
+    return values
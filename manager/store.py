@@ -0,0 +1,290 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import bisect
+import json
+import logging
+import mmap
+import numbers
+import os
+import struct
+import sys
+
+from perf_moon.exceptions import ApacheManagerError
+
+DEFAULT_HISTORY_FILE = '/tmp/perf-moon.history'
+
+# The raw samples are rotated (one previous generation is kept) when the
+# file grows beyond this size.
+DEFAULT_MAX_SIZE = 1024 * 1024 * 16
+
+# Raw samples are averaged into one rollup record per interval.
+ROLLUP_INTERVAL = 60 * 5
+
+ROLLUP_SUFFIX = '.rollup'
+
+MAGIC = b'PMHIST01'
+
+# Magic, header length (including padding) and the length of the JSON schema.
+PREAMBLE = struct.Struct('<8sII')
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStoreError(ApacheManagerError):
+    pass
+
+
+class HistoryWriter(object):
+
+    def __init__(self, path=DEFAULT_HISTORY_FILE, max_size=DEFAULT_MAX_SIZE, rollup=True):
+        self.path = path
+        self.max_size = max_size
+        self.rollup = rollup
+
+    def append(self, timestamp, metrics, path=None):
+        # Records are fixed width (one double per column). Metrics missing
+        # from a sample are stored as NaN, new metrics extend the columns of
+        # the file (which means rewriting it).
+        path = path or self.path
+        names = set(n for n, v in metrics.items() if isinstance(v, numbers.Number))
+        try:
+            reader = HistoryReader.open(path)
+        except HistoryStoreError as e:
+            # The file is unusable (e.g. empty or truncated after a crash), it
+            # would otherwise break every following append.
+            logger.warning("Recreating history file %s! (%s)", path, e)
+            reader = None
+        if reader and os.path.getsize(path) >= self.max_size:
+            reader.close()
+            os.rename(path, '%s.1' % path)
+            reader = None
+        # The end of the last complete record (a record that was partially
+        # written when a previous run was interrupted is overwritten).
+        valid_size = None
+        if reader is None:
+            columns = sorted(names)
+            create_file(path, columns)
+        else:
+            columns = reader.columns
+            valid_size = reader.header_size + reader.size * reader.record_size
+            previous = reader.last_timestamp
+            if self.rollup and previous is not None and bucket(previous) != bucket(timestamp):
+                start = bucket(previous) * ROLLUP_INTERVAL
+                rows = reader.query(start, start + ROLLUP_INTERVAL)
+                if rows:
+                    self.append_rollup(start, columns, rows)
+            if not names.issubset(columns):
+                columns = sorted(names.union(columns))
+                rewrite_file(path, reader, columns)
+                valid_size = None
+            reader.close()
+        record = [timestamp] + [float(metrics[n]) if n in names else float('nan') for n in columns]
+        with open(path, 'r+b') as handle:
+            if valid_size is not None:
+                handle.truncate(valid_size)
+            handle.seek(0, os.SEEK_END)
+            handle.write(struct.pack('<%id' % len(record), *record))
+
+    def append_rollup(self, start, columns, rows):
+        averages = {}
+        for index, name in enumerate(columns):
+            values = [r[index + 1] for r in rows if r[index + 1] == r[index + 1]]
+            if values:
+                averages[name] = sum(values) / len(values)
+        writer = HistoryWriter(self.path + ROLLUP_SUFFIX, max_size=self.max_size, rollup=False)
+        writer.append(start, averages)
+
+
+class HistoryReader(object):
+
+    def __init__(self, path):
+        self.handle = open(path, 'rb')
+        try:
+            preamble = self.handle.read(PREAMBLE.size)
+            if len(preamble) != PREAMBLE.size:
+                raise HistoryStoreError("History file %s is truncated!" % path)
+            magic, header_size, schema_size = PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise HistoryStoreError("%s is not a perf-moon history file!" % path)
+            try:
+                self.columns = json.loads(self.handle.read(schema_size).decode('UTF-8'))['columns']
+            except (ValueError, KeyError, TypeError):
+                raise HistoryStoreError("History file %s has an invalid schema!" % path)
+            self.header_size = header_size
+            self.record_size = 8 * (len(self.columns) + 1)
+            size = os.fstat(self.handle.fileno()).st_size
+            # A partially written record at the end (when a writer is busy
+            # appending) is ignored.
+            self.size = (size - header_size) // self.record_size
+            self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        except Exception:
+            self.handle.close()
+            raise
+        self.view = None
+        if self.map is not None and sys.byteorder == 'little' and hasattr(memoryview, 'cast'):
+            # A flat view of the records as doubles, slicing it doesn't copy.
+            end = header_size + self.size * self.record_size
+            self.view = memoryview(self.map)[header_size:end].cast('d')
+
+    @classmethod
+    def open(cls, path):
+        # Returns None when the file doesn't exist (yet).
+        try:
+            return cls(path)
+        except (IOError, OSError):
+            return None
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        self.close()
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.handle.close()
+
+    @property
+    def last_timestamp(self):
+        return self.timestamp(self.size - 1) if self.size else None
+
+    def timestamp(self, index):
+        if self.view is not None:
+            return self.view[index * (len(self.columns) + 1)]
+        return struct.unpack_from('<d', self.map, self.header_size + index * self.record_size)[0]
+
+    def record(self, index):
+        if self.view is not None:
+            stride = len(self.columns) + 1
+            return tuple(self.view[index * stride:(index + 1) * stride])
+        return struct.unpack_from('<%id' % (len(self.columns) + 1), self.map,
+                                  self.header_size + index * self.record_size)
+
+    def locate(self, timestamp):
+        # Binary search for the index of the first record at or after the
+        # given timestamp (the records are appended in chronological order).
+        return bisect.bisect_left(TimestampIndex(self), timestamp)
+
+    def query(self, start=None, end=None):
+        first = self.locate(start) if start is not None else 0
+        last = self.locate(end) if end is not None else self.size
+        return [self.record(i) for i in range(first, last)]
+
+    def column(self, name, start=None, end=None):
+        # Returns a list of (timestamp, value) tuples, skipping missing values.
+        offset = self.columns.index(name) + 1
+        first = self.locate(start) if start is not None else 0
+        last = self.locate(end) if end is not None else self.size
+        if self.view is not None:
+            stride = len(self.columns) + 1
+            timestamps = self.view[first * stride:last * stride:stride].tolist()
+            values = self.view[first * stride + offset:last * stride:stride].tolist()
+        else:
+            records = self.query(start, end)
+            timestamps = [r[0] for r in records]
+            values = [r[offset] for r in records]
+        return [(t, v) for t, v in zip(timestamps, values) if v == v]
+
+
+class TimestampIndex(object):
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, index):
+        return self.reader.timestamp(index)
+
+
+def create_file(path, columns):
+    schema = json.dumps(dict(columns=columns)).encode('UTF-8')
+    # The header is padded so that the records are aligned on doubles.
+    header_size = PREAMBLE.size + len(schema)
+    header_size += -header_size % 8
+    header = PREAMBLE.pack(MAGIC, header_size, len(schema)) + schema
+    with open(path, 'wb') as handle:
+        handle.write(header + b'\0' * (header_size - len(header)))
+    logger.debug("Created history file %s with %i columns.", path, len(columns))
+
+
+def rewrite_file(path, reader, columns):
+    temporary_file = '%s.tmp' % path
+    create_file(temporary_file, columns)
+    mapping = [reader.columns.index(n) + 1 if n in reader.columns else None for n in columns]
+    nan = float('nan')
+    with open(temporary_file, 'ab') as handle:
+        for record in reader.query():
+            values = [record[0]] + [record[i] if i else nan for i in mapping]
+            handle.write(struct.pack('<%id' % len(values), *values))
+    os.rename(temporary_file, path)
+    logger.debug("Extended history file %s to %i columns.", path, len(columns))
+
+
+def flatten_metrics(server_metrics, manager_metrics, memory_groups):
+    metrics = dict(server_metrics)
+    metrics.update(manager_metrics)
+    for group_name, memory_usage in memory_groups.items():
+        metrics['memory_usage.%s.count' % group_name] = len(memory_usage)
+        if memory_usage:
+            for statistic in ('min', 'max', 'average', 'median'):
+                metrics['memory_usage.%s.%s' % (group_name, statistic)] = getattr(memory_usage, statistic)
+    return metrics
+
+
+def query_history(path, start=None, end=None, names=None):
+    # Returns a dictionary with lists of (timestamp, value) tuples, including
+    # the previous generation of the file when the range reaches back into it.
+    # The part of the range before the oldest raw sample is answered from the
+    # rollup file (one average per ROLLUP_INTERVAL).
+    raw_series, oldest = read_series(['%s.1' % path, path], start, end, names)
+    series = {}
+    if start is None or oldest is None or start < oldest:
+        # Rollup records are stamped with the start of their interval, the
+        # interval that overlaps with the raw samples is left out.
+        rollup_end = bucket(oldest) * ROLLUP_INTERVAL if oldest is not None else end
+        if end is not None and rollup_end is not None:
+            rollup_end = min(rollup_end, end)
+        rollup_path = path + ROLLUP_SUFFIX
+        series, _ = read_series(['%s.1' % rollup_path, rollup_path], start, rollup_end, names)
+    for name, samples in raw_series.items():
+        series.setdefault(name, []).extend(samples)
+    return series
+
+
+def read_series(filenames, start=None, end=None, names=None):
+    # Returns the series from the given files (oldest first) and the
+    # timestamp of the oldest record in those files.
+    series = {}
+    oldest = None
+    for filename in filenames:
+        try:
+            reader = HistoryReader.open(filename)
+        except HistoryStoreError as e:
+            logger.warning("Skipping history file %s! (%s)", filename, e)
+            continue
+        if reader is None:
+            continue
+        with reader:
+            if reader.size and oldest is None:
+                oldest = reader.timestamp(0)
+            if reader.size and (end is None or reader.timestamp(0) < end) and \
+                    (start is None or reader.last_timestamp >= start):
+                for name in (names or reader.columns):
+                    if name in reader.columns:
+                        series.setdefault(name, []).extend(reader.column(name, start, end))
+    return series, oldest
+
+
+def bucket(timestamp):
+    return int(timestamp // ROLLUP_INTERVAL)
@@ -0,0 +1,952 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import json
+import os
+import re
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+from proc.apache import StatsList
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.http_client import HTTPConnection
+
+from perf_moon import STATUS_COLUMNS, ApacheManager, ScoreboardRow, WorkerStatus
+from perf_moon.activity import UTIME_FIELD
+from perf_moon.aggregator import MAX_BATCH_SIZE, MergeableSummary, MetricsAggregator, decode_batch, encode_batch
+from perf_moon.benchmarks import (
+    FIRST_PID,
+    FakeProcTree,
+    benchmark_parsers,
+    benchmark_pipeline,
+    compare_results,
+    generate_html_status,
+    generate_text_status,
+)
+from perf_moon.exceptions import StatusPageError
+from perf_moon.killer import KillScheduler
+from perf_moon.parsers import STATUS_PARSERS, normalize_text, parse_status_page, parse_text_status
+from perf_moon.processes import STARTTIME_FIELD, ProcessSnapshot
+from perf_moon.scoreboard import Scoreboard, diff_scoreboards
+from perf_moon.store import ROLLUP_INTERVAL, ROLLUP_SUFFIX, HistoryReader, HistoryWriter, query_history
+from perf_moon.transport import ConnectionPool
+
+REQUIRED_COLUMNS = [normalize_text(c) for c in STATUS_COLUMNS]
+
+
+def make_scoreboard(slots, threads=1):
+    # Creates a scoreboard from (mode, pid, accesses, ss) tuples, consecutive
+    # slots share a server slot number when there's more than one thread.
+    rows = []
+    for index, (mode, pid, accesses, ss) in enumerate(slots):
+        rows.append({
+            'srv': '%i-0' % (index // threads),
+            'pid': str(pid) if pid else '-',
+            'acc': '0/0/%i' % accesses,
+            'm': mode,
+            'ss': str(ss),
+        })
+    return Scoreboard.from_rows(rows, row_type=ScoreboardRow)
+
+
+def event_kinds(events):
+    return sorted((e.kind, e.slot, e.pid) for e in events)
+
+
+def make_worker(pid, mode='W', memory_usage=None, ss=0):
+    return WorkerStatus(status_fields=dict(pid=str(pid), m=mode, ss=str(ss)), memory_usage=memory_usage)
+
+
+def update_stat_field(proc_tree, pid, index, function):
+    # Changes a field of /proc/[pid]/stat in a fake /proc tree.
+    filename = os.path.join(proc_tree.directory, str(pid), 'stat')
+    with open(filename) as handle:
+        fields = handle.read().split()
+    fields[index] = str(function(int(fields[index])))
+    with open(filename, 'w') as handle:
+        handle.write(' '.join(fields) + '\n')
+
+
+def set_resident_pages(proc_tree, pid, pages):
+    update_stat_field(proc_tree, pid, 23, lambda value: pages)
+
+
+def add_cpu_time(proc_tree, pid, ticks):
+    update_stat_field(proc_tree, pid, UTIME_FIELD, lambda value: value + ticks)
+
+
+class WebServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    # Serves (status, headers, body) tuples by path, callables are called to
+    # produce the response of each request.
+
+    daemon_threads = True
+
+    def __init__(self, responses=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), WebRequestHandler)
+        self.responses = responses or {}
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs=dict(poll_interval=0.01))
+        self.thread.daemon = True
+
+    def url(self, path='/'):
+        return 'http://%s:%i%s' % (self.server_address[0], self.server_address[1], path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        self.shutdown()
+        self.server_close()
+
+
+class WebRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        response = self.server.responses.get(self.path, (404, {}, b'Not Found'))
+        status, headers, body = response() if callable(response) else response
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ManagerTestCase(unittest.TestCase):
+
+    # Runs ApacheManager against stubbed status pages and a fake /proc tree
+    # (one process per slot of the status page).
+
+    num_workers = 8
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = WebServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.proc_tree = FakeProcTree(self.num_workers).__enter__()
+        self.addCleanup(self.proc_tree.__exit__)
+        self.set_status_pages(generate_html_status(self.num_workers), generate_text_status(self.num_workers))
+
+    def set_status_pages(self, html_status, text_status):
+        # Pages that are None are answered with "503 Service Unavailable".
+        for path, body in (('/server-status', html_status), ('/server-status?auto', text_status)):
+            self.server.responses[path] = (200, {}, body) if body is not None else (503, {}, b'Busy')
+
+    @property
+    def pool(self):
+        pool = self.__dict__.get('connection_pool')
+        if pool is None:
+            pool = self.__dict__['connection_pool'] = ConnectionPool()
+            self.addCleanup(pool.close)
+        return pool
+
+    def create_manager(self, **options):
+        options.setdefault('html_status_url', self.server.url('/server-status'))
+        options.setdefault('config_cache', None)
+        options.setdefault('process_snapshot', ProcessSnapshot(proc_root=self.proc_tree.directory))
+        manager = ApacheManager(**options)
+        self.addCleanup(manager.connection_pool.close)
+        return manager
+
+    def read_data_file(self, manager):
+        data_file = os.path.join(self.directory, 'metrics.txt')
+        manager.save_metrics(data_file)
+        with open(data_file) as handle:
+            lines = [line.split('\t') for line in handle if line.strip() and not line.startswith('#')]
+        return dict(('/'.join(tokens[:-1]), tokens[-1].strip()) for tokens in lines)
+
+
+class ParserTestCase(unittest.TestCase):
+
+    def test_parsers_agree(self):
+        html = generate_html_status(50)
+        results = [parse_status_page(html, REQUIRED_COLUMNS, parser=p) for p in sorted(STATUS_PARSERS)]
+        assert len(results[0]) == 50
+        for rows in results[1:]:
+            assert rows == results[0]
+
+    def test_parsed_fields(self):
+        rows = parse_status_page(generate_html_status(3), REQUIRED_COLUMNS)
+        assert [r['srv'] for r in rows] == ['0-0', '1-0', '2-0']
+        assert [r['pid'] for r in rows] == [str(FIRST_PID + i) for i in range(3)]
+        assert all(r['request'] and r['vhost'] == 'www.example.com:80' for r in rows)
+
+    def test_threaded_scoreboard(self):
+        rows = parse_status_page(generate_html_status(8, threads=4), REQUIRED_COLUMNS)
+        assert [r['srv'] for r in rows] == ['0-0'] * 4 + ['1-0'] * 4
+        assert len(set(r['pid'] for r in rows)) == 2
+
+    def test_entities_and_markup(self):
+        html = (b'<table><tr><th>Srv</th><th>PID</th><th>Acc</th><th>M</th><th>Request</th></tr>'
+                b'<tr><td><b>0-0</b></td><td>42</td><td>0/1/1</td><td><b>W</b></td>'
+                b'<td>GET /?a=1&amp;b=&lt;2&gt; HTTP/1.1</td></tr></table>')
+        for parser in sorted(STATUS_PARSERS):
+            rows = parse_status_page(html, ['srv', 'pid'], parser=parser)
+            assert rows[0]['srv'] == '0-0'
+            assert rows[0]['m'] == 'W'
+            assert rows[0]['request'] == 'GET /?a=1&b=<2> HTTP/1.1'
+
+    def test_missing_columns(self):
+        assert parse_status_page(b'<table><tr><th>Foo</th></tr><tr><td>1</td></tr></table>', ['srv']) == []
+
+    def test_unknown_parser(self):
+        self.assertRaises(ValueError, parse_status_page, b'', REQUIRED_COLUMNS, parser='nonexistent')
+
+    def test_text_status(self):
+        fields = parse_text_status(generate_text_status(16).decode('UTF-8'))
+        assert fields['busy_workers'] + fields['idle_workers'] == sum(1 for m in fields['scoreboard'] if m != '.')
+        assert fields['total_accesses'] == 16 * 250
+        assert isinstance(fields['req_per_sec'], float)
+        assert len(fields['scoreboard']) == 16
+
+
+class ScoreboardTestCase(unittest.TestCase):
+
+    def test_unchanged(self):
+        slots = [('W', 100, 1, 0), ('_', 101, 1, 0)]
+        assert diff_scoreboards(make_scoreboard(slots), make_scoreboard(slots), 60) == []
+
+    def test_request_lifecycle(self):
+        previous = make_scoreboard([('_', 100, 1, 0), ('W', 101, 1, 0), ('W', 102, 1, 0)])
+        current = make_scoreboard([('W', 100, 2, 0), ('_', 101, 1, 0), ('W', 102, 2, 0)])
+        kinds = [(k, s) for k, s, p in event_kinds(diff_scoreboards(previous, current, 60))]
+        assert ('request_started', 0) in kinds
+        assert ('request_finished', 1) in kinds
+        # A new request on a busy slot finishes the old one.
+        assert ('request_finished', 2) in kinds and ('request_started', 2) in kinds
+
+    def test_hanging(self):
+        previous = make_scoreboard([('W', 100, 1, 59)])
+        current = make_scoreboard([('W', 100, 1, 60)])
+        assert event_kinds(diff_scoreboards(previous, current, 60)) == [('hanging', 0, 100)]
+        # The event is only emitted when the threshold is crossed.
+        assert diff_scoreboards(current, make_scoreboard([('W', 100, 1, 61)]), 60) == []
+
+    def test_pid_replaced(self):
+        previous = make_scoreboard([('W', 100, 1, 0)])
+        current = make_scoreboard([('W', 200, 1, 0)])
+        events = diff_scoreboards(previous, current, 60)
+        assert [e.previous_pid for e in events if e.kind == 'pid_replaced'] == [100]
+        assert ('request_finished', 0, 100) in event_kinds(events)
+        assert ('request_started', 0, 200) in event_kinds(events)
+
+    def test_threaded_slots(self):
+        # Threads share the server slot number, each thread is a slot.
+        previous = make_scoreboard([('_', 100, 1, 0), ('W', 100, 1, 0), ('_', 101, 1, 0), ('_', 101, 1, 0)], 2)
+        current = make_scoreboard([('W', 100, 2, 0), ('W', 100, 1, 0), ('_', 101, 1, 0), ('_', 101, 1, 0)], 2)
+        assert event_kinds(diff_scoreboards(previous, current, 60)) == [
+            ('mode_changed', 0, 100),
+            ('request_started', 0, 100),
+        ]
+
+    def test_slots_added_and_removed(self):
+        previous = make_scoreboard([('W', 100, 1, 0), ('_', 100, 1, 0), ('W', 101, 1, 0), ('_', 101, 1, 0)], 2)
+        # The second process exited and a third one (already busy) appeared.
+        rows = [('W', 100, 1, 0), ('_', 100, 1, 0), ('W', 102, 1, 90), ('_', 102, 1, 0)]
+        current = make_scoreboard(rows, 2)
+        current.srv_child[2] = current.srv_child[3] = 2
+        assert event_kinds(diff_scoreboards(previous, current, 60)) == [
+            ('hanging', 2, 102),
+            ('request_finished', 1, 101),
+            ('request_started', 2, 102),
+        ]
+
+
+class KillSchedulerTestCase(unittest.TestCase):
+
+    def test_memory_limits(self):
+        workers = [
+            make_worker(1, 'W', memory_usage=150),
+            make_worker(2, '_', memory_usage=150),
+            make_worker(3, '_', memory_usage=50),
+        ]
+        victims = KillScheduler().plan(workers, max_memory_active=200, max_memory_idle=100)
+        assert [(v.worker.pid, v.reason, v.excess) for v in victims] == [(2, 'memory', 50)]
+
+    def test_priority(self):
+        workers = [
+            make_worker(1, 'W', ss=90),
+            make_worker(2, '_', memory_usage=110),
+            make_worker(3, '_', memory_usage=300),
+            make_worker(4, '_', memory_usage=50),
+            make_worker(1, 'W', ss=90),
+        ]
+        victims = KillScheduler().plan(workers, max_memory_idle=100, timeout=60, timed_out=[1],
+                                       projections={4: 500})
+        # Memory kills come first (largest excess first), duplicates are ignored.
+        assert [(v.worker.pid, v.reason) for v in victims] == [
+            (3, 'memory'),
+            (2, 'memory'),
+            (1, 'timeout'),
+            (4, 'growth'),
+        ]
+        assert victims[2].excess == 30
+
+    def test_growth_only_idle(self):
+        workers = [make_worker(1, 'W', memory_usage=10), make_worker(2, '_', memory_usage=10)]
+        victims = KillScheduler().plan(workers, max_memory_active=100, projections={1: 200, 2: 200})
+        assert [v.worker.pid for v in victims] == [2]
+
+    def test_budget(self):
+        scheduler = KillScheduler(max_kills=3, budget_interval=60)
+        scheduler.kill_times.extend([time.time() - 120, time.time() - 10])
+        workers = [make_worker(i, '_', memory_usage=100 + i) for i in range(1, 5)]
+        victims = scheduler.plan(workers, max_memory_idle=100)
+        assert scheduler.remaining_budget == 2
+        assert [(v.worker.pid, v.outcome) for v in victims] == [(4, None), (3, None), (2, 'deferred'), (1, 'deferred')]
+
+    def test_dry_run(self):
+        victims = KillScheduler().plan([make_worker(1, '_', memory_usage=200)], max_memory_idle=100)
+        KillScheduler().execute(victims, dry_run=True)
+        assert victims[0].outcome == 'simulated'
+
+
+class HistoryStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_query(self):
+        writer = HistoryWriter(self.path, rollup=False)
+        for i in range(10):
+            writer.append(1000 + i, dict(busy_workers=i, idle_workers=10 - i, label='ignored'))
+        with HistoryReader(self.path) as reader:
+            assert len(reader) == 10
+            assert reader.columns == ['busy_workers', 'idle_workers']
+            assert reader.column('busy_workers', 1003, 1006) == [(1003, 3), (1004, 4), (1005, 5)]
+        assert query_history(self.path, names=['idle_workers'])['idle_workers'][-1] == (1009, 1)
+
+    def test_new_columns(self):
+        writer = HistoryWriter(self.path, rollup=False)
+        writer.append(1000, dict(busy_workers=1))
+        writer.append(1001, dict(busy_workers=2, idle_workers=3))
+        with HistoryReader(self.path) as reader:
+            assert reader.columns == ['busy_workers', 'idle_workers']
+            assert reader.column('idle_workers') == [(1001, 3)]
+            assert reader.column('busy_workers') == [(1000, 1), (1001, 2)]
+
+    def test_rotation(self):
+        writer = HistoryWriter(self.path, max_size=512, rollup=False)
+        for i in range(100):
+            writer.append(1000 + i, dict(busy_workers=i))
+        assert os.path.isfile(self.path + '.1')
+        samples = query_history(self.path)['busy_workers']
+        assert samples == sorted(samples) and samples[-1] == (1099, 99)
+        with HistoryReader(self.path + '.1') as previous, HistoryReader(self.path) as current:
+            assert len(samples) == len(previous) + len(current)
+
+    def test_rollup(self):
+        writer = HistoryWriter(self.path)
+        start = 1000 * ROLLUP_INTERVAL
+        for i in range(3 * ROLLUP_INTERVAL // 60):
+            writer.append(start + i * 60, dict(busy_workers=i))
+        with HistoryReader(self.path + ROLLUP_SUFFIX) as reader:
+            assert [t for t, v in reader.column('busy_workers')] == [start, start + ROLLUP_INTERVAL]
+            assert reader.column('busy_workers')[0][1] == 2.0
+        # Once the raw samples are gone, older periods come from the rollup.
+        os.unlink(self.path)
+        writer.append(start + 3 * ROLLUP_INTERVAL, dict(busy_workers=42))
+        assert query_history(self.path, start=start)['busy_workers'] == [
+            (start, 2.0),
+            (start + ROLLUP_INTERVAL, 7.0),
+            (start + 3 * ROLLUP_INTERVAL, 42),
+        ]
+
+    def test_partial_record(self):
+        writer = HistoryWriter(self.path, rollup=False)
+        writer.append(1000, dict(busy_workers=1))
+        with open(self.path, 'ab') as handle:
+            handle.write(struct.pack('<d', 1001))
+        with HistoryReader(self.path) as reader:
+            assert len(reader) == 1
+        writer.append(1002, dict(busy_workers=3))
+        with HistoryReader(self.path) as reader:
+            assert reader.column('busy_workers') == [(1000, 1), (1002, 3)]
+
+    def test_corrupt_file(self):
+        for contents in (b'', b'PMHIST01', b'not a history file at all'):
+            with open(self.path, 'wb') as handle:
+                handle.write(contents)
+            assert query_history(self.path) == {}
+            HistoryWriter(self.path, rollup=False).append(1000, dict(busy_workers=1))
+            with HistoryReader(self.path) as reader:
+                assert reader.column('busy_workers') == [(1000, 1)]
+
+
+class AggregatorTestCase(unittest.TestCase):
+
+    def test_merge_matches_combined(self):
+        first = [i * 1024 ** 2 for i in range(10, 200, 3)]
+        second = [i * 1024 ** 2 for i in range(50, 400, 7)] + [0]
+        merged = MergeableSummary.from_values(first)
+        merged.merge(MergeableSummary.from_values(second))
+        combined = MergeableSummary.from_values(first + second)
+        assert merged.to_dict() == combined.to_dict()
+        assert merged.count == len(first) + len(second)
+        assert merged.min == 0 and merged.max == max(second)
+        values = sorted(first + second)
+        for percent in (50, 90, 99):
+            exact = values[int(round((len(values) - 1) * percent / 100.0))]
+            assert abs(merged.percentile(percent) - exact) <= exact * 0.05
+
+    def test_merge_empty(self):
+        summary = MergeableSummary()
+        summary.merge(MergeableSummary())
+        assert summary.count == 0 and summary.percentile(50) is None
+        summary.merge(MergeableSummary.from_values([5]))
+        assert summary.min == summary.max == 5 and summary.percentile(50) == 5
+
+    def test_serialization(self):
+        summary = MergeableSummary.from_values([1, 10, 100, 1000])
+        assert MergeableSummary.from_dict(summary.to_dict()).to_dict() == summary.to_dict()
+
+    def test_accuracy_mismatch(self):
+        self.assertRaises(ValueError, MergeableSummary(0.01).merge, MergeableSummary(0.02))
+
+    def test_expiry(self):
+        report = dict(timestamp=0, server_metrics=dict(busy_workers=2), manager_metrics={}, memory_usage={})
+        aggregator = MetricsAggregator(expiry=10)
+        # The clock of the agent doesn't matter, only when reports arrive.
+        aggregator.ingest('web1', [report], now=1000)
+        assert aggregator.aggregate(now=1005)[0]['busy_workers'] == 2
+        metrics = aggregator.aggregate(now=1020)[0]
+        assert 'busy_workers' not in metrics and metrics['hosts_stale'] == 1
+        assert aggregator.aggregate(now=1000 + 11 * 10)[0]['hosts_total'] == 0
+
+    def test_batches(self):
+        assert decode_batch(encode_batch('web1', [1, 2])) == ('web1', [1, 2])
+        self.assertRaises(ValueError, decode_batch, zlib.compress(b' ' * (MAX_BATCH_SIZE + 1)))
+
+
+class ActivityTestCase(ManagerTestCase):
+
+    def test_busy_periods_carry_over(self):
+        # A one-shot run (like from cron) reports the metrics with the status
+        # page available and saves the state of the activity tracker.
+        activity_file = os.path.join(self.directory, 'activity')
+        manager = self.create_manager(activity_file=activity_file)
+        self.read_data_file(manager)
+        busy = dict((w.pid, w.ss) for w in manager.slots if w.is_active)
+        assert busy
+        # The next run can't fetch the status page, the busy workers are
+        # still using CPU time so their busy periods continue.
+        self.set_status_pages(None, generate_text_status(self.num_workers))
+        for pid in busy:
+            add_cpu_time(self.proc_tree, pid, 10)
+        manager = self.create_manager(activity_file=activity_file)
+        metrics = self.read_data_file(manager)
+        assert metrics['fallback-slots'] == str(self.num_workers + 4)
+        fallback = dict((w.pid, w.ss) for w in manager.slots)
+        for pid, ss in busy.items():
+            assert fallback[pid] >= ss
+        # Workers that didn't use CPU time are idle.
+        assert all(fallback[w] == 0 for w in fallback if w not in busy)
+
+
+class GrowthTestCase(ManagerTestCase):
+
+    def test_growing_idle_worker_is_recycled(self):
+        manager = self.create_manager(growth_horizon=3600)
+        pid = [w.pid for w in manager.slots if not w.is_active][0]
+        limit = 1024 ** 3
+        for i in range(4):
+            manager.refresh()
+            set_resident_pages(self.proc_tree, pid, 4096 * (i + 1))
+            manager.apache_workers
+            time.sleep(0.01)
+        manager.kill_workers(max_memory_active=limit, max_memory_idle=limit, horizon=3600, dry_run=True)
+        assert [(v.worker.pid, v.reason, v.outcome) for v in manager.kill_results] == [(pid, 'growth', 'simulated')]
+
+    def test_projections(self):
+        manager = self.create_manager(growth_horizon=60)
+        pid = FIRST_PID
+        for i in range(3):
+            manager.refresh()
+            set_resident_pages(self.proc_tree, pid, 1024 * (i + 1))
+            manager.apache_workers
+            time.sleep(0.01)
+        projections = manager.growth_tracker.projections(manager.apache_workers, 60)
+        # Only the growing worker is projected, beyond its current usage.
+        assert list(projections) == [pid]
+        assert projections[pid] > manager.process_snapshot.processes[pid].rss
+
+    def test_not_tracked_without_horizon(self):
+        manager = self.create_manager()
+        manager.apache_workers
+        assert len(manager.growth_tracker) == 0
+
+    def test_command_line_requirements(self):
+        from perf_moon.cli import main
+        saved_argv = sys.argv
+        try:
+            for arguments in (['--growth-horizon=1h', '--max-memory-active=1G'], ['--growth-horizon=1h', '--daemon']):
+                sys.argv = ['perf-moon'] + arguments
+                self.assertRaises(SystemExit, main)
+        finally:
+            sys.argv = saved_argv
+
+
+class DaemonTestCase(ManagerTestCase):
+
+    def test_ticks(self):
+        from perf_moon.daemon import CollectorDaemon
+        snapshots = []
+        data_file = os.path.join(self.directory, 'metrics.txt')
+        collector = CollectorDaemon(manager=self.create_manager(), data_file=data_file, interval=0.01)
+        collector.subscribe(snapshots.append)
+        collector.run(max_ticks=2)
+        assert len(snapshots) == 2
+        expected = parse_text_status(generate_text_status(self.num_workers).decode('UTF-8'))
+        assert snapshots[-1].server_metrics['busy_workers'] == expected['busy_workers']
+        assert os.path.isfile(data_file)
+
+    def test_survives_errors(self):
+        from perf_moon.daemon import CollectorDaemon
+        # Neither an unwritable data file nor an unreachable status page end
+        # the daemon.
+        data_file = os.path.join(self.directory, 'missing', 'metrics.txt')
+        collector = CollectorDaemon(manager=self.create_manager(), data_file=data_file)
+        collector.tick()
+        assert collector.snapshot is not None
+        self.set_status_pages(None, None)
+        collector.tick()
+        collector.tick()
+
+
+def format_text_status(fields):
+    return ''.join('%s: %s\n' % (n, v) for n, v in sorted(fields.items())).encode('UTF-8')
+
+
+BUSY_INSTANCE = {
+    'Total Accesses': 9000, 'BytesPerReq': 1000.0, 'DurationPerReq': 10.0, 'BusyWorkers': 10, 'IdleWorkers': 5,
+    'ReqPerSec': 9.0, 'Uptime': 1000, 'CPULoad': 4.0, 'ParentServerConfigGeneration': 3, 'Scoreboard': 'W_',
+}
+
+IDLE_INSTANCE = {
+    'Total Accesses': 1000, 'BytesPerReq': 5000.0, 'DurationPerReq': 100.0, 'BusyWorkers': 1, 'IdleWorkers': 14,
+    'ReqPerSec': 1.0, 'Uptime': 500, 'CPULoad': 2.0, 'ParentServerConfigGeneration': 2, 'Scoreboard': '__',
+}
+
+
+class FleetTestCase(unittest.TestCase):
+
+    def check_combined(self, metrics):
+        assert metrics['busy_workers'] == 11
+        assert metrics['requests_per_second'] == 10.0
+        # Per request averages are weighted by the number of requests.
+        assert metrics['bytes_per_request'] == 1400.0
+        assert metrics['duration_per_req'] == 19.0
+        assert metrics['cpu_load'] == 3.0
+        assert metrics['uptime'] == 500
+        # Adding up configuration generations is meaningless.
+        assert 'parent_server_config_generation' not in metrics
+        assert metrics['parent_server_config_generation_min'] == 2
+        assert metrics['parent_server_config_generation_max'] == 3
+
+    def poll_fleet(self):
+        from perf_moon.fleet import ApacheFleet
+        responses = {
+            '/busy?auto': (200, {}, format_text_status(BUSY_INSTANCE)),
+            '/idle?auto': (200, {}, format_text_status(IDLE_INSTANCE)),
+        }
+        with WebServer(responses) as server:
+            fleet = ApacheFleet(targets=[server.url('/busy'), server.url('/idle'), server.url('/missing')])
+            try:
+                fleet.aggregated_metrics
+            finally:
+                fleet.connection_pool.close()
+        return fleet
+
+    def test_fleet(self):
+        fleet = self.poll_fleet()
+        self.check_combined(fleet.aggregated_metrics)
+        assert fleet.aggregated_metrics['targets_total'] == 3
+        assert len(fleet.failed_targets) == 1 and fleet.failed_targets[0].endswith('/missing')
+
+    def test_aggregator(self):
+        aggregator = MetricsAggregator()
+        for url, metrics in self.poll_fleet().server_metrics.items():
+            report = dict(server_metrics=metrics, manager_metrics=dict(workers_killed_active=1), memory_usage={})
+            aggregator.ingest(url, [dict(report, timestamp=time.time())])
+        metrics = aggregator.aggregate()[0]
+        self.check_combined(metrics)
+        assert metrics['workers_killed_active'] == 2
+        assert metrics['hosts_total'] == 2
+
+
+class ServerMetricsTestCase(ManagerTestCase):
+
+    def test_key_mapping(self):
+        metrics = self.create_manager().server_metrics
+        fields = parse_text_status(generate_text_status(self.num_workers).decode('UTF-8'))
+        assert metrics['total_accesses'] == fields['total_accesses']
+        assert metrics['total_traffic'] == fields['total_kbytes'] * 1024
+        assert metrics['requests_per_second'] == fields['req_per_sec']
+        assert metrics['bytes_per_request'] == fields['bytes_per_req']
+        # Fields without a historical name are reported by their own name,
+        # text fields (like the server version) are left out.
+        assert metrics['duration_per_req'] == fields['duration_per_req']
+        assert 'server_version' not in metrics and 'total_kbytes' not in metrics
+        scoreboard = fields['scoreboard']
+        assert metrics['slots_waiting'] == scoreboard.count('_')
+        assert metrics['slots_sending'] == scoreboard.count('W')
+        assert sum(v for n, v in metrics.items() if n.startswith('slots_')) == len(scoreboard)
+
+    def test_missing_fields(self):
+        self.set_status_pages(None, b'Total Accesses: 10\nScoreboard: __W\n')
+        metrics = self.create_manager().server_metrics
+        assert metrics['total_accesses'] == 10
+        assert metrics['busy_workers'] == 0 and metrics['uptime'] == 0
+        assert metrics['slots_sending'] == 1
+
+
+class CollectionModeTestCase(ManagerTestCase):
+
+    def test_full_mode(self):
+        manager = self.create_manager()
+        metrics = self.read_data_file(manager)
+        assert '/server-status' in self.server.requests
+        hanging = sum(1 for w in manager.slots if w.is_active and w.ss >= 300)
+        assert metrics['workers-hanging'] == str(hanging)
+        assert metrics['workers-recycled'] == '0'
+        assert metrics['fallback-slots'] == '0'
+        assert metrics['memory-usage/native/count'] == str(self.num_workers)
+
+    def test_lean_mode(self):
+        # Only the plain text status page is fetched, so the metrics that
+        # need per-PID details are left out.
+        manager = self.create_manager(collection_mode='lean')
+        metrics = self.read_data_file(manager)
+        assert self.server.requests == ['/server-status?auto']
+        assert 'workers-hanging' not in metrics and 'workers-recycled' not in metrics
+        assert metrics['busy-workers'] == str(manager.server_metrics['busy_workers'])
+        assert metrics['memory-usage/native/count'] == str(self.num_workers)
+
+    def test_lean_kills(self):
+        manager = self.create_manager(collection_mode='lean')
+        limit = 1024 ** 3
+        # A single memory threshold doesn't need the HTML status page.
+        manager.kill_workers(max_memory_active=limit, max_memory_idle=limit, dry_run=True)
+        assert '/server-status' not in self.server.requests
+        assert not manager.have_worker_details
+        # A timeout does, after which the details are reported as well.
+        manager.refresh()
+        manager.kill_workers(max_memory_active=limit, max_memory_idle=limit, timeout=60, dry_run=True)
+        assert '/server-status' in self.server.requests
+        assert 'workers_hanging' in manager.manager_metrics
+
+
+APACHE_CONFIG = """
+ServerRoot "%(root)s"
+LoadModule status_module /usr/lib/apache2/modules/mod_status.so
+Include ports.conf
+IncludeOptional sites-enabled/*.conf
+<IfModule ssl_module>
+    Listen 443
+</IfModule>
+"""
+
+PORTS_CONFIG = """
+Listen 8080
+Listen 0.0.0.0:8081
+"""
+
+SITE_CONFIG = """
+<VirtualHost *:8081>
+    <IfModule mod_status.c>
+        <Location "/status">
+            SetHandler server-status
+        </Location>
+    </IfModule>
+    <IfModule !mod_status.c>
+        <Location /disabled>
+            SetHandler server-status
+        </Location>
+    </IfModule>
+</VirtualHost>
+"""
+
+
+class ConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config_file = os.path.join(self.directory, 'apache2.conf')
+        # The directory of the configuration is stamped, so the cache lives
+        # somewhere else.
+        os.mkdir(os.path.join(self.directory, 'cache'))
+        self.cache_file = os.path.join(self.directory, 'cache', 'config-cache')
+        os.mkdir(os.path.join(self.directory, 'sites-enabled'))
+        self.write_config('apache2.conf', APACHE_CONFIG % dict(root=self.directory))
+        self.write_config('ports.conf', PORTS_CONFIG)
+        self.write_config('sites-enabled/status.conf', SITE_CONFIG)
+
+    def write_config(self, filename, contents):
+        with open(os.path.join(self.directory, filename), 'w') as handle:
+            handle.write(contents)
+
+    def create_manager(self):
+        return ApacheManager(config_file=self.config_file, config_cache=self.cache_file)
+
+    def test_discovery(self):
+        manager = self.create_manager()
+        # The SSL module isn't loaded, the status module is.
+        assert [a.port for a in manager.listen_addresses] == [8080, 8081]
+        assert manager.html_status_url == 'http://127.0.0.1:8081/status'
+        assert manager.text_status_url == 'http://127.0.0.1:8081/status?auto'
+        # The handler is only configured in the virtual host on port 8081.
+        assert manager.status_urls == ['http://127.0.0.1:8081/status']
+
+    def test_cache_invalidation(self):
+        assert len(self.create_manager().listen_addresses) == 2
+        assert os.path.isfile(self.cache_file)
+        # A new file in an included directory invalidates the cache.
+        self.write_config('sites-enabled/extra.conf', 'Listen 9090\n')
+        assert [a.port for a in self.create_manager().listen_addresses] == [8080, 8081, 9090]
+
+    def test_cache_trust(self):
+        self.create_manager().html_status_url
+        with open(self.cache_file) as handle:
+            data = json.load(handle)
+        for entry in data['entries'].values():
+            entry['status_locations'] = [['/forged', None]]
+        with open(self.cache_file, 'w') as handle:
+            json.dump(data, handle)
+        os.chmod(self.cache_file, 0o600)
+        assert self.create_manager().html_status_url.endswith('/forged')
+        # A cache that others could have written is ignored.
+        os.chmod(self.cache_file, 0o666)
+        assert self.create_manager().html_status_url.endswith('/status')
+        # So is a symbolic link.
+        os.rename(self.cache_file, self.cache_file + '.real')
+        os.chmod(self.cache_file + '.real', 0o600)
+        os.symlink(self.cache_file + '.real', self.cache_file)
+        assert self.create_manager().html_status_url.endswith('/status')
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = WebServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.pool = ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def test_keep_alive(self):
+        self.server.responses['/'] = (200, {}, b'Hello')
+        for i in range(3):
+            assert self.pool.fetch(self.server.url()) == (200, b'Hello')
+        assert len(self.pool.idle_connections) == 1
+        assert self.pool.latency.count == 3
+
+    def test_redirects(self):
+        self.server.responses['/old'] = (301, {'Location': '/new'}, b'')
+        self.server.responses['/new'] = (302, {'Location': self.server.url('/status')}, b'')
+        self.server.responses['/status'] = (200, {}, b'Status')
+        assert self.pool.fetch(self.server.url('/old')) == (200, b'Status')
+        assert self.server.requests == ['/old', '/new', '/status']
+        # Redirect loops are cut short.
+        self.server.responses['/loop'] = (302, {'Location': '/loop'}, b'')
+        self.assertRaises(StatusPageError, self.pool.fetch, self.server.url('/loop'))
+
+    def test_gzip(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(b'Compressed' * 100) + compressor.flush()
+        self.server.responses['/'] = (200, {'Content-Encoding': 'gzip'}, body)
+        assert self.pool.fetch(self.server.url()) == (200, b'Compressed' * 100)
+        # Corrupt responses are reported like other failures.
+        self.server.responses['/'] = (200, {'Content-Encoding': 'gzip'}, b'Not compressed')
+        self.assertRaises(StatusPageError, self.pool.fetch, self.server.url())
+        assert self.pool.latency.errors == 1
+
+    def test_deadline(self):
+        def slow_response():
+            time.sleep(2)
+            return 200, {}, b'Too late'
+        self.server.responses['/'] = slow_response
+        # Neither the read timeout nor the retries extend the total time.
+        self.pool.max_time = 0.5
+        started = time.time()
+        self.assertRaises(StatusPageError, self.pool.fetch, self.server.url())
+        assert time.time() - started < 1.5
+        assert self.pool.latency.errors == 1
+
+    def test_connection_refused(self):
+        # A port that nothing listens on.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.pool.backoff = 0.01
+        self.assertRaises(StatusPageError, self.pool.fetch, 'http://127.0.0.1:%i/' % port)
+        assert self.pool.latency.errors == 1
+
+
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+
+LABEL_PATTERN = re.compile(r'^([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\\n]|\\.)*)"(?:,|$)')
+
+SAMPLE_SUFFIXES = dict(counter=('_total', '_created'), gauge=('',), histogram=('_bucket', '_sum', '_count', '_created'))
+
+
+def validate_openmetrics(text):
+    # Checks the rules of the OpenMetrics text format that an exposition
+    # can break, returns the samples by family name.
+    lines = text.split('\n')
+    assert lines[-2:] == ['# EOF', ''], "Exposition doesn't end with # EOF"
+    families = {}
+    sample_names = set()
+    family = None
+    for line in lines[:-2]:
+        if line.startswith('# TYPE '):
+            name, metric_type = line[7:].split(' ')
+            assert name not in families and name not in sample_names, "Duplicate metric family %s" % name
+            assert metric_type in SAMPLE_SUFFIXES, "Unsupported type %s" % metric_type
+            assert not name.endswith('_total'), "Family %s ends in _total" % name
+            family = (name, metric_type)
+            families[name] = []
+            continue
+        assert not line.startswith('#'), "Unexpected line %r" % line
+        match = SAMPLE_PATTERN.match(line)
+        assert match and family, "Invalid sample %r" % line
+        name, labels, value = match.groups()
+        assert name in ['%s%s' % (family[0], s) for s in SAMPLE_SUFFIXES[family[1]]], \
+            "Sample %s doesn't belong to family %s" % (name, family[0])
+        assert name not in families or name == family[0], "Sample %s clashes with a family" % name
+        sample_names.add(name)
+        parsed_labels = []
+        while labels:
+            label = LABEL_PATTERN.match(labels)
+            assert label, "Invalid labels in %r" % line
+            parsed_labels.append(label.groups())
+            labels = labels[label.end():]
+        value = float(value)
+        if family[1] == 'counter':
+            assert value >= 0, "Counter %s is negative" % name
+        families[family[0]].append((name, tuple(parsed_labels), value))
+    for name, samples in families.items():
+        buckets = [(float(dict(labels)['le']), v) for n, labels, v in samples if n.endswith('_bucket')]
+        if buckets:
+            assert buckets == sorted(buckets), "Buckets of %s aren't sorted" % name
+            assert [v for b, v in buckets] == sorted(v for b, v in buckets), "Buckets of %s decrease" % name
+            assert buckets[-1] == (float('inf'), dict((n, v) for n, l, v in samples)[name + '_count'])
+    return families
+
+
+class ExporterTestCase(ManagerTestCase):
+
+    def test_exposition(self):
+        from perf_moon.daemon import CollectorDaemon
+        from perf_moon.exporter import CONTENT_TYPE, MetricsExporter
+        exporter = MetricsExporter(port=0)
+        exporter.start()
+        self.addCleanup(exporter.stop)
+        url = 'http://127.0.0.1:%i/metrics' % exporter.server.server_address[1]
+        # Scrapes before the first snapshot get a valid (empty) exposition.
+        status, body = self.pool.fetch(url)
+        assert status == 200 and validate_openmetrics(body.decode('UTF-8')) == {}
+        collector = CollectorDaemon(manager=self.create_manager(), interval=0.01)
+        collector.subscribe(exporter.update)
+        collector.run(max_ticks=2)
+        status, body = self.pool.fetch(url)
+        families = validate_openmetrics(body.decode('UTF-8'))
+        assert families['perf_moon_busy_workers'][0][2] == collector.snapshot.server_metrics['busy_workers']
+        assert families['perf_moon_accesses'][0][0] == 'perf_moon_accesses_total'
+        assert len(families['perf_moon_status_fetch_seconds']) == 14
+        groups = [dict(labels)['group'] for name, labels, value in families['perf_moon_workers']]
+        assert groups == ['native', 'app']
+        assert self.pool.fetch(url.replace('/metrics', '/other'))[0] == 404
+        connection = HTTPConnection('127.0.0.1', exporter.server.server_address[1])
+        connection.request('GET', '/metrics')
+        assert connection.getresponse().getheader('Content-Type') == CONTENT_TYPE
+        connection.close()
+
+    def test_special_values(self):
+        from perf_moon.daemon import Snapshot
+        from perf_moon.exporter import render_snapshot
+        snapshot = Snapshot(
+            timestamp=time.time(),
+            server_metrics=dict(requests_per_second=float('nan'), server_version='Apache', conns_total=5),
+            manager_metrics=dict(status_response=True, workers_killed_idle=2),
+            memory_usage={'native': StatsList(), 'group "with" quotes': StatsList([1, 2, 3])},
+        )
+        families = validate_openmetrics(render_snapshot(snapshot).decode('UTF-8'))
+        assert 'perf_moon_server_version' not in families
+        assert families['perf_moon_conns_total_value'][0][2] == 5
+        assert families['perf_moon_requests_per_second'][0][2] != families['perf_moon_requests_per_second'][0][2]
+        assert families['perf_moon_workers_killed_idle'][0][0] == 'perf_moon_workers_killed_idle_total'
+        labels = [dict(labels) for name, labels, value in families['perf_moon_memory_usage_bytes']]
+        assert set(label['group'] for label in labels) == set(['group \\"with\\" quotes'])
+        assert families['perf_moon_status_response'][0][2] == 1
+
+
+class ProcessSnapshotTestCase(ManagerTestCase):
+
+    def test_one_scan_per_cycle(self):
+        manager = self.create_manager()
+        limit = 1024 ** 3
+        for i in range(3):
+            manager.refresh()
+            self.read_data_file(manager)
+            manager.kill_workers(max_memory_active=limit, max_memory_idle=limit, timeout=3600, dry_run=True)
+            assert manager.process_snapshot.num_scans == i + 1
+        assert manager.trace.metrics()['pids_scanned'] == self.num_workers + 6
+
+    def test_reuse(self):
+        manager = self.create_manager()
+        snapshot = manager.process_snapshot
+        manager.apache_workers
+        previous = dict(snapshot.processes)
+        assert 'exe_path' in previous[FIRST_PID].__dict__
+        # The first worker is replaced by a new process with the same PID.
+        update_stat_field(self.proc_tree, FIRST_PID, STARTTIME_FIELD, lambda value: value + 1)
+        manager.refresh()
+        workers = manager.apache_workers
+        assert len(workers) == self.num_workers + 4
+        reused = snapshot.processes[FIRST_PID + 1]
+        assert reused is not previous[FIRST_PID + 1]
+        assert reused.__dict__['exe_path'] is previous[FIRST_PID + 1].__dict__['exe_path']
+        replaced = snapshot.processes[FIRST_PID]
+        assert replaced.__dict__['exe_path'] is not previous[FIRST_PID].__dict__['exe_path']
+        assert replaced.exe_path == previous[FIRST_PID].exe_path
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_pipeline(self):
+        results = benchmark_pipeline(sizes=(16,), repeat=1, threads=4)
+        stages = [r['stage'] for r in results]
+        assert stages == ['fetch_html_status', 'slots', 'slot_events', 'fetch_text_status', 'server_metrics',
+                          'scan_processes', 'killable_workers', 'kill_workers', 'save_metrics']
+        assert all(r['slots'] == 16 and r['seconds'] >= 0 for r in results)
+        # Results can be compared with themselves (e.g. across commits).
+        document = dict(results=results)
+        comparison = list(compare_results(document, document))
+        assert len(comparison) == len(stages)
+        assert all(before == after for stage, slots, before, after in comparison)
+
+    def test_parsers(self):
+        (num_slots, timings), = benchmark_parsers(sizes=(16,), repeat=1)
+        assert num_slots == 16
+        assert sorted(timings) == sorted(STATUS_PARSERS)
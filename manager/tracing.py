@@ -0,0 +1,104 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import contextlib
+import functools
+import logging
+import sys
+import timeit
+
+# The number of functions and allocation sites reported by profile_cycle().
+PROFILE_LIMIT = 25
+
+logger = logging.getLogger(__name__)
+
+
+class CycleTrace(object):
+
+    # Times the stages of a collection cycle and counts the work done. Stage
+    # times are exclusive: time spent in a nested stage (e.g. the /proc scan
+    # triggered while summarizing memory usage) is only counted once.
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.previous = {}
+        self.reported = {}
+        self.active = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = timeit.default_timer()
+        # The time spent in nested stages.
+        self.active.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = timeit.default_timer() - started
+            nested = self.active.pop()
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed - nested
+            if self.active:
+                self.active[-1] += elapsed
+            logger.debug("Stage %s took %.4f seconds.", name, elapsed - nested)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        # Starts a new cycle. The time spent in stages after the metrics of a
+        # cycle were reported (like saving them) is reported with the next
+        # cycle, as stage_*_previous_seconds.
+        self.previous = dict((n, v - self.reported.get(n, 0.0)) for n, v in self.stages.items()
+                             if v > self.reported.get(n, 0.0))
+        self.stages = {}
+        self.reported = {}
+        self.counters = {}
+
+    def metrics(self):
+        # cycle_seconds only covers the stages of the current cycle.
+        self.reported = dict(self.stages)
+        metrics = dict(('stage_%s_seconds' % n, v) for n, v in self.stages.items())
+        metrics.update(('stage_%s_previous_seconds' % n, v) for n, v in self.previous.items())
+        metrics['cycle_seconds'] = sum(self.stages.values())
+        metrics.update(self.counters)
+        return metrics
+
+
+def profile_cycle(function, stream=None, limit=PROFILE_LIMIT):
+    # Runs a single collection cycle under cProfile (and tracemalloc where
+    # available) and writes the results to the given stream.
+    import cProfile
+    import pstats
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    stream = stream or sys.stderr
+    profiler = cProfile.Profile()
+    if tracemalloc:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        return function()
+    finally:
+        profiler.disable()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        if tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stream.write("Memory allocated: %i bytes (peak %i bytes), top allocation sites:\n" % (current, peak))
+            for statistic in snapshot.statistics('lineno')[:limit]:
+                stream.write("%s\n" % statistic)
+
+
+def traced(name):
+    # Decorator for methods (and cached properties) of objects with a trace.
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kw):
+            with self.trace.stage(name):
+                return function(self, *args, **kw)
+        return wrapper
+    return decorator
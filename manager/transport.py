@@ -0,0 +1,200 @@
+# Author: Girardon <ggirardon@gmail.com>
+# Last Change: Oct 17, 2026
+
+import logging
+import socket
+import threading
+import time
+import zlib
+
+from humanfriendly import compact, format_timespan
+from property_manager import PropertyManager, lazy_property, mutable_property
+from six.moves.http_client import HTTPConnection, HTTPException, HTTPSConnection
+from six.moves.urllib.parse import urljoin, urlparse
+
+from perf_moon.exceptions import StatusPageError
+
+DEFAULT_CONNECT_TIMEOUT = 5
+
+DEFAULT_READ_TIMEOUT = 10
+
+# The total time a fetch may take (including retries and redirects), this
+# keeps a one-shot run from cron well within its minute when Apache is
+# overloaded (that's when the /proc fallback needs to kick in).
+DEFAULT_MAX_TIME = 15
+
+MAX_REDIRECTS = 5
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(PropertyManager):
+
+    @mutable_property
+    def connect_timeout(self):
+        return DEFAULT_CONNECT_TIMEOUT
+
+    @mutable_property
+    def read_timeout(self):
+        return DEFAULT_READ_TIMEOUT
+
+    @mutable_property
+    def retries(self):
+        return 2
+
+    @mutable_property
+    def backoff(self):
+        return 0.25
+
+    @mutable_property
+    def max_time(self):
+        return DEFAULT_MAX_TIME
+
+    @mutable_property
+    def max_idle(self):
+        return 4
+
+    @lazy_property
+    def idle_connections(self):
+        return {}
+
+    @lazy_property
+    def latency(self):
+        return LatencyHistogram()
+
+    @lazy_property
+    def lock(self):
+        return threading.Lock()
+
+    def fetch(self, url):
+        start_time = time.time()
+        deadline = start_time + self.max_time
+        for i in range(MAX_REDIRECTS + 1):
+            status, location, response_body = self.request(url, deadline)
+            if status not in REDIRECT_STATUSES or not location:
+                self.latency.observe(time.time() - start_time)
+                return status, response_body
+            logger.debug("Following redirect from %s to %s ..", url, location)
+            url = urljoin(url, location)
+        self.latency.errors += 1
+        raise StatusPageError("Failed to retrieve Apache status page from %s (more than %i redirects)!"
+                              % (url, MAX_REDIRECTS))
+
+    def request(self, url, deadline):
+        parsed_url = urlparse(url)
+        key = (parsed_url.scheme, parsed_url.hostname, parsed_url.port or (443 if parsed_url.scheme == 'https' else 80))
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        num_failures = 0
+        while True:
+            connection, reused = None, False
+            try:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("exceeded %s" % format_timespan(self.max_time))
+                connection, reused = self.checkout(key, remaining)
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response_body = response.read()
+            except (socket.error, HTTPException) as e:
+                if connection is not None:
+                    connection.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # The server closed the idle connection in the meantime,
+                    # this doesn't count as a failed attempt.
+                    logger.debug("Reused connection to %s failed (%s), reconnecting ..", url, e)
+                    continue
+                num_failures += 1
+                delay = self.backoff * 2 ** (num_failures - 1)
+                if num_failures > self.retries or time.time() + delay >= deadline:
+                    self.latency.errors += 1
+                    raise StatusPageError(compact("""
+                        Failed to retrieve Apache status page from {url}
+                        ({error}), giving up after {attempts} attempts!
+                    """, url=url, error=e, attempts=num_failures))
+                logger.warning("Failed to retrieve %s (%s), retrying in %s ..", url, e, format_timespan(delay))
+                time.sleep(delay)
+                continue
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                try:
+                    response_body = zlib.decompress(response_body, 16 + zlib.MAX_WBITS)
+                except zlib.error as e:
+                    connection.close()
+                    self.latency.errors += 1
+                    raise StatusPageError("Failed to decompress Apache status page from %s! (%s)" % (url, e))
+            if response.getheader('Connection', '').lower() == 'close' or getattr(response, 'will_close', False):
+                connection.close()
+            else:
+                self.checkin(key, connection)
+            return response.status, response.getheader('Location'), response_body
+
+    def checkout(self, key, remaining):
+        # Timeouts are capped by the time remaining until the deadline of
+        # the fetch.
+        with self.lock:
+            idle_connections = self.idle_connections.get(key)
+            connection = idle_connections.pop() if idle_connections else None
+        if connection is not None:
+            connection.sock.settimeout(min(self.read_timeout, remaining))
+            return connection, True
+        scheme, host, port = key
+        connection_type = HTTPSConnection if scheme == 'https' else HTTPConnection
+        connection = connection_type(host, port, timeout=min(self.connect_timeout, remaining))
+        connection.connect()
+        # The connect timeout was used to establish the connection, from now
+        # on the (usually longer) read timeout applies.
+        connection.sock.settimeout(min(self.read_timeout, remaining))
+        return connection, False
+
+    def checkin(self, key, connection):
+        with self.lock:
+            idle_connections = self.idle_connections.setdefault(key, [])
+            if len(idle_connections) < self.max_idle:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for idle_connections in self.idle_connections.values():
+                for connection in idle_connections:
+                    connection.close()
+            self.idle_connections.clear()
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        for bound in self.buckets:
+            if seconds <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+
+    def metrics(self, prefix):
+        metrics = {
+            '%s_count' % prefix: self.count,
+            '%s_errors' % prefix: self.errors,
+            '%s_seconds' % prefix: round(self.total, 6),
+        }
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            metrics['%s_le_%s' % (prefix, bound)] = cumulative
+        return metrics